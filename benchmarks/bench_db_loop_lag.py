@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+قياس تأخر حلقة الأحداث تحت حمل قاعدة البيانات: الجلسات المتزامنة مقابل aiosqlite
+Event-Loop Lag Benchmark (sync SessionLocal vs async DatabaseManager)
+
+ينفذ نفس عمل المعالجات (حفظ المستخدم، سجل التنزيل وتحديثه، /stats و/history)
+من عدة مستخدمين متزامنين، بينما يقيس مجس تأخر استيقاظ حلقة الأحداث عن موعده.
+المسار المتزامن هو ما كانت المعالجات تفعله بـ next(get_db()) داخل الدوال غير المتزامنة.
+
+الاستخدام: python benchmarks/bench_db_loop_lag.py [عدد_سجلات_التنزيل] [عدد_المستخدمين_المتزامنين]
+"""
+
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+# إعدادات كافية لاستيراد config دون ملف .env
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ.setdefault("ADMIN_ID", "1")
+
+project_root = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(project_root))
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import database
+from database import Download, User
+from services.database_manager import DatabaseManager
+from utils.logger import logger
+
+# عدم قياس زمن الكتابة في السجلات
+logger.setLevel(logging.WARNING)
+
+PROBE_INTERVAL = 0.005
+USERS = 1000
+
+def seed(db_url: str, rows: int):
+    """سجلات تنزيل موزعة على المستخدمين"""
+    engine = create_engine(db_url)
+    database.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [{'telegram_id': i} for i in range(USERS)])
+        now = datetime.utcnow()
+        for start in range(0, rows, 50_000):
+            conn.execute(Download.__table__.insert(), [
+                {'user_id': i % USERS, 'url': f"https://site{i}.example", 'domain': f"site{i % 97}.example",
+                 'status': 'completed' if i % 4 else 'failed', 'file_size': 1024.0, 'created_at': now}
+                for i in range(start, min(start + 50_000, rows))
+            ])
+    engine.dispose()
+
+async def sync_handler(Session, user_id: int):
+    """المسار القديم: استعلامات متزامنة داخل المعالج"""
+    db = Session()
+    try:
+        db_user = db.query(User).filter(User.telegram_id == user_id).first()
+        db_user.last_activity = datetime.utcnow()
+        record = Download(user_id=user_id, url="https://new.example", domain="new.example")
+        db.add(record)
+        db.commit()
+        record.status = 'completed'
+        db.commit()
+        db.query(Download).filter(Download.user_id == user_id).count()
+        db.query(Download).filter(Download.user_id == user_id, Download.status == 'completed').count()
+        db.query(func.sum(Download.file_size)).filter(Download.user_id == user_id).scalar()
+        db.query(Download).filter(Download.user_id == user_id).order_by(Download.created_at.desc()).limit(10).all()
+    finally:
+        db.close()
+
+async def async_handler(manager: DatabaseManager, user_id: int):
+    """المسار الجديد: نفس العمل عبر طبقة aiosqlite"""
+    await manager.save_user(user_id)
+    download_id = await manager.create_download(user_id, "https://new.example", domain="new.example")
+    await manager.update_download(download_id, status='completed')
+    await manager.get_user_summary(user_id)
+    await manager.get_user_downloads(user_id, limit=10)
+
+async def measure(run_handler, concurrency: int, rounds: int) -> dict:
+    """تشغيل المعالجات بالتوازي مع مجس تأخر الحلقة"""
+    lags = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            expected = time.perf_counter() + PROBE_INTERVAL
+            await asyncio.sleep(PROBE_INTERVAL)
+            lags.append(max(0.0, time.perf_counter() - expected))
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    for round_number in range(rounds):
+        await asyncio.gather(*(
+            run_handler((round_number * concurrency + i) % USERS) for i in range(concurrency)
+        ))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await probe_task
+
+    lags.sort()
+    return {
+        'handlers_per_s': concurrency * rounds / elapsed,
+        'lag_p50_ms': statistics.median(lags) * 1000,
+        'lag_p99_ms': lags[int(len(lags) * 0.99) - 1] * 1000,
+        'lag_max_ms': lags[-1] * 1000,
+    }
+
+async def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rounds = 4
+    columns = ['path', 'handlers_per_s', 'lag_p50_ms', 'lag_p99_ms', 'lag_max_ms']
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        seed(db_url, rows)
+        print(f"downloads={rows:,} concurrency={concurrency}")
+        print(" | ".join(f"{c:>15}" for c in columns))
+
+        engine = create_engine(db_url, connect_args={'timeout': 30})
+        Session = sessionmaker(bind=engine, autoflush=False)
+        results = [('sync', await measure(lambda user_id: sync_handler(Session, user_id), concurrency, rounds))]
+        engine.dispose()
+
+        manager = DatabaseManager(db_url)
+        await manager.initialize()
+        try:
+            results.append(('async', await measure(lambda user_id: async_handler(manager, user_id),
+                                                   concurrency, rounds)))
+        finally:
+            await manager.close()
+
+        for path, result in results:
+            print(" | ".join([f"{path:>15}"] + [f"{result[c]:>15.2f}" for c in columns[1:]]))
+
+if __name__ == "__main__":
+    asyncio.run(main())
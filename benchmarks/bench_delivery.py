@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+قياس زمن تسليم الأرشيف: رفع المحتوى مقابل مسار الملف (خادم Bot API محلي)
+Archive Delivery Benchmark (multipart upload vs local file path)
+
+يشغل خادماً بديلاً لـ Bot API على localhost يقرأ الطلب كاملاً كما يفعل الخادم
+الحقيقي، ثم يرسل نفس الأرشيف بالطريقتين. الفرق هو كلفة قراءة الملف وترميزه
+ونقله عبر HTTP، وهي ما يلغيه local_mode في النشر على نفس الجهاز.
+
+الاستخدام: python benchmarks/bench_delivery.py [الحجم_بالميغابايت]
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# إعدادات كافية لاستيراد config دون ملف .env
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ.setdefault("ADMIN_ID", "1")
+
+project_root = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(project_root))
+
+from aiohttp import web
+from telegram.ext import ExtBot
+
+from services.delivery import ArchiveDelivery
+from utils.logger import logger
+
+# عدم قياس زمن الكتابة في السجلات
+logger.setLevel(logging.WARNING)
+
+ROUNDS = 5
+
+async def api(request):
+    """بديل Bot API: يقرأ الجسم كاملاً ويرد برسالة فيها مستند"""
+    await request.read()
+    if request.match_info['method'] == "getMe":
+        result = {'id': 1, 'is_bot': True, 'first_name': "bench", 'username': "bench"}
+    else:
+        result = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': "private"},
+                  'document': {'file_id': "fid", 'file_unique_id': "u"}}
+    return web.json_response({'ok': True, 'result': result})
+
+async def bench(size_mb: int, base_url: str, archive: str) -> dict:
+    result = {'size_mb': size_mb}
+    for local_mode in (False, True):
+        bot = ExtBot("1:bench", base_url=base_url, local_mode=local_mode)
+        await bot.initialize()
+        delivery = ArchiveDelivery(local_mode=local_mode, upload_limit=(size_mb + 1) * 1024 * 1024)
+        try:
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                await delivery.deliver(bot, 1, archive, "site.zip")
+            elapsed = (time.perf_counter() - start) / ROUNDS
+        finally:
+            await bot.shutdown()
+        result['local_path_ms' if local_mode else 'upload_ms'] = elapsed * 1000
+    return result
+
+async def main():
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [5, 20, 50]
+    columns = ['size_mb', 'upload_ms', 'local_path_ms']
+
+    app = web.Application(client_max_size=max(sizes) * 1024 * 1024 * 2)
+    app.router.add_post("/bot{token}/{method}", api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/bot"
+
+    print(" | ".join(f"{c:>15}" for c in columns))
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                archive = os.path.join(directory, f"site_{size}.zip")
+                with open(archive, 'wb') as file:
+                    file.write(os.urandom(size * 1024 * 1024))
+                result = await bench(size, base_url, archive)
+                print(" | ".join(
+                    f"{result[c]:>15,}" if c == 'size_mb' else f"{result[c]:>15.2f}" for c in columns
+                ))
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+قياس أداء عمليات قائمة الانتظار
+Queue Operations Benchmark
+
+يقيس متوسط زمن add_task و get_task_status و get_queue_position و cancel_task وعد مهام
+المستخدم عند أحجام مختلفة للقائمة؛ يجب أن يبقى الزمن شبه ثابت مع نمو القائمة.
+
+الاستخدام: python benchmarks/bench_queue.py [عدد_المهام]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+# إعدادات كافية لاستيراد config دون ملف .env
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ.setdefault("ADMIN_ID", "1")
+
+project_root = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(project_root))
+
+from services.queue_manager import DownloadQueue
+from utils.logger import logger
+
+# عدم قياس زمن الكتابة في السجلات
+logger.setLevel(logging.WARNING)
+
+TASKS_PER_USER = 4
+SAMPLES = 2000
+
+async def bench(total_tasks: int) -> dict:
+    """ملء قائمة غير مشغلة بعدد المهام ثم قياس العمليات"""
+    queue = DownloadQueue(max_concurrent=1)
+    queue.max_pending = total_tasks  # القياس لحجم القائمة لا لحد الضغط العكسي
+    task_ids = []
+
+    start = time.perf_counter()
+    for i in range(total_tasks):
+        task_ids.append(await queue.add_task(i // TASKS_PER_USER, f"https://site{i}.example"))
+    add_time = (time.perf_counter() - start) / total_tasks
+
+    sample_ids = random.sample(task_ids, min(SAMPLES, len(task_ids) // 2))
+
+    start = time.perf_counter()
+    for task_id in sample_ids:
+        await queue.get_task_status(task_id)
+    status_time = (time.perf_counter() - start) / len(sample_ids)
+
+    # يُستدعى مع كل إضافة وتحديث حالة لعرض ترتيب المستخدم
+    start = time.perf_counter()
+    for task_id in sample_ids:
+        queue.get_queue_position(task_id)
+    position_time = (time.perf_counter() - start) / len(sample_ids)
+
+    start = time.perf_counter()
+    for task_id in sample_ids:
+        queue._get_user_pending_count(random.randrange(total_tasks // TASKS_PER_USER))
+    count_time = (time.perf_counter() - start) / len(sample_ids)
+
+    start = time.perf_counter()
+    for task_id in sample_ids:
+        await queue.cancel_task(task_id)
+    cancel_time = (time.perf_counter() - start) / len(sample_ids)
+
+    start = time.perf_counter()
+    popped = 0
+    while queue._pop_pending() is not None and popped < len(sample_ids):
+        popped += 1
+    pop_time = (time.perf_counter() - start) / max(1, popped)
+
+    return {
+        'tasks': total_tasks,
+        'add_us': add_time * 1e6,
+        'status_us': status_time * 1e6,
+        'position_us': position_time * 1e6,
+        'user_count_us': count_time * 1e6,
+        'cancel_us': cancel_time * 1e6,
+        'dispatch_pop_us': pop_time * 1e6,
+    }
+
+async def main():
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [1_000, 10_000, 100_000]
+    columns = ['tasks', 'add_us', 'status_us', 'position_us', 'user_count_us', 'cancel_us', 'dispatch_pop_us']
+
+    print(" | ".join(f"{c:>15}" for c in columns))
+    for size in sizes:
+        result = await bench(size)
+        print(" | ".join(
+            f"{result[c]:>15,}" if c == 'tasks' else f"{result[c]:>15.2f}" for c in columns
+        ))
+
+if __name__ == "__main__":
+    asyncio.run(main())
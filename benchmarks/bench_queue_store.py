@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+قياس أداء قائمة الانتظار الدائمة
+Durable Queue Benchmark
+
+يقيس معدل إضافة المهام مع مخزن SQLite (حتى اكتمال الكتابة على القرص)
+وزمن استعادتها عند بدء عملية جديدة.
+
+الاستخدام: python benchmarks/bench_queue_store.py [عدد_المهام]
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# إعدادات كافية لاستيراد config دون ملف .env
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ.setdefault("ADMIN_ID", "1")
+
+project_root = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(project_root))
+
+from services.queue_manager import DownloadQueue
+from services.queue_store import QueueStore
+from utils.logger import logger
+
+# عدم قياس زمن الكتابة في السجلات
+logger.setLevel(logging.WARNING)
+
+TASKS_PER_USER = 4
+
+async def bench(total_tasks: int, db_path: str) -> dict:
+    """إضافة المهام مع المخزن ثم استعادتها في قائمة جديدة"""
+    store = QueueStore(path=db_path)
+    await store.start()
+    queue = DownloadQueue(max_concurrent=1, store=store)
+    queue.max_pending = total_tasks  # القياس لحجم القائمة لا لحد الضغط العكسي
+
+    start = time.perf_counter()
+    for i in range(total_tasks):
+        await queue.add_task(i // TASKS_PER_USER, f"https://site{i}.example", handler="download")
+    await store.flush()
+    enqueue_time = time.perf_counter() - start
+    await store.stop()
+
+    # استعادة في "عملية" جديدة بدون تشغيل الموزع
+    recovered = DownloadQueue(max_concurrent=1, store=QueueStore(path=db_path))
+    await recovered.store.start()
+    start = time.perf_counter()
+    await recovered._recover_tasks()
+    recover_time = time.perf_counter() - start
+    await recovered.store.stop()
+
+    return {
+        'tasks': total_tasks,
+        'enqueue_per_s': total_tasks / enqueue_time,
+        'recover_ms': recover_time * 1000,
+        'recovered': len(recovered._pending_index),
+    }
+
+async def main():
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [1_000, 10_000, 50_000]
+    columns = ['tasks', 'enqueue_per_s', 'recover_ms', 'recovered']
+
+    print(" | ".join(f"{c:>15}" for c in columns))
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            result = await bench(size, os.path.join(temp_dir, "queue.db"))
+        print(" | ".join(
+            f"{result[c]:>15,.2f}" if isinstance(result[c], float) else f"{result[c]:>15,}"
+            for c in columns
+        ))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+قياس زمن /stats و/history على جدول تنزيلات كبير
+Per-User Stats Benchmark (four scans vs one indexed aggregate)
+
+يملأ جدول downloads بمخططه القديم (بلا فهارس)، فيقيس استعلامات /stats الأربعة
+السابقة، ثم يطبق الترحيلات كما يحدث لقاعدة إنتاج قائمة ويقيس الاستعلام التجميعي
+الواحد عبر الفهرس المغطي وآخر تنزيلات المستخدم عبر (user_id, created_at).
+
+الاستخدام: python benchmarks/bench_stats.py [عدد_سجلات_التنزيل]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# إعدادات كافية لاستيراد config دون ملف .env
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ.setdefault("ADMIN_ID", "1")
+
+project_root = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(project_root))
+
+from sqlalchemy import create_engine
+
+import database
+from services.database_manager import DatabaseManager
+from utils.logger import logger
+
+# عدم قياس زمن الكتابة في السجلات
+logger.setLevel(logging.WARNING)
+
+ROWS_PER_USER = 100
+STATUSES = ('completed', 'completed', 'completed', 'failed', 'cancelled')
+
+# استعلامات /stats كما كانت قبل الفهارس والتجميع
+OLD_STATS = (
+    "SELECT count(*) FROM downloads WHERE user_id = ?",
+    "SELECT count(*) FROM downloads WHERE user_id = ? AND status = 'completed'",
+    "SELECT sum(file_size) FROM downloads WHERE user_id = ? AND status = 'completed'",
+    "SELECT * FROM downloads WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
+)
+
+# الاستعلام التجميعي الذي يولده DatabaseManager.get_user_summary
+NEW_STATS = (
+    "SELECT count(*), sum(CASE WHEN status = 'completed' THEN 1 ELSE 0 END), "
+    "sum(CASE WHEN status = 'completed' THEN file_size ELSE 0 END), max(created_at) "
+    "FROM downloads WHERE user_id = ?",
+)
+
+def seed(path: str, rows: int):
+    """جدول التنزيلات بمخططه الأصلي (المفتاح الأساسي فقط)"""
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=OFF;
+        CREATE TABLE downloads (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, url VARCHAR NOT NULL,
+                                domain VARCHAR, status VARCHAR, file_path VARCHAR, file_size FLOAT,
+                                total_files INTEGER, start_time DATETIME, end_time DATETIME,
+                                error_message VARCHAR, created_at DATETIME);
+    """)
+    users = max(1, rows // ROWS_PER_USER)
+    start = datetime(2024, 1, 1)
+    chunk = 100_000
+    for offset in range(0, rows, chunk):
+        connection.executemany(
+            "INSERT INTO downloads (user_id, url, domain, status, file_size, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i % users, f"https://site{i % 5000}.example/", f"site{i % 5000}.example",
+              STATUSES[i % len(STATUSES)], float(i % 50_000_000),
+              (start + timedelta(seconds=i)).isoformat(sep=' '))
+             for i in range(offset, min(offset + chunk, rows)))
+        )
+        connection.commit()
+    connection.close()
+    return users
+
+def time_sql(path: str, queries: tuple, users: int, samples: int) -> list:
+    """زمن استعلامات /stats في SQLite وحده دون طبقة الوصول"""
+    connection = sqlite3.connect(path)
+    timings = []
+    for _ in range(samples):
+        user_id = random.randrange(users)
+        start = time.perf_counter()
+        for query in queries:
+            connection.execute(query, (user_id,)).fetchall()
+        timings.append(time.perf_counter() - start)
+    connection.close()
+    return timings
+
+async def time_new(manager: DatabaseManager, users: int, samples: int) -> dict:
+    """أزمنة get_user_summary وget_user_downloads بعد الترحيل"""
+    stats, history = [], []
+    for _ in range(samples):
+        user_id = random.randrange(users)
+        start = time.perf_counter()
+        await manager.get_user_summary(user_id)
+        stats.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await manager.get_user_downloads(user_id, limit=10)
+        history.append(time.perf_counter() - start)
+    return {'stats': stats, 'history': history}
+
+def summarize(timings: list) -> str:
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1000
+    p99 = timings[max(0, int(len(timings) * 0.99) - 1)] * 1000
+    return f"p50={p50:.3f}ms p99={p99:.3f}ms"
+
+async def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    random.seed(1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        start = time.perf_counter()
+        users = seed(path, rows)
+        print(f"downloads={rows:,} users={users:,} seeded in {time.perf_counter() - start:.1f}s")
+
+        print(f"old /stats (4 scans)        {summarize(time_sql(path, OLD_STATS, users, 5))}")
+
+        engine = create_engine(f"sqlite:///{path}")
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            version = database.migrate(connection)
+        engine.dispose()
+        print(f"migrated to v{version} in {time.perf_counter() - start:.1f}s")
+        print(f"sql /stats (1 aggregate)    {summarize(time_sql(path, NEW_STATS, users, 2000))}")
+
+        manager = DatabaseManager(f"sqlite:///{path}")
+        await manager.initialize()
+        try:
+            await time_new(manager, users, 50)  # تسخين ذاكرة الصفحات
+            result = await time_new(manager, users, 2000)
+        finally:
+            await manager.close()
+        print(f"get_user_summary (async)    {summarize(result['stats'])}")
+        print(f"get_user_downloads (async)  {summarize(result['history'])}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
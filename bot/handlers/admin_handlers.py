@@ -5,14 +5,15 @@ Admin and Management Handlers
 
 import psutil
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from telegram import Update
 from telegram.ext import ContextTypes
 
 from .base_handler import BaseHandler
 from bot.keyboards import get_admin_keyboard, get_confirmation_keyboard, get_main_keyboard
+from services.broadcast import broadcast_engine
 from utils.logger import logger
-from database import get_db, Download, User
+from services.database_manager import db_manager
 import config
 
 class AdminHandlers(BaseHandler):
@@ -46,20 +47,14 @@ class AdminHandlers(BaseHandler):
         
         try:
             # جمع إحصائيات سريعة
-            db = next(get_db())
-            
-            total_users = db.query(User).count()
-            total_downloads = db.query(Download).count()
+            totals = await db_manager.get_global_stats()
+            total_users = totals['users']
+            total_downloads = totals['downloads']
             active_downloads = len(self.active_downloads)
             banned_users_count = len(self.banned_users)
             
             # إحصائيات اليوم
-            today = datetime.utcnow().date()
-            today_downloads = db.query(Download).filter(
-                Download.created_at >= today
-            ).count()
-            
-            db.close()
+            today_downloads = (await db_manager.get_recent_stats(days=1))['downloads']
             
             admin_text = f"""🛡️ **لوحة تحكم المشرف**
 
@@ -111,36 +106,19 @@ class AdminHandlers(BaseHandler):
         message_text = ' '.join(context.args)
         
         try:
-            # جلب جميع المستخدمين
-            db = next(get_db())
-            users = db.query(User).all()
-            db.close()
-            
-            sent_count = 0
-            failed_count = 0
-            
             broadcast_text = f"📢 **رسالة من إدارة البوت**\n\n{message_text}"
             
-            # إرسال للجميع
-            for user in users:
-                try:
-                    await context.bot.send_message(
-                        chat_id=user.telegram_id,
-                        text=broadcast_text,
-                        parse_mode='Markdown'
-                    )
-                    sent_count += 1
-                except Exception as e:
-                    failed_count += 1
-                    logger.warning(f"فشل إرسال لـ {user.telegram_id}: {e}")
-            
-            # تقرير النتائج
-            result_text = f"✅ **تم إرسال الرسالة الجماعية**\n\n"
-            result_text += f"📤 تم الإرسال لـ: {sent_count} مستخدم\n"
-            result_text += f"❌ فشل الإرسال لـ: {failed_count} مستخدم\n"
-            result_text += f"📊 معدل النجاح: {(sent_count/(sent_count+failed_count)*100):.1f}%"
-            
-            await update.message.reply_text(result_text, parse_mode='Markdown')
+            # الإرسال يجري في الخلفية ويحدّث هذه الرسالة بالتقدم، ويُستأنف بعد إعادة التشغيل
+            status_message = await update.message.reply_text(
+                "📢 **جاري بدء الإرسال الجماعي...**",
+                parse_mode='Markdown'
+            )
+            broadcast_id = await broadcast_engine.create(
+                broadcast_text,
+                admin_chat_id=status_message.chat_id,
+                status_message_id=status_message.message_id
+            )
+            logger.info(f"📢 المشرف {user_id} بدأ الرسالة الجماعية {broadcast_id}")
             
         except Exception as e:
             logger.error(f"❌ خطأ في الإرسال الجماعي: {e}")
@@ -284,21 +262,20 @@ class AdminHandlers(BaseHandler):
             # معلومات النظام
             memory = psutil.virtual_memory()
             disk = psutil.disk_usage('/')
-            cpu_percent = psutil.cpu_percent(interval=1)
+            # بدون interval: القراءة منذ آخر استدعاء بدلاً من حجز حلقة الأحداث ثانية كاملة
+            cpu_percent = psutil.cpu_percent(interval=None)
             
             # معلومات قاعدة البيانات
-            db = next(get_db())
-            total_users = db.query(User).count()
-            total_downloads = db.query(Download).count()
-            successful_downloads = db.query(Download).filter(Download.status == 'completed').count()
-            failed_downloads = db.query(Download).filter(Download.status == 'failed').count()
+            totals = await db_manager.get_global_stats()
+            total_users = totals['users']
+            total_downloads = totals['downloads']
+            successful_downloads = totals['completed']
+            failed_downloads = totals['failed']
             
             # إحصائيات الأسبوع الماضي
-            week_ago = datetime.utcnow() - timedelta(days=7)
-            week_downloads = db.query(Download).filter(Download.created_at >= week_ago).count()
-            week_users = db.query(User).filter(User.created_at >= week_ago).count()
-            
-            db.close()
+            week = await db_manager.get_recent_stats(days=7)
+            week_downloads = week['downloads']
+            week_users = week['new_users']
             
             # معدل النجاح
             success_rate = (successful_downloads / total_downloads * 100) if total_downloads > 0 else 0
@@ -7,12 +7,11 @@ import asyncio
 import time
 from typing import Dict, Optional
 from collections import defaultdict
-from datetime import datetime
 
 from services.downloader import WebsiteDownloader
 from services.file_manager import FileManager
 from utils.logger import logger
-from database import get_db, Download, User
+from services.database_manager import db_manager
 import config
 
 class BaseHandler:
@@ -180,23 +179,14 @@ class BaseHandler:
     async def save_user_to_db(self, user):
         """حفظ بيانات المستخدم في قاعدة البيانات"""
         try:
-            db = next(get_db())
-            db_user = db.query(User).filter(User.telegram_id == user.id).first()
-            
-            if not db_user:
-                db_user = User(
-                    telegram_id=user.id,
-                    username=user.username,
-                    first_name=user.first_name,
-                    last_name=user.last_name
-                )
-                db.add(db_user)
+            db_user, created = await db_manager.save_user(
+                user.id,
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name
+            )
+            if created:
                 logger.info(f"🎆 مستخدم جديد: {user.first_name} ({user.id})")
-            else:
-                db_user.last_activity = datetime.utcnow()
-            
-            db.commit()
-            db.close()
             return db_user
             
         except Exception as e:
@@ -11,6 +11,7 @@ from bot.keyboards import (
     get_main_keyboard, get_settings_keyboard, get_admin_keyboard,
     get_confirmation_keyboard, get_quality_keyboard, get_file_type_keyboard
 )
+from services.database_manager import db_manager
 from utils.logger import logger
 
 class CallbackHandlers(BaseHandler):
@@ -203,7 +204,7 @@ class CallbackHandlers(BaseHandler):
             )
         elif data == "admin_cleanup":
             await self.parent.admin_handlers.cleanup_command(
-                type('obj', (object,), {'message': query, 'effective_user': query.from_user})(),
+                type('obj', (object,), {'message': query.message, 'effective_user': query.from_user})(),
                 context
             )
         elif data == "admin_logs":
@@ -266,10 +267,7 @@ class CallbackHandlers(BaseHandler):
         try:
             download_id = int(data.split('_')[1])
             
-            from database import get_db, Download
-            db = next(get_db())
-            download = db.query(Download).filter(Download.id == download_id).first()
-            db.close()
+            download = await db_manager.get_download(download_id)
             
             if not download:
                 await query.edit_message_text("❌ لم يتم العثور على التنزيل")
@@ -318,37 +316,28 @@ class CallbackHandlers(BaseHandler):
         
         # تفويض الإلغاء لمعالج التنزيل
         await self.parent.download_handlers.cancel(
-            type('obj', (object,), {'message': query, 'effective_user': query.from_user})(),
+            type('obj', (object,), {'message': query.message, 'effective_user': query.from_user})(),
             context
         )
     
     async def _show_detailed_stats(self, query, context):
         """عرض إحصائيات مفصلة"""
         try:
-            from database import get_db, Download, User
-            from datetime import datetime, timedelta
             import psutil
             
-            db = next(get_db())
-            
             # إحصائيات عامة
-            total_users = db.query(User).count()
-            total_downloads = db.query(Download).count()
-            successful_downloads = db.query(Download).filter(Download.status == 'completed').count()
+            totals = await db_manager.get_global_stats()
+            total_users = totals['users']
+            total_downloads = totals['downloads']
+            successful_downloads = totals['completed']
             
             # إحصائيات الشهر الماضي
-            month_ago = datetime.utcnow() - timedelta(days=30)
-            month_downloads = db.query(Download).filter(Download.created_at >= month_ago).count()
-            month_users = db.query(User).filter(User.created_at >= month_ago).count()
+            month = await db_manager.get_recent_stats(days=30)
+            month_downloads = month['downloads']
+            month_users = month['new_users']
             
             # أكثر النطاقات تنزيلاً
-            from sqlalchemy import func
-            top_domains = db.query(
-                Download.domain, 
-                func.count(Download.id).label('count')
-            ).group_by(Download.domain).order_by(func.count(Download.id).desc()).limit(5).all()
-            
-            db.close()
+            top_domains = await db_manager.get_top_domains(limit=5)
             
             # معلومات النظام
             memory = psutil.virtual_memory()
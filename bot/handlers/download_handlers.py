@@ -3,24 +3,37 @@
 Download and File Handlers
 """
 
-import asyncio
-import os
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Dict, Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 
 from .base_handler import BaseHandler
-from utils.helpers import sanitize_filename, get_domain_from_url, human_readable_size
+from services.delivery import DeliveryError, archive_delivery, url_cache_key
+from services.progress_publisher import progress_publisher
+from services.queue_manager import QueueFullError, QueueTask, TaskStatus, download_queue
+from services.worker import DOWNLOAD_HANDLER
+from utils.helpers import get_domain_from_url, human_readable_size, format_timedelta
 from bot.keyboards import get_cancel_keyboard, get_main_keyboard
 from utils.logger import logger
-from database import get_db, Download
+from services.database_manager import db_manager
 import config
 
 class DownloadHandlers(BaseHandler):
-    """معالجات التنزيل والملفات"""
+    """معالجات التنزيل والملفات
+    
+    التنزيلات لا تبدأ مباشرة: تُضاف لقائمة الانتظار العامة التي تحدد عدد الزحف
+    المتزامن، وتصل تحديثات المهمة عبر مستمع مسجل للمعالج DOWNLOAD_HANDLER.
+    """
     
     def __init__(self, parent):
         super().__init__(parent)
+        self.bot = None
+    
+    def bind_queue(self, bot):
+        """ربط مهام التنزيل في القائمة برسائل المستخدمين (قبل بدء القائمة كي تشمل المستعادة)"""
+        self.bot = bot
+        download_queue.register_listener(DOWNLOAD_HANDLER, self._on_task_update)
     
     async def initialize(self):
         """تهيئة معالجات التنزيل"""
@@ -81,50 +94,83 @@ class DownloadHandlers(BaseHandler):
         await self.start_download(update, context, url)
     
     async def start_download(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
-        """بدء عملية التنزيل"""
+        """إضافة التنزيل لقائمة الانتظار مع إظهار الترتيب والوقت المتوقع"""
         user_id = update.effective_user.id
         domain = get_domain_from_url(url)
         
         try:
             # إنشاء سجل في قاعدة البيانات
-            db = next(get_db())
-            download_record = Download(
-                user_id=user_id,
-                url=url,
+            download_id = await db_manager.create_download(
+                user_id, url,
                 domain=domain,
-                status='in_progress',
+                status='pending',
                 created_at=datetime.utcnow()
             )
-            db.add(download_record)
-            db.commit()
-            download_id = download_record.id
-            db.close()
             
-            # إضافة للتنزيلات النشطة
-            self.active_downloads[user_id] = {
-                'download_id': download_id,
-                'url': url,
-                'domain': domain,
-                'start_time': datetime.utcnow(),
-                'status': 'starting'
-            }
+            # وزن المستخدم في الجدولة العادلة حسب اشتراكه
+            is_premium = await db_manager.is_premium(user_id)
+            
+            # نفس الرابط أُرسل مؤخراً: إعادة إرسال الملف بمعرفه دون زحف ولا رفع
+            cached = await archive_delivery.deliver_cached(
+                context.bot,
+                update.effective_chat.id,
+                url_cache_key(url),
+                caption=self._archive_caption(domain) + "\n⚡ تم الإرسال من نسخة محفوظة",
+                reply_markup=get_main_keyboard()
+            )
+            if cached:
+                now = datetime.utcnow()
+                await self._update_download_record(download_id, status='completed', start_time=now, end_time=now)
+                logger.info(f"⚡ إرسال {url} من معرفات الملفات المحفوظة للمستخدم {user_id}")
+                return
             
-            # رسالة بدء التنزيل
+            # رسالة الطلب التي تُحدَّث بحالة المهمة
             progress_message = await update.message.reply_text(
-                f"🚀 **بدء تنزيل الموقع**\n\n"
+                f"📥 **تم استلام الطلب**\n\n"
                 f"🌐 **الموقع:** {domain}\n"
-                f"📊 **الحالة:** جاري التحضير...\n"
-                f"⏰ **بدء في:** {datetime.now().strftime('%H:%M:%S')}\n\n"
-                f"⏳ يرجى الانتظار، قد تستغرق العملية عدة دقائق...",
+                f"📊 **الحالة:** جاري الإضافة لقائمة الانتظار...",
                 parse_mode='Markdown',
                 reply_markup=get_cancel_keyboard()
             )
             
-            # حفظ معرف الرسالة للتحديث
-            self.active_downloads[user_id]['message_id'] = progress_message.message_id
+            # إضافة للتنزيلات النشطة (مهمة واحدة لكل مستخدم)
+            self.active_downloads[user_id] = {
+                'download_id': download_id,
+                'url': url,
+                'domain': domain,
+                'chat_id': progress_message.chat_id,
+                'message_id': progress_message.message_id,
+                'start_time': datetime.utcnow(),
+                'status': 'pending'
+            }
             
-            # بدء التنزيل في مهمة منفصلة
-            asyncio.create_task(self._download_website(update, context, url, download_id))
+            try:
+                task_id = await download_queue.add_task(
+                    user_id, url,
+                    is_premium=is_premium,
+                    handler=DOWNLOAD_HANDLER,
+                    context={
+                        'chat_id': progress_message.chat_id,
+                        'message_id': progress_message.message_id,
+                        'download_id': download_id,
+                        'domain': domain
+                    }
+                )
+            except QueueFullError as e:
+                # ضغط عكسي: رفض واضح بدلاً من زحف إضافي يُسقط العملية
+                self.active_downloads.pop(user_id, None)
+                await self._update_download_record(download_id, status='failed', error_message=str(e),
+                                             end_time=datetime.utcnow())
+                await progress_message.edit_text(
+                    f"🚦 **الخدمة مشغولة حالياً**\n\n"
+                    f"⚠️ {e}\n"
+                    f"⏰ **جرب مرة أخرى بعد:** {self._format_eta(e.retry_after)}",
+                    parse_mode='Markdown'
+                )
+                return
+            
+            self.active_downloads[user_id]['task_id'] = task_id
+            await self._show_queue_position(task_id, self.active_downloads[user_id])
             
         except Exception as e:
             logger.error(f"❌ خطأ في بدء التنزيل: {e}")
@@ -135,196 +181,225 @@ class DownloadHandlers(BaseHandler):
             # تنظيف التنزيل الفاشل
             self.active_downloads.pop(user_id, None)
     
-    async def _download_website(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, download_id: int):
-        """تنزيل الموقع الفعلي"""
-        user_id = update.effective_user.id
+    async def _show_queue_position(self, task_id: str, download_info: Dict):
+        """عرض ترتيب المهمة إذا لم تكن ستبدأ فوراً"""
+        position = download_queue.get_queue_position(task_id)
+        free_slots = download_queue.max_concurrent - len(download_queue.running_tasks)
+        if not position or position['position'] <= free_slots:
+            return  # تبدأ الآن وتصل رسالة البدء من المستمع
+        
+        await self._edit_message(
+            download_info,
+            f"⏳ **في قائمة الانتظار**\n\n"
+            f"🌐 **الموقع:** {download_info['domain']}\n"
+            f"🔢 **ترتيبك:** {position['position']}\n"
+            f"⏰ **البدء المتوقع خلال:** {self._format_eta(position['eta'])}\n\n"
+            f"💡 سنُحدّث هذه الرسالة عند بدء التنزيل",
+            reply_markup=get_cancel_keyboard()
+        )
+    
+    @staticmethod
+    def _format_eta(seconds: float) -> str:
+        """تنسيق الوقت المتوقع بدقة دقيقة"""
+        if seconds < 60:
+            return "أقل من دقيقة"
+        return format_timedelta(timedelta(seconds=round(seconds / 60) * 60))
+    
+    async def _on_task_update(self, task: QueueTask):
+        """مستمع مهام التنزيل: تحديث الرسالة والسجل مع تغير حالة المهمة"""
+        download_info = self.active_downloads.get(task.user_id)
+        if download_info is None or download_info.get('task_id') != task.id:
+            # مهمة مستعادة بعد إعادة التشغيل: بياناتها محفوظة في سياقها
+            download_info = {
+                'task_id': task.id,
+                'url': task.url,
+                'domain': task.context.get('domain') or get_domain_from_url(task.url),
+                'download_id': task.context.get('download_id'),
+                'chat_id': task.context.get('chat_id', task.user_id),
+                'message_id': task.context.get('message_id'),
+                'start_time': task.created_at,
+                'status': 'pending'
+            }
+            if task.user_id not in self.active_downloads:
+                self.active_downloads[task.user_id] = download_info
+        
+        if task.status == TaskStatus.RUNNING:
+            await self._handle_running_download(task, download_info)
+            return
+        
+        if task.status == TaskStatus.PENDING:
+            return  # إعادة محاولة مجدولة؛ تبقى الرسالة كما هي
+        
+        if self.active_downloads.get(task.user_id) is download_info:
+            self.active_downloads.pop(task.user_id, None)
+        
+        if task.status == TaskStatus.COMPLETED:
+            await self._handle_successful_download(task, download_info)
+        elif task.status == TaskStatus.FAILED:
+            await self._handle_failed_download(download_info, task.error_message or "خطأ غير معروف")
+        elif task.status == TaskStatus.CANCELLED:
+            await self._handle_cancelled_download(download_info)
+    
+    async def _handle_running_download(self, task: QueueTask, download_info: Dict):
+        """تحديث رسالة التقدم (الناشر يدمج التحديثات المتقاربة)"""
+        if download_info['status'] != 'running':
+            download_info['status'] = 'running'
+            download_info['start_time'] = datetime.utcnow()
+            await self._update_download_record(download_info['download_id'], status='in_progress',
+                                         start_time=download_info['start_time'])
+        
+        await self._update_progress(download_info, f"⬇️ جاري التنزيل... {task.progress:.0f}%")
+    
+    async def _update_download_record(self, download_id: Optional[int], **fields):
+        """تحديث سجل التنزيل في قاعدة البيانات"""
+        if not download_id:
+            return
         
         try:
-            # تحديث الحالة
-            await self._update_progress(context, user_id, "🔍 جاري فحص الموقع...")
-            
-            # تنزيل الموقع
-            result = await self.downloader.download_website(
-                url=url,
-                output_dir=config.Config.DOWNLOADS_DIR,
-                progress_callback=lambda msg: asyncio.create_task(
-                    self._update_progress(context, user_id, msg)
-                )
-            )
-            
-            if result['success']:
-                # نجح التنزيل
-                await self._handle_successful_download(update, context, result, download_id)
-            else:
-                # فشل التنزيل
-                await self._handle_failed_download(update, context, result['error'], download_id)
-                
-        except asyncio.CancelledError:
-            # تم إلغاء التنزيل
-            await self._handle_cancelled_download(update, context, download_id)
+            await db_manager.update_download(download_id, **fields)
         except Exception as e:
-            logger.error(f"❌ خطأ في تنزيل الموقع: {e}")
-            await self._handle_failed_download(update, context, str(e), download_id)
-        finally:
-            # تنظيف التنزيل النشط
-            self.active_downloads.pop(user_id, None)
+            logger.error(f"❌ خطأ في تحديث سجل التنزيل {download_id}: {e}")
     
-    async def _update_progress(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, message: str):
+    async def _edit_message(self, download_info: Dict, text: str, reply_markup=None, final: bool = False):
+        """طلب تعديل رسالة التنزيل عبر ناشر التقدم (لا ينتظر الإرسال)"""
+        message_id = download_info.get('message_id')
+        if not message_id:
+            return
+        
+        progress_publisher.publish(download_info['chat_id'], message_id, text,
+                                   reply_markup=reply_markup, final=final)
+    
+    async def _update_progress(self, download_info: Dict, message: str):
         """تحديث رسالة التقدم"""
-        try:
-            if user_id in self.active_downloads:
-                download_info = self.active_downloads[user_id]
-                message_id = download_info.get('message_id')
-                
-                if message_id:
-                    elapsed_time = datetime.utcnow() - download_info['start_time']
-                    elapsed_str = f"{elapsed_time.seconds // 60}:{elapsed_time.seconds % 60:02d}"
-                    
-                    progress_text = f"🚀 **جاري تنزيل الموقع**\n\n"
-                    progress_text += f"🌐 **الموقع:** {download_info['domain']}\n"
-                    progress_text += f"📊 **الحالة:** {message}\n"
-                    progress_text += f"⏱️ **الوقت المنقضي:** {elapsed_str}\n\n"
-                    progress_text += f"⏳ يرجى الانتظار..."
-                    
-                    await context.bot.edit_message_text(
-                        chat_id=user_id,
-                        message_id=message_id,
-                        text=progress_text,
-                        parse_mode='Markdown',
-                        reply_markup=get_cancel_keyboard()
-                    )
-        except Exception as e:
-            logger.error(f"❌ خطأ في تحديث التقدم: {e}")
+        elapsed_time = datetime.utcnow() - download_info['start_time']
+        elapsed_str = f"{elapsed_time.seconds // 60}:{elapsed_time.seconds % 60:02d}"
+        
+        progress_text = f"🚀 **جاري تنزيل الموقع**\n\n"
+        progress_text += f"🌐 **الموقع:** {download_info['domain']}\n"
+        progress_text += f"📊 **الحالة:** {message}\n"
+        progress_text += f"⏱️ **الوقت المنقضي:** {elapsed_str}\n\n"
+        progress_text += f"⏳ يرجى الانتظار..."
+        
+        await self._edit_message(download_info, progress_text, reply_markup=get_cancel_keyboard())
+    
+    @staticmethod
+    def _archive_caption(domain: str) -> str:
+        """تعليق ملف الأرشيف المرسل"""
+        return (f"🎉 **موقع {domain} جاهز!**\n\n"
+                f"📱 يمكنك الآن فتح الملفات بدون إنترنت\n"
+                f"🔄 شكراً لاستخدام WebMaster Bot!")
     
-    async def _handle_successful_download(self, update: Update, context: ContextTypes.DEFAULT_TYPE, result: dict, download_id: int):
+    async def _handle_successful_download(self, task: QueueTask, download_info: Dict):
         """معالجة التنزيل الناجح"""
-        user_id = update.effective_user.id
+        result = task.result or {}
         
         try:
+            elapsed = (task.completed_at or datetime.utcnow()) - (task.started_at or task.created_at)
+            
             # تحديث قاعدة البيانات
-            db = next(get_db())
-            download_record = db.query(Download).filter(Download.id == download_id).first()
-            if download_record:
-                download_record.status = 'completed'
-                download_record.file_path = result['zip_path']
-                download_record.file_size = result['total_size']
-                download_record.completed_at = datetime.utcnow()
-                db.commit()
-            db.close()
+            await self._update_download_record(
+                download_info['download_id'],
+                status='completed',
+                file_path=result['zip_path'],
+                file_size=result['total_size'],
+                total_files=result['files_count'],
+                download_time=elapsed.total_seconds(),
+                end_time=datetime.utcnow()
+            )
             
             # إرسال الملف
             file_size = human_readable_size(result['total_size'])
+            duration = format_timedelta(elapsed)
             
             success_text = f"✅ **تم التنزيل بنجاح!**\n\n"
-            success_text += f"🌐 **الموقع:** {result['domain']}\n"
+            success_text += f"🌐 **الموقع:** {download_info['domain']}\n"
             success_text += f"📁 **عدد الملفات:** {result['files_count']}\n"
             success_text += f"💾 **حجم الملف:** {file_size}\n"
-            success_text += f"⏱️ **وقت التنزيل:** {result['duration']}\n\n"
-            success_text += f"📎 **جاري إرسال الملف...**"
+            success_text += f"⏱️ **وقت التنزيل:** {duration}\n"
+            if result.get('partial'):
+                success_text += f"⚠️ **أرشيف جزئي:** بلغ التنزيل حد الموارد المسموح\n"
+            
+            # الحجم يُفحص قبل الرفع: ما يتجاوز حد تيليجرام يُرسل على أجزاء
+            parts = archive_delivery.part_count(result['zip_path'])
+            if parts > 1:
+                success_text += f"\n📦 **الأرشيف أكبر من حد تيليجرام:** سيُرسل على {parts} أجزاء\n"
+                success_text += f"🧩 للتجميع: `cat {download_info['domain']}.zip.* > {download_info['domain']}.zip`\n"
+            success_text += f"\n📎 **جاري إرسال الملف...**"
             
             # تحديث الرسالة
-            message_id = self.active_downloads[user_id].get('message_id')
-            if message_id:
-                await context.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=message_id,
-                    text=success_text,
-                    parse_mode='Markdown'
-                )
+            await self._edit_message(download_info, success_text, final=True)
             
-            # إرسال الملف
-            with open(result['zip_path'], 'rb') as file:
-                await context.bot.send_document(
-                    chat_id=user_id,
-                    document=file,
-                    filename=f"{result['domain']}.zip",
-                    caption=f"🎉 **موقع {result['domain']} جاهز!**\n\n"
-                           f"📱 يمكنك الآن فتح الملفات بدون إنترنت\n"
-                           f"🔄 شكراً لاستخدام WebMaster Bot!",
-                    parse_mode='Markdown',
-                    reply_markup=get_main_keyboard()
-                )
+            # الأرشيف قد يكون مشتركاً بين طلبات مدمجة، لذا يحذفه التنظيف الدوري لا المرسل
+            await archive_delivery.deliver(
+                self.bot,
+                download_info['chat_id'],
+                result['zip_path'],
+                filename=f"{download_info['domain']}.zip",
+                caption=self._archive_caption(download_info['domain']),
+                reply_markup=get_main_keyboard(),
+                # الأرشيف الجزئي لا يمثل الموقع كاملاً فلا يُعاد استخدامه لطلبات الرابط
+                url_key=None if result.get('partial') else url_cache_key(task.url, task.context.get('options'))
+            )
             
-            # حذف الملف المؤقت
-            try:
-                os.remove(result['zip_path'])
-            except:
-                pass
-                
+        except DeliveryError as e:
+            # الأرشيف باقٍ والكاش يحتفظ بمساره لساعة، فإعادة الطلب خلالها لا تعيد الزحف
+            logger.error(f"❌ فشل تسليم الأرشيف {result.get('zip_path')}: {e}")
+            await self._edit_message(
+                download_info,
+                "✅ تم التنزيل بنجاح لكن تعذر رفع الملف لتيليجرام.\n"
+                "🔄 أرسل الرابط مرة أخرى خلال ساعة لإعادة الإرسال دون إعادة التنزيل.",
+                final=True
+            )
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة التنزيل الناجح: {e}")
-            await update.message.reply_text(
-                "✅ تم التنزيل بنجاح لكن حدث خطأ في الإرسال. يرجى المحاولة مرة أخرى."
+            await self._edit_message(
+                download_info,
+                "✅ تم التنزيل بنجاح لكن حدث خطأ في الإرسال. يرجى المحاولة مرة أخرى.",
+                final=True
             )
     
-    async def _handle_failed_download(self, update: Update, context: ContextTypes.DEFAULT_TYPE, error: str, download_id: int):
+    async def _handle_failed_download(self, download_info: Dict, error: str):
         """معالجة التنزيل الفاشل"""
-        user_id = update.effective_user.id
-        
         try:
             # تحديث قاعدة البيانات
-            db = next(get_db())
-            download_record = db.query(Download).filter(Download.id == download_id).first()
-            if download_record:
-                download_record.status = 'failed'
-                download_record.error_message = error
-                download_record.completed_at = datetime.utcnow()
-                db.commit()
-            db.close()
+            await self._update_download_record(
+                download_info['download_id'],
+                status='failed',
+                error_message=error,
+                end_time=datetime.utcnow()
+            )
             
             # رسالة الفشل
             error_text = f"❌ **فشل في التنزيل**\n\n"
-            error_text += f"🌐 **الموقع:** {self.active_downloads[user_id]['domain']}\n"
+            error_text += f"🌐 **الموقع:** {download_info['domain']}\n"
             error_text += f"⚠️ **السبب:** {error}\n\n"
             error_text += f"💡 **اقتراحات:**\n"
             error_text += f"• تأكد من صحة الرابط\n"
             error_text += f"• جرب مرة أخرى لاحقاً\n"
             error_text += f"• تواصل مع المشرف إذا استمرت المشكلة"
             
-            # تحديث الرسالة
-            message_id = self.active_downloads[user_id].get('message_id')
-            if message_id:
-                await context.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=message_id,
-                    text=error_text,
-                    parse_mode='Markdown',
-                    reply_markup=get_main_keyboard()
-                )
+            await self._edit_message(download_info, error_text, final=True)
                 
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة التنزيل الفاشل: {e}")
     
-    async def _handle_cancelled_download(self, update: Update, context: ContextTypes.DEFAULT_TYPE, download_id: int):
+    async def _handle_cancelled_download(self, download_info: Dict):
         """معالجة التنزيل المُلغى"""
-        user_id = update.effective_user.id
-        
         try:
             # تحديث قاعدة البيانات
-            db = next(get_db())
-            download_record = db.query(Download).filter(Download.id == download_id).first()
-            if download_record:
-                download_record.status = 'cancelled'
-                download_record.completed_at = datetime.utcnow()
-                db.commit()
-            db.close()
+            await self._update_download_record(
+                download_info['download_id'],
+                status='cancelled',
+                end_time=datetime.utcnow()
+            )
             
             # رسالة الإلغاء
             cancel_text = f"🚫 **تم إلغاء التنزيل**\n\n"
-            cancel_text += f"🌐 **الموقع:** {self.active_downloads[user_id]['domain']}\n"
+            cancel_text += f"🌐 **الموقع:** {download_info['domain']}\n"
             cancel_text += f"⏰ **تم الإلغاء في:** {datetime.now().strftime('%H:%M:%S')}\n\n"
             cancel_text += f"💡 يمكنك بدء تنزيل جديد في أي وقت"
             
-            # تحديث الرسالة
-            message_id = self.active_downloads[user_id].get('message_id')
-            if message_id:
-                await context.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=message_id,
-                    text=cancel_text,
-                    parse_mode='Markdown',
-                    reply_markup=get_main_keyboard()
-                )
+            await self._edit_message(download_info, cancel_text, final=True)
                 
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة التنزيل المُلغى: {e}")
@@ -342,12 +417,16 @@ class DownloadHandlers(BaseHandler):
             return
         
         try:
-            # إلغاء التنزيل
-            download_info = self.active_downloads[user_id]
-            download_id = download_info['download_id']
+            # إلغاء المهمة في القائمة (منتظرة أو قيد التنفيذ)
+            download_info = self.active_downloads.pop(user_id)
+            task_id = download_info.get('task_id')
+            if task_id:
+                task = await download_queue.get_task_status(task_id)
+                if task:
+                    task.listener = None  # رسالة الإلغاء تُرسل من هنا وليس من المستمع
+                await download_queue.cancel_task(task_id, user_id)
             
-            # إشارة الإلغاء (سيتم التعامل معها في _download_website)
-            await self._handle_cancelled_download(update, context, download_id)
+            await self._handle_cancelled_download(download_info)
             
             await update.message.reply_text(
                 "✅ **تم إلغاء التنزيل بنجاح**\n\n"
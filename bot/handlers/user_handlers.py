@@ -10,6 +10,7 @@ from datetime import datetime
 from .base_handler import BaseHandler
 from utils.helpers import is_valid_url
 from bot.keyboards import get_main_keyboard
+from services.database_manager import db_manager
 from utils.logger import logger
 
 class UserHandlers(BaseHandler):
@@ -134,30 +135,11 @@ class UserHandlers(BaseHandler):
             user_id = update.effective_user.id
             
             # جلب الإحصائيات من قاعدة البيانات
-            from database import get_db, Download
-            from sqlalchemy import func
-            
-            db = next(get_db())
-            
-            # إحصائيات التنزيلات
-            total_downloads = db.query(Download).filter(Download.user_id == user_id).count()
-            successful_downloads = db.query(Download).filter(
-                Download.user_id == user_id, 
-                Download.status == 'completed'
-            ).count()
-            
-            # حجم البيانات المحملة
-            total_size = db.query(func.sum(Download.file_size)).filter(
-                Download.user_id == user_id,
-                Download.status == 'completed'
-            ).scalar() or 0
-            
-            # آخر تنزيل
-            last_download = db.query(Download).filter(
-                Download.user_id == user_id
-            ).order_by(Download.created_at.desc()).first()
-            
-            db.close()
+            summary = await db_manager.get_user_summary(user_id)
+            total_downloads = summary['total']
+            successful_downloads = summary['successful']
+            total_size = summary['total_size']
+            last_download_at = summary['last_download_at']
             
             # تنسيق الحجم
             from utils.helpers import human_readable_size
@@ -173,7 +155,7 @@ class UserHandlers(BaseHandler):
 📈 **معدل النجاح:** {success_rate:.1f}%
 💾 **إجمالي البيانات:** {formatted_size}
 
-📅 **آخر تنزيل:** {last_download.created_at.strftime('%Y-%m-%d %H:%M') if last_download else 'لا يوجد'}
+📅 **آخر تنزيل:** {last_download_at.strftime('%Y-%m-%d %H:%M') if last_download_at else 'لا يوجد'}
 
 🏆 **مستوى النشاط:** {'🥇 نشط جداً' if total_downloads > 50 else '🥈 نشط' if total_downloads > 10 else '🥉 مبتدئ'}
 
@@ -192,15 +174,8 @@ class UserHandlers(BaseHandler):
         try:
             user_id = update.effective_user.id
             
-            from database import get_db, Download
-            db = next(get_db())
-            
             # جلب آخر 10 تنزيلات
-            downloads = db.query(Download).filter(
-                Download.user_id == user_id
-            ).order_by(Download.created_at.desc()).limit(10).all()
-            
-            db.close()
+            downloads = await db_manager.get_user_downloads(user_id, limit=10)
             
             if not downloads:
                 await update.message.reply_text(
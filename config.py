@@ -18,9 +18,15 @@ class Config:
     PAGE_LOAD_TIMEOUT = int(os.getenv("PAGE_LOAD_TIMEOUT", 60000))  # 60 ثانية
     NETWORK_IDLE_TIMEOUT = int(os.getenv("NETWORK_IDLE_TIMEOUT", 15000))  # 15 ثانية
     
+    # حصص الموارد لكل مهمة تنزيل
+    QUOTA_MAX_PAGES = int(os.getenv("QUOTA_MAX_PAGES", 11))  # الصفحة الرئيسية + 10 صفحات
+    QUOTA_MAX_ASSETS_PER_PAGE = int(os.getenv("QUOTA_MAX_ASSETS_PER_PAGE", 100))
+    
     # إعدادات الذاكرة والأداء
     MAX_MEMORY_USAGE = int(os.getenv("MAX_MEMORY_USAGE", 512))  # MB بدلاً من نسبة مئوية
     MAX_CONTEXTS_POOL = int(os.getenv("MAX_CONTEXTS_POOL", 3))  # عدد السياقات في المجموعة
+    MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", 1536))  # ذاكرة البوت + Chromium
+    MEMORY_SAMPLE_INTERVAL = float(os.getenv("MEMORY_SAMPLE_INTERVAL", 2.0))  # ثواني بين العينات
     
     # إعدادات الأمان والحدود
     RATE_LIMIT_PER_HOUR = int(os.getenv("RATE_LIMIT_PER_HOUR", 10))
@@ -52,6 +58,84 @@ class Config:
     # إعدادات قوائل الانتظار
     QUEUE_MAX_RETRIES = int(os.getenv("QUEUE_MAX_RETRIES", 3))
     QUEUE_RETRY_DELAY = int(os.getenv("QUEUE_RETRY_DELAY", 5))  # ثواني
+    PREMIUM_USER_WEIGHT = float(os.getenv("PREMIUM_USER_WEIGHT", 3.0))  # حصة المستخدم المميز مقابل العادي
+    QUEUE_PERSISTENCE = os.getenv("QUEUE_PERSISTENCE", "true").lower() == "true"
+    QUEUE_DB_PATH = os.getenv("QUEUE_DB_PATH", os.path.join(DATA_DIR, "queue.db"))
+    QUEUE_FLUSH_INTERVAL = float(os.getenv("QUEUE_FLUSH_INTERVAL", 0.1))  # ثواني بين دفعات الكتابة
+    QUEUE_LEASE_TIMEOUT = float(os.getenv("QUEUE_LEASE_TIMEOUT", 60))  # مهلة عقد المهمة قيد التنفيذ
+    QUEUE_STORE_RETENTION_DAYS = int(os.getenv("QUEUE_STORE_RETENTION_DAYS", 7))
+    STATS_DAILY_RETENTION_DAYS = int(os.getenv("STATS_DAILY_RETENTION_DAYS", 90))  # حاويات العدادات اليومية
+    QUEUE_HISTORY_SIZE = int(os.getenv("QUEUE_HISTORY_SIZE", 1000))  # المهام المنتهية في الذاكرة
+    QUEUE_HISTORY_MAX_AGE = int(os.getenv("QUEUE_HISTORY_MAX_AGE", 86400))  # ثواني
+    TASK_DEADLINE_GRACE = float(os.getenv("TASK_DEADLINE_GRACE", 30))  # هامش إنشاء الأرشيف الجزئي قبل الإلغاء القسري
+    QUEUE_LOOKAHEAD = int(os.getenv("QUEUE_LOOKAHEAD", 4))  # نافذة اختيار المهمة الأقصر تقديراً
+    QUEUE_MAX_PENDING = int(os.getenv("QUEUE_MAX_PENDING", 200))  # رفض المهام الجديدة بعد هذا الحد
+    
+    # رسائل التقدم (حدود تعديل الرسائل في تيليجرام)
+    PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", 3.0))  # ثواني بين تعديلات الرسالة الواحدة
+    PROGRESS_FINAL_MIN_INTERVAL = float(os.getenv("PROGRESS_FINAL_MIN_INTERVAL", 1.0))  # للحالات النهائية
+    PROGRESS_GLOBAL_RATE = float(os.getenv("PROGRESS_GLOBAL_RATE", 20))  # تعديلات في الثانية لكل البوت
+    PROGRESS_MAX_PENDING = int(os.getenv("PROGRESS_MAX_PENDING", 5000))  # رسائل معلقة قبل إسقاط الحالات الوسيطة
+    
+    # محدد معدل الطلبات الصادرة لتيليجرام
+    TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))  # طلبات في الثانية لكل البوت
+    TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))  # رسائل في الثانية للمحادثة الخاصة
+    TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", 20 / 60))  # 20 رسالة في الدقيقة للمجموعة
+    TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))  # دفعة مسموحة في المحادثة الخاصة
+    TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))  # إعادة الطلب بعد RetryAfter
+    
+    # خادم Bot API محلي (telegram-bot-api --local): الملفات تُرسل بمسارها دون رفع
+    TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")  # مثال: http://localhost:8081
+    TELEGRAM_LOCAL_MODE = os.getenv("TELEGRAM_LOCAL_MODE", "true" if TELEGRAM_API_URL else "false").lower() == "true"
+    
+    # تسليم الأرشيفات (حد رفع Bot API العام 50MB، والخادم المحلي 2000MB)
+    TELEGRAM_UPLOAD_LIMIT = int(os.getenv(
+        "TELEGRAM_UPLOAD_LIMIT", (2000 if TELEGRAM_LOCAL_MODE else 50) * 1024 * 1024
+    ))
+    DELIVERY_PART_SIZE = int(os.getenv("DELIVERY_PART_SIZE", 48 * 1024 * 1024))  # حجم الجزء عند التقسيم
+    DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", 2))  # أجزاء تُرفع بالتوازي
+    DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", 3))  # محاولات لكل جزء
+    DELIVERY_UPLOAD_TIMEOUT = float(os.getenv("DELIVERY_UPLOAD_TIMEOUT", 300))  # ثواني لرفع جزء
+    
+    FILE_ID_DB_PATH = os.getenv("FILE_ID_DB_PATH", os.path.join(DATA_DIR, "file_ids.db"))
+    FILE_ID_URL_TTL = float(os.getenv("FILE_ID_URL_TTL", 86400))  # صلاحية إعادة استخدام أرشيف الرابط (ثواني)
+    
+    # الرسائل الجماعية
+    BROADCAST_DB_PATH = os.getenv("BROADCAST_DB_PATH", os.path.join(DATA_DIR, "broadcast.db"))
+    BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 50))  # مستلمون لكل دفعة محفوظة
+    BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 30))  # إرسالات متزامنة (المحدد يضبط المعدل)
+    BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))  # محاولات بلا تقدم قبل تعليمها فاشلة
+    
+    # التحجيم التلقائي لحد التزامن (AIMD)
+    AUTOSCALE_ENABLED = os.getenv("AUTOSCALE_ENABLED", "true").lower() == "true"
+    AUTOSCALE_MIN_CONCURRENT = int(os.getenv("AUTOSCALE_MIN_CONCURRENT", 1))
+    AUTOSCALE_MAX_CONCURRENT = int(os.getenv("AUTOSCALE_MAX_CONCURRENT", 8))
+    AUTOSCALE_INTERVAL = float(os.getenv("AUTOSCALE_INTERVAL", 5.0))  # ثواني بين القرارات
+    AUTOSCALE_LOOP_LAG_THRESHOLD = float(os.getenv("AUTOSCALE_LOOP_LAG_THRESHOLD", 0.25))  # ثواني
+    AUTOSCALE_CPU_THRESHOLD = float(os.getenv("AUTOSCALE_CPU_THRESHOLD", 90))  # نسبة مئوية
+    AUTOSCALE_LATENCY_TARGET = float(os.getenv("AUTOSCALE_LATENCY_TARGET", 20))  # p95 لعرض الصفحة بالثواني
+    AUTOSCALE_ERROR_RATE_THRESHOLD = float(os.getenv("AUTOSCALE_ERROR_RATE_THRESHOLD", 0.3))
+    
+    # استقبال التحديثات
+    UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")  # polling | webhook
+    UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))  # تحديثات تُعالج بالتوازي (محادثات مختلفة)
+    SLOW_HANDLER_THRESHOLD = float(os.getenv("SLOW_HANDLER_THRESHOLD", 1.0))  # ثواني قبل تسجيل المعالج كبطيء
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # العنوان العام (https://...) الذي يسجل لدى تيليجرام
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # مطلوب في وضع webhook؛ يُقارن بترويسة X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))  # اتصالات تيليجرام المتزامنة
+    WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "false").lower() == "true"  # نسخة واحدة فقط تسجل العنوان
+    
+    # إعدادات التشغيل الموزع (واجهة البوت + عمال الزحف)
+    RUN_MODE = os.getenv("RUN_MODE", "bot")  # bot | worker
+    QUEUE_EXECUTION = os.getenv("QUEUE_EXECUTION", "local")  # local | broker
+    BROKER_URL = os.getenv("BROKER_URL", f"sqlite:///{os.path.join(DATA_DIR, 'broker.db')}")
+    BROKER_LEASE_TIMEOUT = float(os.getenv("BROKER_LEASE_TIMEOUT", 60))
+    BROKER_POLL_INTERVAL = float(os.getenv("BROKER_POLL_INTERVAL", 1.0))  # ثواني
+    BROKER_MAX_INFLIGHT = int(os.getenv("BROKER_MAX_INFLIGHT", 20))  # مهام الواجهة لدى العمال
+    WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 1))  # متصفح لكل خانة
     
     # إعدادات المراقبة
     ENABLE_METRICS = os.getenv("ENABLE_METRICS", "true").lower() == "true"
@@ -74,6 +158,8 @@ class Config:
             raise ValueError("❌ BOT_TOKEN غير محدد في ملف .env")
         if not cls.ADMIN_ID:
             raise ValueError("❌ ADMIN_ID غير محدد في ملف .env")
+        if cls.UPDATE_MODE == "webhook" and not cls.WEBHOOK_SECRET:
+            raise ValueError("❌ WEBHOOK_SECRET مطلوب عند UPDATE_MODE=webhook")
         
         cls.create_directories()
         return True
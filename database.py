@@ -1,6 +1,5 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Float, JSON
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, case, column, func, inspect, literal, select, table, Column, Date, Index, Integer, MetaData, String, Table, Text, DateTime, Boolean, Float, JSON
+from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime
 import config
 
@@ -8,9 +7,12 @@ Base = declarative_base()
 engine = create_engine(config.Config.DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# النموذج الوحيد لقاعدة البيانات: المعالجات (عبر DatabaseManager) والخدمات المتزامنة
+# تستخدم نفس الجداول، وأي تغيير فيها يُضاف كترحيل في MIGRATIONS أدناه
+
 class User(Base):
     __tablename__ = "users"
-    
+
     id = Column(Integer, primary_key=True)
     telegram_id = Column(Integer, unique=True, nullable=False)
     username = Column(String)
@@ -21,27 +23,424 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     last_activity = Column(DateTime, default=datetime.utcnow)
     total_downloads = Column(Integer, default=0)
+    successful_downloads = Column(Integer, default=0)
+    failed_downloads = Column(Integer, default=0)
     total_size = Column(Float, default=0.0)
     is_banned = Column(Boolean, default=False)
+    ban_reason = Column(Text)
+    warnings_count = Column(Integer, default=0)
+    settings = Column(JSON, default=dict)
+
+    __table_args__ = (
+        Index('ix_users_created_at', 'created_at'),
+    )
 
 class Download(Base):
     __tablename__ = "downloads"
-    
+
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     url = Column(String, nullable=False)
     domain = Column(String)
-    status = Column(String, default="pending")  # pending, processing, completed, failed
+    status = Column(String, default="pending")  # pending, in_progress, completed, failed, cancelled
     file_path = Column(String)
     file_size = Column(Float)
     total_files = Column(Integer)
+    download_time = Column(Float, default=0.0)  # ثواني الزحف من البدء حتى الاكتمال
     start_time = Column(DateTime)
     end_time = Column(DateTime)
     error_message = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # الاسم metadata محجوز في Declarative؛ العمود يحتفظ باسمه في الجدول
+    meta = Column('metadata', JSON, default=dict)
+
+    __table_args__ = (
+        Index('ix_downloads_created_at', 'created_at'),
+        Index('ix_downloads_status', 'status'),
+        # /history: آخر تنزيلات المستخدم مرتبة دون فرز
+        Index('ix_downloads_user_created', 'user_id', 'created_at'),
+        # /stats: فهرس يغطي الاستعلام التجميعي كاملاً فلا تُقرأ صفوف الجدول
+        Index('ix_downloads_user_status', 'user_id', 'status', 'file_size', 'created_at'),
+    )
+
+class SystemLog(Base):
+    """جدول سجلات النظام"""
+    __tablename__ = 'system_logs'
+
+    id = Column(Integer, primary_key=True)
+    level = Column(String(20), nullable=False)  # INFO, WARNING, ERROR, CRITICAL
+    message = Column(Text, nullable=False)
+    module = Column(String(100))
+    user_id = Column(Integer)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    meta = Column('metadata', JSON, default=dict)
+
+    __table_args__ = (
+        Index('ix_system_logs_timestamp', 'timestamp'),
+    )
+
+class SecurityEvent(Base):
+    """جدول الأحداث الأمنية"""
+    __tablename__ = 'security_events'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    event_type = Column(String(100), nullable=False)
+    severity = Column(String(20), nullable=False)  # low, medium, high, critical
+    description = Column(Text, nullable=False)
+    ip_address = Column(String(45))
+    user_agent = Column(Text)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    meta = Column('metadata', JSON, default=dict)
+
+    __table_args__ = (
+        Index('ix_security_events_timestamp', 'timestamp'),
+    )
+
+class CacheEntry(Base):
+    """جدول الكاش"""
+    __tablename__ = 'cache_entries'
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(255), unique=True, nullable=False)
+    value = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    access_count = Column(Integer, default=0)
+    last_accessed = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_cache_entries_expires_at', 'expires_at'),
+    )
+
+# === العدادات المجمعة ===
+# تُحدَّث في نفس معاملة الكتابة على users/downloads (DatabaseManager)، فتقرأ لوحات
+# المشرف بضعة صفوف بدلاً من COUNT(*) وGROUP BY على الجداول كاملة
+
+class GlobalStats(Base):
+    """صف واحد بإجماليات البوت"""
+    __tablename__ = 'global_stats'
+
+    id = Column(Integer, primary_key=True)
+    users = Column(Integer, nullable=False, default=0)
+    downloads = Column(Integer, nullable=False, default=0)
+    completed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    cancelled = Column(Integer, nullable=False, default=0)
+    total_size = Column(Float, nullable=False, default=0.0)
+
+class DailyStats(Base):
+    """إجماليات كل يوم (UTC): التنزيلات بيوم إنشائها والنتائج بيوم اكتمالها"""
+    __tablename__ = 'daily_stats'
+
+    day = Column(Date, primary_key=True)
+    new_users = Column(Integer, nullable=False, default=0)
+    downloads = Column(Integer, nullable=False, default=0)
+    completed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    cancelled = Column(Integer, nullable=False, default=0)
+    total_size = Column(Float, nullable=False, default=0.0)
+
+class DomainStats(Base):
+    """عدد التنزيلات لكل نطاق"""
+    __tablename__ = 'domain_stats'
+
+    domain = Column(String, primary_key=True)
+    downloads = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # أكثر النطاقات تنزيلاً: قراءة أول N من الفهرس
+        Index('ix_domain_stats_downloads', 'downloads'),
+    )
+
+# حالات التنزيل النهائية وعمود كل منها في العدادات
+TERMINAL_STATUSES = {'completed': 'completed', 'failed': 'failed', 'cancelled': 'cancelled'}
+
+class SchemaVersion(Base):
+    """الترحيلات المطبقة على قاعدة البيانات"""
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+# === الترحيلات ===
+# كل ترحيل دالة تستقبل اتصالاً داخل معاملة، وتُطبق مرة واحدة بالترتيب.
+# تعريفات كل ترحيل مجمدة بداخله (جداول Core وفهارس بأسمائها) ولا تقرأ النماذج أعلاه:
+# تعديل نموذج لاحقاً لا يغير ما يفعله ترحيل قديم، بل يُضاف له ترحيل جديد.
+# الترحيلات آمنة للتكرار: قاعدة قديمة قد تكون أنشأها أي من النموذجين السابقين.
+
+def _add_missing_columns(connection, table_name, columns):
+    """إضافة الأعمدة الناقصة من جدول موجود"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    for column in columns:
+        if column.name in existing:
+            continue
+        ddl = f'ALTER TABLE {table_name} ADD COLUMN "{column.name}" {column.type.compile(dialect=connection.dialect)}'
+        default = column.default
+        if default is not None and default.is_scalar:
+            # الصفوف الموجودة تأخذ القيمة الافتراضية بدلاً من NULL (العدادات خاصة)
+            value = literal(default.arg).compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+            ddl += f" DEFAULT {value}"
+        connection.exec_driver_sql(ddl)
+
+def _create_index(connection, name, table_name, *columns):
+    """إنشاء فهرس إن لم يوجد"""
+    connection.exec_driver_sql(
+        f"CREATE INDEX IF NOT EXISTS {name} ON {table_name} ({', '.join(columns)})"
+    )
+
+def _migration_baseline(connection):
+    """جداول ما قبل الترحيلات كما أنشأها database.py وdatabase_manager (إن لم توجد)"""
+    metadata = MetaData()
+    Table(
+        'users', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('telegram_id', Integer, unique=True, nullable=False),
+        Column('username', String),
+        Column('first_name', String),
+        Column('last_name', String),
+        Column('language_code', String),
+        Column('is_premium', Boolean),
+        Column('created_at', DateTime),
+        Column('last_activity', DateTime),
+        Column('total_downloads', Integer),
+        Column('total_size', Float),
+        Column('is_banned', Boolean),
+    )
+    Table(
+        'downloads', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer, nullable=False),
+        Column('url', String, nullable=False),
+        Column('domain', String),
+        Column('status', String),
+        Column('file_path', String),
+        Column('file_size', Float),
+        Column('total_files', Integer),
+        Column('start_time', DateTime),
+        Column('end_time', DateTime),
+        Column('error_message', String),
+        Column('created_at', DateTime),
+    )
+    Table(
+        'system_logs', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('level', String(20), nullable=False),
+        Column('message', Text, nullable=False),
+        Column('module', String(100)),
+        Column('user_id', Integer),
+        Column('timestamp', DateTime),
+        Column('metadata', JSON),
+    )
+    Table(
+        'security_events', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer, nullable=False),
+        Column('event_type', String(100), nullable=False),
+        Column('severity', String(20), nullable=False),
+        Column('description', Text, nullable=False),
+        Column('ip_address', String(45)),
+        Column('user_agent', Text),
+        Column('timestamp', DateTime),
+        Column('metadata', JSON),
+    )
+    Table(
+        'cache_entries', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('key', String(255), unique=True, nullable=False),
+        Column('value', Text, nullable=False),
+        Column('expires_at', DateTime, nullable=False),
+        Column('created_at', DateTime),
+        Column('access_count', Integer),
+        Column('last_accessed', DateTime),
+    )
+    metadata.create_all(connection)
+
+def _migration_unify_schemas(connection):
+    """دمج مخططي database.py وdatabase_manager في جدولي users وdownloads"""
+    _add_missing_columns(connection, 'users', [
+        Column('username', String),
+        Column('first_name', String),
+        Column('last_name', String),
+        Column('language_code', String),
+        Column('is_premium', Boolean, default=False),
+        Column('created_at', DateTime),
+        Column('last_activity', DateTime),
+        Column('total_downloads', Integer, default=0),
+        Column('successful_downloads', Integer, default=0),
+        Column('failed_downloads', Integer, default=0),
+        Column('total_size', Float, default=0.0),
+        Column('is_banned', Boolean, default=False),
+        Column('ban_reason', Text),
+        Column('warnings_count', Integer, default=0),
+        Column('settings', JSON),
+    ])
+    _add_missing_columns(connection, 'downloads', [
+        Column('domain', String),
+        Column('status', String, default='pending'),
+        Column('file_path', String),
+        Column('file_size', Float),
+        Column('total_files', Integer),
+        Column('download_time', Float, default=0.0),
+        Column('start_time', DateTime),
+        Column('end_time', DateTime),
+        Column('error_message', String),
+        Column('created_at', DateTime),
+        Column('metadata', JSON),
+    ])
+
+    # مخطط database_manager كان يسجل أوقات التنزيل في started_at/completed_at
+    columns = {column['name'] for column in inspect(connection).get_columns('downloads')}
+    if 'started_at' in columns:
+        connection.exec_driver_sql(
+            "UPDATE downloads SET start_time = started_at WHERE start_time IS NULL"
+        )
+    if 'completed_at' in columns:
+        connection.exec_driver_sql(
+            "UPDATE downloads SET end_time = completed_at WHERE end_time IS NULL"
+        )
+
+def _migration_hot_query_indexes(connection):
+    """فهارس استعلامات لوحات الإحصائيات والتنظيف الدوري"""
+    _create_index(connection, 'ix_users_created_at', 'users', 'created_at')
+    _create_index(connection, 'ix_downloads_created_at', 'downloads', 'created_at')
+    _create_index(connection, 'ix_downloads_status', 'downloads', 'status')
+    _create_index(connection, 'ix_system_logs_timestamp', 'system_logs', 'timestamp')
+    _create_index(connection, 'ix_security_events_timestamp', 'security_events', 'timestamp')
+    _create_index(connection, 'ix_cache_entries_expires_at', 'cache_entries', 'expires_at')
+
+def _migration_user_indexes(connection):
+    """فهارس مركبة لاستعلامات المستخدم (/stats و/history)"""
+    _create_index(connection, 'ix_downloads_user_created', 'downloads', 'user_id', 'created_at')
+    _create_index(connection, 'ix_downloads_user_status', 'downloads', 'user_id', 'status', 'file_size', 'created_at')
+
+def _migration_materialized_counters(connection):
+    """جداول العدادات المجمعة وتعبئتها من البيانات الموجودة"""
+    metadata = MetaData()
+    global_stats = Table(
+        'global_stats', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('users', Integer, nullable=False, default=0),
+        Column('downloads', Integer, nullable=False, default=0),
+        Column('completed', Integer, nullable=False, default=0),
+        Column('failed', Integer, nullable=False, default=0),
+        Column('cancelled', Integer, nullable=False, default=0),
+        Column('total_size', Float, nullable=False, default=0.0),
+    )
+    daily_stats = Table(
+        'daily_stats', metadata,
+        Column('day', Date, primary_key=True),
+        Column('new_users', Integer, nullable=False, default=0),
+        Column('downloads', Integer, nullable=False, default=0),
+        Column('completed', Integer, nullable=False, default=0),
+        Column('failed', Integer, nullable=False, default=0),
+        Column('cancelled', Integer, nullable=False, default=0),
+        Column('total_size', Float, nullable=False, default=0.0),
+    )
+    domain_stats = Table(
+        'domain_stats', metadata,
+        Column('domain', String, primary_key=True),
+        Column('downloads', Integer, nullable=False, default=0),
+    )
+    metadata.create_all(connection)
+    _create_index(connection, 'ix_domain_stats_downloads', 'domain_stats', 'downloads')
+
+    users = table('users', column('telegram_id'), column('created_at'), column('total_downloads'),
+                  column('successful_downloads'), column('failed_downloads'), column('total_size'))
+    downloads = table('downloads', column('user_id'), column('domain'), column('status'),
+                      column('file_size'), column('created_at'), column('end_time'))
+    completed = downloads.c.status == 'completed'
+
+    def status_sums():
+        return [func.coalesce(func.sum(case((downloads.c.status == status, 1), else_=0)), 0)
+                for status in ('completed', 'failed', 'cancelled')] + [
+            func.coalesce(func.sum(case((completed, downloads.c.file_size), else_=0)), 0.0)
+        ]
+
+    # الإجماليات
+    user_count = connection.scalar(select(func.count()).select_from(users))
+    download_count = connection.scalar(select(func.count()).select_from(downloads))
+    finished, failed, cancelled, total_size = connection.execute(select(*status_sums())).one()
+    connection.execute(global_stats.delete())
+    connection.execute(global_stats.insert().values(
+        id=1, users=user_count, downloads=download_count, completed=finished,
+        failed=failed, cancelled=cancelled, total_size=total_size
+    ))
+
+    # الأيام: التنزيلات والمستخدمون بيوم الإنشاء، النتائج بيوم الانتهاء إن وُجد
+    days = {}
+
+    def bucket(day):
+        return days.setdefault(str(day), {'new_users': 0, 'downloads': 0, 'completed': 0,
+                                          'failed': 0, 'cancelled': 0, 'total_size': 0.0})
+
+    for day, count in connection.execute(
+        select(func.date(users.c.created_at), func.count()).where(users.c.created_at.isnot(None))
+        .group_by(func.date(users.c.created_at))
+    ):
+        bucket(day)['new_users'] = count
+    for day, count in connection.execute(
+        select(func.date(downloads.c.created_at), func.count()).where(downloads.c.created_at.isnot(None))
+        .group_by(func.date(downloads.c.created_at))
+    ):
+        bucket(day)['downloads'] = count
+    finished_day = func.date(func.coalesce(downloads.c.end_time, downloads.c.created_at))
+    for day, finished, failed, cancelled, total_size in connection.execute(
+        select(finished_day, *status_sums()).where(finished_day.isnot(None)).group_by(finished_day)
+    ):
+        bucket(day).update(completed=finished, failed=failed, cancelled=cancelled, total_size=total_size)
+
+    connection.execute(daily_stats.delete())
+    if days:
+        connection.execute(daily_stats.insert(), [
+            {'day': datetime.strptime(day, '%Y-%m-%d').date(), **values} for day, values in days.items()
+        ])
+
+    # النطاقات
+    connection.execute(domain_stats.delete())
+    connection.execute(domain_stats.insert().from_select(
+        ['domain', 'downloads'],
+        select(downloads.c.domain, func.count()).where(downloads.c.domain.isnot(None))
+        .group_by(downloads.c.domain)
+    ))
+
+    # عدادات كل مستخدم التي لم يكن شيء يحدثها
+    mine = downloads.c.user_id == users.c.telegram_id
+    connection.execute(users.update().values(
+        total_downloads=select(func.count()).where(mine).scalar_subquery(),
+        successful_downloads=select(func.count()).where(mine, completed).scalar_subquery(),
+        failed_downloads=select(func.count()).where(mine, downloads.c.status == 'failed').scalar_subquery(),
+        total_size=select(func.coalesce(func.sum(downloads.c.file_size), 0.0))
+        .where(mine, completed).scalar_subquery()
+    ))
+
+MIGRATIONS = [
+    (1, "baseline", _migration_baseline),
+    (2, "unify users/downloads schemas", _migration_unify_schemas),
+    (3, "hot query indexes", _migration_hot_query_indexes),
+    (4, "per-user composite indexes", _migration_user_indexes),
+    (5, "materialized counters", _migration_materialized_counters),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate(connection) -> int:
+    """تطبيق الترحيلات الناقصة داخل معاملة الاتصال؛ يعيد رقم الإصدار الحالي"""
+    SchemaVersion.__table__.create(connection, checkfirst=True)
+    applied = set(connection.scalars(select(SchemaVersion.version)))
+    for version, description, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        apply(connection)
+        connection.execute(SchemaVersion.__table__.insert().values(
+            version=version, description=description, applied_at=datetime.utcnow()
+        ))
+    return SCHEMA_VERSION
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+# تطبيق الترحيلات
+with engine.begin() as _connection:
+    migrate(_connection)
 
 def get_db():
     db = SessionLocal()
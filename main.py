@@ -26,24 +26,57 @@ from services.monitoring import metrics_collector
 from services.database_manager import db_manager
 from services.cache_manager import cache_manager
 from services.security_manager import security_manager
+from services.memory_governor import memory_governor
+from services.autoscaler import autoscaler
+from services.progress_publisher import progress_publisher
+from services.rate_limiter import outbound_limiter
+from services.broadcast import broadcast_engine
+from services.delivery import archive_delivery
+from services.webhook import webhook_server
+from services.update_processor import ChatOrderedUpdateProcessor, timed_handler
+from services.broker import create_broker
+from services.worker import CrawlWorker, DOWNLOAD_HANDLER, make_local_handler, make_remote_handler
 import config
 
 # إعداد نظام التسجيل المحسن
 logger = setup_logger("webmaster_bot", getattr(logging, config.Config.LOG_LEVEL, logging.INFO))
 
-async def shutdown_handler(application, bot_handlers):
+async def shutdown_handler(application, bot_handlers, broker=None):
     """معالج إيقاف البوت بشكل آمن مع تنظيف شامل"""
     logger.info("🔄 جاري إيقاف البوت بشكل آمن...")
     
     try:
+        # إيقاف استقبال التحديثات الجديدة أولاً
+        await webhook_server.stop()
+        
+        # إيقاف التحجيم التلقائي
+        await autoscaler.stop()
+        
         # إيقاف قوائل الانتظار
         await download_queue.stop()
         logger.info("✅ تم إيقاف قوائل الانتظار")
         
+        # إيقاف الرسائل الجماعية (تُستأنف بعد إعادة التشغيل)
+        await broadcast_engine.stop()
+        
+        # إرسال رسائل الحالة النهائية المتبقية
+        await progress_publisher.stop()
+        
+        # إغلاق مخزن معرفات الملفات المرسلة
+        await archive_delivery.stop()
+        
+        # إغلاق وسيط المهام
+        if broker:
+            await broker.stop()
+        
         # إيقاف نظام المراقبة
         await metrics_collector.stop()
         logger.info("✅ تم إيقاف نظام المراقبة")
         
+        # إيقاف منظم الذاكرة
+        await memory_governor.stop()
+        logger.info("✅ تم إيقاف منظم الذاكرة")
+        
         # إغلاق قاعدة البيانات
         await db_manager.close()
         logger.info("✅ تم إغلاق قاعدة البيانات")
@@ -72,10 +105,37 @@ async def shutdown_handler(application, bot_handlers):
     
     logger.info("🛑 تم إيقاف البوت بنجاح")
 
+async def run_worker():
+    """تشغيل عامل زحف فقط (RUN_MODE=worker): بدون تيليجرام، يحجز المهام من الوسيط"""
+    worker = CrawlWorker(create_broker())
+    stop_event = asyncio.Event()
+    
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_event.set)
+    
+    await metrics_collector.start()
+    await memory_governor.start()
+    await worker.start()
+    logger.info("🎉 عامل الزحف يعمل الآن")
+    
+    try:
+        await stop_event.wait()
+    finally:
+        await worker.stop()
+        await memory_governor.stop()
+        await metrics_collector.stop()
+        logger.info(f"🛑 تم إيقاف عامل الزحف: {worker.get_stats()}")
+
 async def main():
     """الدالة الرئيسية لتشغيل البوت"""
+    if config.Config.RUN_MODE == "worker":
+        await run_worker()
+        return
+    
     application = None
     bot_handlers = None
+    broker = None
     
     try:
         logger.info("🚀 بدء تشغيل WebMaster Bot المتطور...")
@@ -88,20 +148,35 @@ async def main():
         await db_manager.initialize()
         logger.info("✅ تم تهيئة قاعدة البيانات")
         
-        # بدء قوائل الانتظار
-        await download_queue.start()
-        logger.info("✅ تم بدء قوائل الانتظار")
-        
         # بدء نظام المراقبة
         await metrics_collector.start()
         logger.info("✅ تم بدء نظام المراقبة")
         
+        # بدء منظم الذاكرة
+        await memory_governor.start()
+        logger.info("✅ تم بدء منظم الذاكرة")
+        
         # بدء خادم الفحص الصحي
         health_thread = start_health_server()
         logger.info("✅ تم بدء خادم الفحص الصحي")
         
-        # تهيئة البوت
-        application = Application.builder().token(config.Config.BOT_TOKEN).build()
+        # تهيئة البوت (كل الطلبات الصادرة تمر عبر محدد المعدل)
+        builder = (
+            Application.builder()
+            .token(config.Config.BOT_TOKEN)
+            .rate_limiter(outbound_limiter)
+            .concurrent_updates(ChatOrderedUpdateProcessor(config.Config.UPDATE_CONCURRENCY))
+        )
+        if config.Config.TELEGRAM_API_URL:
+            # خادم Bot API محلي: رفع بمسار الملف وحد 2000MB
+            builder = (
+                builder
+                .base_url(f"{config.Config.TELEGRAM_API_URL}/bot")
+                .base_file_url(f"{config.Config.TELEGRAM_API_URL}/file/bot")
+                .local_mode(config.Config.TELEGRAM_LOCAL_MODE)
+            )
+            logger.info(f"🏠 استخدام خادم Bot API: {config.Config.TELEGRAM_API_URL}")
+        application = builder.build()
         logger.info("✅ تم تهيئة التطبيق")
         
         # تهيئة المعالجات
@@ -109,6 +184,32 @@ async def main():
         await bot_handlers.initialize()
         logger.info("✅ تم تهيئة معالجات البوت")
         
+        # معرفات الملفات المرسلة سابقاً (إعادة الإرسال بدون رفع)
+        await archive_delivery.start()
+        
+        # ناشر رسائل التقدم: كل تعديلات رسائل التنزيل تمر عبره
+        await progress_publisher.start(application.bot)
+        
+        # تسجيل معالج التنزيل ومستمعه قبل بدء القائمة كي تُربط المهام المستعادة بهما
+        bot_handlers.download_handlers.bind_queue(application.bot)
+        if config.Config.QUEUE_EXECUTION == "broker":
+            broker = create_broker()
+            await broker.start()
+            download_queue.register_handler(DOWNLOAD_HANDLER, make_remote_handler(broker))
+            download_queue.max_concurrent = config.Config.BROKER_MAX_INFLIGHT
+            logger.info("✅ التنفيذ عبر عمال الزحف (الوسيط)")
+        else:
+            download_queue.register_handler(DOWNLOAD_HANDLER, make_local_handler(bot_handlers.downloader))
+        
+        # بدء قوائل الانتظار
+        await download_queue.start()
+        logger.info("✅ تم بدء قوائل الانتظار")
+        
+        # حد التزامن المحلي يتكيف مع الحمل؛ في وضع الوسيط الحد يخص العمال لا هذه العملية
+        if config.Config.AUTOSCALE_ENABLED and config.Config.QUEUE_EXECUTION != "broker":
+            await autoscaler.start()
+            logger.info("✅ تم بدء التحجيم التلقائي")
+        
         # تسجيل المعالجات
         handlers = [
             CommandHandler("start", bot_handlers.start),
@@ -128,6 +229,8 @@ async def main():
         ]
         
         for handler in handlers:
+            # قياس مدة كل معالج (Prometheus + تسجيل البطيء)
+            handler.callback = timed_handler(handler.callback)
             application.add_handler(handler)
         
         logger.info("✅ تم تسجيل جميع المعالجات")
@@ -135,7 +238,7 @@ async def main():
         # إعداد معالج الإيقاف
         def signal_handler(signum, frame):
             logger.info(f"📡 تم استلام إشارة الإيقاف: {signum}")
-            asyncio.create_task(shutdown_handler(application, bot_handlers))
+            asyncio.create_task(shutdown_handler(application, bot_handlers, broker))
         
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
@@ -144,12 +247,23 @@ async def main():
         await application.initialize()
         await application.start()
         
-        # إعداد الـ polling مع معالجة الأخطاء
-        await application.updater.start_polling(
-            allowed_updates=["message", "callback_query", "inline_query"],
-            drop_pending_updates=True,  # تجاهل الرسائل القديمة
-            timeout=30  # مهلة انتظار أقصر
-        )
+        # الرسائل الجماعية غير المكتملة تُستأنف من آخر دفعة محفوظة (بعد تهيئة البوت ومحدد المعدل)
+        await broadcast_engine.start(application.bot)
+        
+        allowed_updates = ["message", "callback_query", "inline_query"]
+        if config.Config.UPDATE_MODE == "webhook":
+            # تيليجرام يدفع التحديثات لنقطة ASGI بدلاً من انتظارها بالـ polling
+            await webhook_server.start(application)
+            if config.Config.WEBHOOK_REGISTER:
+                # نسخة واحدة فقط تسجل العنوان؛ التحديثات المنتظرة لا تُحذف
+                await webhook_server.register(allowed_updates=allowed_updates)
+        else:
+            # إعداد الـ polling مع معالجة الأخطاء
+            await application.updater.start_polling(
+                allowed_updates=allowed_updates,
+                drop_pending_updates=True,  # تجاهل الرسائل القديمة
+                timeout=30  # مهلة انتظار أقصر
+            )
         
         logger.info("🎉 البوت يعمل الآن! اضغط Ctrl+C للإيقاف")
         logger.info(f"📊 معرف المشرف: {config.Config.ADMIN_ID}")
@@ -163,24 +277,34 @@ async def main():
             cleanup_counter += 1
             security_cleanup_counter += 1
             
-            # تنظيف دوري كل ساعة
-            if cleanup_counter >= 60:
-                if bot_handlers:
-                    await bot_handlers.periodic_cleanup()
-                
-                # تنظيف الكاش المنتهي الصلاحية
-                await cache_manager.cleanup_expired()
+            # خطأ في الصيانة الدورية لا يُنهي البوت
+            try:
+                # تنظيف دوري كل ساعة
+                if cleanup_counter >= 60:
+                    if bot_handlers:
+                        await bot_handlers.periodic_cleanup()
+                    
+                    # تنظيف الكاش المنتهي الصلاحية
+                    await cache_manager.cleanup_expired()
+                    
+                    # تنظيف قاعدة البيانات
+                    await db_manager.cleanup_expired_cache()
+                    
+                    # حذف مهام الوسيط المنتهية
+                    if broker:
+                        purged = await broker.purge_finished()
+                        if purged:
+                            logger.info(f"🧹 تم حذف {purged} مهمة منتهية من الوسيط")
+                    
+                    cleanup_counter = 0
+                    logger.info("🧹 تم إجراء تنظيف دوري")
                 
-                # تنظيف قاعدة البيانات
-                await db_manager.cleanup_expired_cache()
-                
-                cleanup_counter = 0
-                logger.info("🧹 تم إجراء تنظيف دوري")
-            
-            # تنظيف بيانات الأمان كل 30 دقيقة
-            if security_cleanup_counter >= 30:
-                await security_manager.cleanup_old_data()
-                security_cleanup_counter = 0
+                # تنظيف بيانات الأمان كل 30 دقيقة
+                if security_cleanup_counter >= 30:
+                    await security_manager.cleanup_old_data()
+                    security_cleanup_counter = 0
+            except Exception as e:
+                logger.error(f"❌ خطأ في الصيانة الدورية: {e}")
                 
     except telegram.error.Conflict as e:
         logger.error(f"⚠️ خطأ: تم تشغيل البوت مسبقاً على جهاز آخر. {e}")
@@ -210,7 +334,7 @@ async def main():
         await db_manager.log_event('CRITICAL', f'Unexpected error: {e}', 'main')
         raise
     finally:
-        await shutdown_handler(application, bot_handlers)
+        await shutdown_handler(application, bot_handlers, broker)
 
 if __name__ == "__main__":
     try:
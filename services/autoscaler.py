@@ -0,0 +1,225 @@
+"""
+التحجيم التلقائي لعدد التنزيلات المتزامنة
+Adaptive Concurrency Autoscaler (AIMD)
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+import psutil
+from prometheus_client import Counter, Gauge
+
+from services.memory_governor import MemoryGovernor, MemoryPressure, memory_governor
+from services.queue_manager import DownloadQueue, download_queue
+from utils.logger import logger
+import config
+
+# المقاييس على مستوى الوحدة: سجل Prometheus يرفض تسجيل الاسم نفسه مرتين
+PROM_CONCURRENCY_LIMIT = Gauge('bot_queue_concurrency_limit', 'Current download concurrency limit')
+PROM_LOOP_LAG = Gauge('bot_event_loop_lag_seconds', 'Worst event loop lag in the last window')
+PROM_PAGE_LATENCY_P95 = Gauge('bot_page_render_latency_p95_seconds', 'Page render latency p95')
+PROM_ERROR_RATE = Gauge('bot_download_error_rate', 'Download error rate in the last window')
+PROM_DECISIONS = Counter('bot_autoscaler_decisions_total', 'Autoscaler decisions', ['action', 'reason'])
+
+class ScaleAction:
+    """قرارات المتحكم"""
+    INCREASE = "increase"
+    DECREASE = "decrease"
+    HOLD = "hold"
+
+class ConcurrencyAutoscaler:
+    """متحكم AIMD لحد التزامن في قائمة التنزيل
+
+    كل نافذة يقرأ تأخر حلقة الأحداث والمعالج وضغط الذاكرة (البوت + Chromium)
+    وزمن عرض الصفحات وقيمة الأخطاء: أي إشارة حمل زائد تقسم الحد على اثنين،
+    وإن كانت كل الإشارات سليمة والقائمة مشبعة يزيد الحد بواحد.
+    """
+
+    def __init__(self, queue: DownloadQueue = None, governor: MemoryGovernor = None,
+                 min_concurrent: int = None, max_concurrent: int = None, interval: float = None):
+        self.queue = queue or download_queue
+        self.governor = governor or memory_governor
+        self.min_concurrent = min_concurrent or config.Config.AUTOSCALE_MIN_CONCURRENT
+        self.max_concurrent = max(self.min_concurrent, max_concurrent or config.Config.AUTOSCALE_MAX_CONCURRENT)
+        self.interval = interval or config.Config.AUTOSCALE_INTERVAL
+
+        self.lag_threshold = config.Config.AUTOSCALE_LOOP_LAG_THRESHOLD
+        self.cpu_threshold = config.Config.AUTOSCALE_CPU_THRESHOLD
+        self.latency_target = config.Config.AUTOSCALE_LATENCY_TARGET
+        self.error_rate_threshold = config.Config.AUTOSCALE_ERROR_RATE_THRESHOLD
+        self.decrease_factor = 0.5
+        self.cooldown = 3  # نوافذ بدون زيادة بعد كل تخفيض
+
+        self._latencies: deque = deque(maxlen=200)  # أزمنة عرض الصفحات الأخيرة (ثواني)
+        self._max_lag = 0.0
+        self._last_counts: Tuple[int, int] = (0, 0)
+        self._cooldown_left = 0
+        self.last_decision: Dict = {'action': ScaleAction.HOLD, 'reason': 'startup'}
+
+        self._probe_task = None
+        self._control_task = None
+        self._is_running = False
+
+    async def start(self):
+        """بدء قياس تأخر الحلقة وحلقة التحكم"""
+        if self._is_running:
+            return
+
+        self._is_running = True
+        self._last_counts = self._finished_counts()
+        self._apply(self._clamp(self.queue.max_concurrent))
+        psutil.cpu_percent(interval=None)  # القراءة الأولى مرجعية فقط
+
+        self._probe_task = asyncio.create_task(self._probe_loop())
+        self._control_task = asyncio.create_task(self._control_loop())
+        logger.info(f"📈 تم بدء التحجيم التلقائي ({self.min_concurrent}-{self.max_concurrent} تنزيل متزامن)")
+
+    async def stop(self):
+        """إيقاف المتحكم مع إبقاء آخر حد"""
+        self._is_running = False
+
+        for task in (self._probe_task, self._control_task):
+            if task:
+                task.cancel()
+        await asyncio.gather(*(t for t in (self._probe_task, self._control_task) if t),
+                             return_exceptions=True)
+        self._probe_task = self._control_task = None
+
+        logger.info("⏹️ تم إيقاف التحجيم التلقائي")
+
+    def record_page_latency(self, seconds: float):
+        """تسجيل زمن عرض صفحة (من المحمل)"""
+        self._latencies.append(seconds)
+
+    async def _probe_loop(self, period: float = 0.1):
+        """قياس تأخر حلقة الأحداث كفرق بين مدة النوم المطلوبة والفعلية"""
+        while self._is_running:
+            started = time.monotonic()
+            await asyncio.sleep(period)
+            lag = time.monotonic() - started - period
+            self._max_lag = max(self._max_lag, lag)
+
+    async def _control_loop(self):
+        """تقييم الإشارات كل نافذة"""
+        while self._is_running:
+            try:
+                await asyncio.sleep(self.interval)
+                self.evaluate(cpu_percent=psutil.cpu_percent(interval=None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في التحجيم التلقائي: {e}")
+
+    def _finished_counts(self) -> Tuple[int, int]:
+        stats = self.queue.stats
+        return stats['completed_tasks'], stats['failed_tasks']
+
+    def _latency_p95(self) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _error_rate(self) -> Optional[float]:
+        """نسبة الفشل في النافذة الأخيرة (None إذا لم تنته مهام كافية)"""
+        completed, failed = self._finished_counts()
+        done = completed - self._last_counts[0]
+        errors = failed - self._last_counts[1]
+        self._last_counts = (completed, failed)
+
+        if done + errors < 2:
+            return None
+        return errors / (done + errors)
+
+    def collect_signals(self, cpu_percent: float = 0.0) -> Dict:
+        """جمع إشارات النافذة الحالية وتصفير ما يخصها"""
+        signals = {
+            'loop_lag': self._max_lag,
+            'cpu_percent': cpu_percent,
+            'memory_pressure': self.governor.pressure,
+            'latency_p95': self._latency_p95(),
+            'error_rate': self._error_rate(),
+            'saturated': (
+                bool(self.queue._pending_index)
+                and len(self.queue.running_tasks) >= self.queue.max_concurrent
+            ),
+        }
+        self._max_lag = 0.0
+        self._latencies.clear()
+        return signals
+
+    def decide(self, signals: Dict) -> Tuple[str, str]:
+        """قرار AIMD من الإشارات: (الإجراء، السبب)"""
+        if signals['memory_pressure'].value >= MemoryPressure.HIGH.value:
+            return ScaleAction.DECREASE, 'memory'
+        if signals['loop_lag'] > self.lag_threshold:
+            return ScaleAction.DECREASE, 'loop_lag'
+        if signals['cpu_percent'] > self.cpu_threshold:
+            return ScaleAction.DECREASE, 'cpu'
+        if signals['latency_p95'] is not None and signals['latency_p95'] > self.latency_target:
+            return ScaleAction.DECREASE, 'latency'
+        if signals['error_rate'] is not None and signals['error_rate'] > self.error_rate_threshold:
+            return ScaleAction.DECREASE, 'errors'
+
+        # ضغط متوسط: لا زيادة ولا تخفيض
+        if signals['memory_pressure'] == MemoryPressure.ELEVATED:
+            return ScaleAction.HOLD, 'memory'
+        if self._cooldown_left > 0:
+            return ScaleAction.HOLD, 'cooldown'
+        if not signals['saturated']:
+            return ScaleAction.HOLD, 'idle'
+        return ScaleAction.INCREASE, 'healthy'
+
+    def evaluate(self, cpu_percent: float = 0.0) -> int:
+        """نافذة تحكم واحدة: جمع الإشارات، اتخاذ القرار وتطبيقه"""
+        signals = self.collect_signals(cpu_percent)
+        action, reason = self.decide(signals)
+        current = self.queue.max_concurrent
+
+        if action == ScaleAction.DECREASE:
+            target = self._clamp(int(current * self.decrease_factor))
+            self._cooldown_left = self.cooldown
+        elif action == ScaleAction.INCREASE:
+            target = self._clamp(current + 1)
+        else:
+            target = current
+            self._cooldown_left = max(0, self._cooldown_left - 1)
+
+        if target != current:
+            log = logger.warning if target < current else logger.info
+            log(f"📈 حد التزامن: {current} → {target} ({reason})")
+        self._apply(target)
+
+        self.last_decision = {'action': action, 'reason': reason, 'limit': target}
+        PROM_DECISIONS.labels(action=action, reason=reason).inc()
+        PROM_LOOP_LAG.set(signals['loop_lag'])
+        if signals['latency_p95'] is not None:
+            PROM_PAGE_LATENCY_P95.set(signals['latency_p95'])
+        if signals['error_rate'] is not None:
+            PROM_ERROR_RATE.set(signals['error_rate'])
+        return target
+
+    def _clamp(self, value: int) -> int:
+        return max(self.min_concurrent, min(self.max_concurrent, value))
+
+    def _apply(self, limit: int):
+        """تطبيق الحد؛ التخفيض لا يوقف المهام الجارية بل يمنع بدء جديدة"""
+        raised = limit > self.queue.max_concurrent
+        self.queue.max_concurrent = limit
+        PROM_CONCURRENCY_LIMIT.set(limit)
+        if raised:
+            self.queue._notify_dispatcher()
+
+    def get_stats(self) -> Dict:
+        """إحصائيات المتحكم"""
+        return {
+            'limit': self.queue.max_concurrent,
+            'min': self.min_concurrent,
+            'max': self.max_concurrent,
+            'last_decision': self.last_decision,
+        }
+
+# إنشاء مثيل عام للاستخدام
+autoscaler = ConcurrencyAutoscaler()
@@ -0,0 +1,364 @@
+"""
+محرك الرسائل الجماعية القابل للاستئناف
+Resumable Concurrent Broadcast Engine
+"""
+
+import asyncio
+import os
+import sqlite3
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from telegram.error import Forbidden, TelegramError
+
+from services.progress_publisher import progress_publisher
+from services.rate_limiter import Priority
+from utils.logger import logger
+import config
+
+class BroadcastStatus:
+    """حالات الرسالة الجماعية"""
+    RUNNING = "running"
+    DONE = "done"
+    CANCELLED = "cancelled"
+    FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    admin_chat_id INTEGER,
+    status_message_id INTEGER,
+    status TEXT NOT NULL,
+    cursor INTEGER DEFAULT 0,
+    sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    total INTEGER DEFAULT 0,
+    created_at REAL,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    broadcast_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    ok INTEGER NOT NULL,
+    error TEXT,
+    PRIMARY KEY (broadcast_id, chat_id)
+) WITHOUT ROWID;
+"""
+
+def _recipient_page(cursor: int, limit: int) -> List[int]:
+    """صفحة معرفات المستلمين بعد المؤشر (ترقيم بالمفتاح، بدون تحميل الصفوف)"""
+    from database import SessionLocal, User
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(User.telegram_id)
+            .filter(User.telegram_id > cursor, User.is_banned.isnot(True))
+            .order_by(User.telegram_id)
+            .limit(limit)
+            .all()
+        )
+        return [row[0] for row in rows]
+    finally:
+        db.close()
+
+def _recipient_count() -> int:
+    from database import SessionLocal, User
+    db = SessionLocal()
+    try:
+        return db.query(User.telegram_id).filter(User.is_banned.isnot(True)).count()
+    finally:
+        db.close()
+
+class BroadcastEngine:
+    """إرسال رسالة لكل المستخدمين بدفعات متزامنة مع حفظ التقدم
+
+    المستلمون يُقرؤون بدفعات مرتبة بمعرف تيليجرام بعد مؤشر محفوظ، وتُرسل كل
+    دفعة بالتوازي بأولوية BULK عبر محدد المعدل. نتيجة كل مستلم تُحفظ مع
+    المؤشر بعد كل دفعة، فبعد إعادة التشغيل يُستأنف الإرسال من آخر دفعة
+    دون تكرار من استلم (قد تتكرر فقط الدفعة التي انقطعت أثناء إرسالها).
+    الخطأ غير المتوقع (قاعدة البيانات مثلاً) يُعاد بعده الإرسال من المؤشر بتأخير
+    متزايد، وبعد max_retries محاولات بلا تقدم تُعلَّم الرسالة فاشلة ويُبلَّغ المشرف.
+    """
+
+    def __init__(self, bot=None, path: str = None, batch_size: int = None, concurrency: int = None,
+                 recipient_page: Callable[[int, int], List[int]] = None,
+                 recipient_count: Callable[[], int] = None, max_retries: int = None):
+        self.bot = bot
+        self.path = path or config.Config.BROADCAST_DB_PATH
+        self.batch_size = batch_size or config.Config.BROADCAST_BATCH_SIZE
+        self.concurrency = concurrency or config.Config.BROADCAST_CONCURRENCY
+        self.max_retries = config.Config.BROADCAST_MAX_RETRIES if max_retries is None else max_retries
+        self._recipient_page = recipient_page or _recipient_page
+        self._recipient_count = recipient_count or _recipient_count
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+        self._jobs: Dict[str, asyncio.Task] = {}
+        self._is_running = False
+
+    async def start(self, bot=None):
+        """فتح قاعدة البيانات واستئناف الرسائل غير المكتملة"""
+        if self._is_running:
+            return
+
+        if bot is not None:
+            self.bot = bot
+        await asyncio.to_thread(self._open)
+        self._is_running = True
+
+        unfinished = await self._run_db(
+            lambda: self._conn.execute("SELECT id FROM broadcasts WHERE status = ?",
+                                       (BroadcastStatus.RUNNING,)).fetchall()
+        )
+        for (broadcast_id,) in unfinished:
+            logger.info(f"📢 استئناف الرسالة الجماعية {broadcast_id}")
+            self._spawn(broadcast_id)
+
+        logger.info("📢 تم بدء محرك الرسائل الجماعية")
+
+    async def stop(self):
+        """إيقاف الإرسال؛ الرسائل الجارية تبقى محفوظة للاستئناف"""
+        self._is_running = False
+
+        for job in self._jobs.values():
+            job.cancel()
+        await asyncio.gather(*self._jobs.values(), return_exceptions=True)
+        self._jobs.clear()
+
+        if self._conn:
+            async with self._lock:
+                await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+        logger.info("⏹️ تم إيقاف محرك الرسائل الجماعية")
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    async def _run_db(self, func, *args):
+        """تنفيذ عملية متزامنة على الاتصال في خيط منفصل"""
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def create(self, text: str, admin_chat_id: int = None, status_message_id: int = None) -> str:
+        """بدء رسالة جماعية جديدة وإرجاع معرفها"""
+        if not self._is_running:
+            raise Exception("محرك الرسائل الجماعية غير مشغل")
+
+        broadcast_id = uuid.uuid4().hex[:12]
+        total = await asyncio.to_thread(self._recipient_count)
+        now = time.time()
+        await self._run_db(
+            self._conn.execute,
+            "INSERT INTO broadcasts (id, text, admin_chat_id, status_message_id, status, total, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (broadcast_id, text, admin_chat_id, status_message_id, BroadcastStatus.RUNNING, total, now, now)
+        )
+        self._spawn(broadcast_id)
+        logger.info(f"📢 بدء رسالة جماعية {broadcast_id} إلى {total} مستخدم")
+        return broadcast_id
+
+    async def cancel(self, broadcast_id: str) -> bool:
+        """إيقاف رسالة جماعية نهائياً (بدون استئناف)"""
+        job = self._jobs.pop(broadcast_id, None)
+        if job:
+            job.cancel()
+            await asyncio.gather(job, return_exceptions=True)
+
+        cursor = await self._run_db(
+            self._conn.execute,
+            "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+            (BroadcastStatus.CANCELLED, time.time(), broadcast_id, BroadcastStatus.RUNNING)
+        )
+        return cursor.rowcount > 0
+
+    async def get(self, broadcast_id: str) -> Optional[Dict]:
+        """حالة الرسالة الجماعية"""
+        def fetch():
+            cursor = self._conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+            row = cursor.fetchone()
+            return dict(zip([column[0] for column in cursor.description], row)) if row else None
+        return await self._run_db(fetch)
+
+    def _spawn(self, broadcast_id: str):
+        job = asyncio.create_task(self._run(broadcast_id))
+        self._jobs[broadcast_id] = job
+
+        def forget(_):
+            if self._jobs.get(broadcast_id) is job:
+                del self._jobs[broadcast_id]
+        job.add_done_callback(forget)
+
+    async def _run(self, broadcast_id: str):
+        """تشغيل الرسالة مع إعادة المحاولة من المؤشر المحفوظ عند الأخطاء غير المتوقعة"""
+        attempt = 0
+        failed_at = None  # المؤشر المحفوظ عند آخر خطأ
+        while True:
+            state = None
+            try:
+                state = await self.get(broadcast_id)
+                if state is None:
+                    return
+                await self._send_all(broadcast_id, state)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # المؤشر في الذاكرة لا يسبق المحفوظ؛ التقدم منذ آخر خطأ يعيد عداد المحاولات
+                cursor = state['cursor'] if state else failed_at
+                attempt = attempt + 1 if cursor == failed_at else 1
+                failed_at = cursor
+                if attempt > self.max_retries:
+                    logger.error(f"❌ فشلت الرسالة الجماعية {broadcast_id} نهائياً: {e}")
+                    await self._fail(broadcast_id, state, e)
+                    return
+                delay = min(2 ** attempt, 60)
+                logger.warning(f"🔄 خطأ في الرسالة الجماعية {broadcast_id}، "
+                               f"إعادة المحاولة بعد {delay} ثانية: {e}")
+                await asyncio.sleep(delay)
+
+    async def _send_all(self, broadcast_id: str, state: Dict):
+        """إرسال الدفعات من المؤشر المحفوظ حتى نهاية المستخدمين"""
+        started = time.monotonic()
+        done_this_run = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        while True:
+            recipients = await asyncio.to_thread(self._recipient_page, state['cursor'], self.batch_size)
+            if not recipients:
+                break
+
+            # من استلم في تشغيل سابق انقطع أثناء هذه الدفعة لا تُعاد له
+            delivered = await self._delivered(broadcast_id, recipients)
+            pending = [chat_id for chat_id in recipients if chat_id not in delivered]
+
+            async def deliver(chat_id: int):
+                async with semaphore:
+                    return chat_id, *await self._send(chat_id, state['text'])
+
+            results = await asyncio.gather(*(deliver(chat_id) for chat_id in pending))
+            sent = sum(1 for _, ok, _ in results if ok)
+
+            # لا يتقدم المؤشر في الذاكرة قبل حفظه، فلا تُحسب دفعة لم تُحفظ تقدماً
+            progress = {'cursor': recipients[-1], 'sent': state['sent'] + sent,
+                        'failed': state['failed'] + len(results) - sent}
+            await self._save_batch(broadcast_id, progress, results)
+            state.update(progress)
+
+            done_this_run += len(results)
+            self._report(state, done_this_run / max(time.monotonic() - started, 1e-6))
+
+        state['status'] = BroadcastStatus.DONE
+        await self._run_db(
+            self._conn.execute,
+            "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ?",
+            (BroadcastStatus.DONE, time.time(), broadcast_id)
+        )
+        self._report(state, done_this_run / max(time.monotonic() - started, 1e-6))
+        logger.info(f"📢 اكتملت الرسالة الجماعية {broadcast_id}: "
+                    f"{state['sent']} ناجحة، {state['failed']} فاشلة")
+
+    async def _fail(self, broadcast_id: str, state: Optional[Dict], error: Exception):
+        """تعليم الرسالة فاشلة (لا تُستأنف) وإبلاغ المشرف بآخر تقدم محفوظ"""
+        try:
+            await self._run_db(
+                self._conn.execute,
+                "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (BroadcastStatus.FAILED, time.time(), broadcast_id, BroadcastStatus.RUNNING)
+            )
+        except Exception as e:
+            logger.error(f"❌ تعذر حفظ فشل الرسالة الجماعية {broadcast_id}: {e}")
+
+        if state:
+            state['status'] = BroadcastStatus.FAILED
+            state['error'] = str(error)
+            self._report(state, 0.0)
+
+    async def _send(self, chat_id: int, text: str):
+        """إرسال لمستلم واحد: (نجاح، الخطأ)"""
+        try:
+            await self.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                parse_mode='Markdown',
+                rate_limit_args={'priority': Priority.BULK}
+            )
+            return True, None
+        except Forbidden as e:
+            # المستخدم حظر البوت: فشل نهائي لا يستحق إعادة المحاولة
+            return False, str(e)
+        except TelegramError as e:
+            logger.warning(f"فشل إرسال لـ {chat_id}: {e}")
+            return False, str(e)
+
+    async def _delivered(self, broadcast_id: str, recipients: List[int]) -> set:
+        def fetch():
+            placeholders = ",".join("?" * len(recipients))
+            rows = self._conn.execute(
+                f"SELECT chat_id FROM broadcast_deliveries WHERE broadcast_id = ? AND chat_id IN ({placeholders})",
+                (broadcast_id, *recipients)
+            ).fetchall()
+            return {row[0] for row in rows}
+        return await self._run_db(fetch)
+
+    async def _save_batch(self, broadcast_id: str, state: Dict, results: List):
+        """حفظ نتائج الدفعة مع المؤشر والعدادات في معاملة واحدة"""
+        def save():
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO broadcast_deliveries (broadcast_id, chat_id, ok, error) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(broadcast_id, chat_id, int(ok), error) for chat_id, ok, error in results]
+                )
+                self._conn.execute(
+                    "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, updated_at = ? WHERE id = ?",
+                    (state['cursor'], state['sent'], state['failed'], time.time(), broadcast_id)
+                )
+        await self._run_db(save)
+
+    def _report(self, state: Dict, rate: float):
+        """تحديث رسالة المشرف بالتقدم والمعدل والوقت المتبقي"""
+        if not state.get('admin_chat_id') or not state.get('status_message_id'):
+            return
+
+        done = state['sent'] + state['failed']
+        total = max(state['total'], done)
+        final = state['status'] != BroadcastStatus.RUNNING
+
+        if state['status'] == BroadcastStatus.FAILED:
+            header = "❌ **توقفت الرسالة الجماعية بسبب خطأ**"
+            timing = f"\n⚠️ الخطأ: {state.get('error', '')}"
+        elif final:
+            header = "✅ **تم إرسال الرسالة الجماعية**"
+            timing = ""
+        else:
+            header = "📢 **جاري الإرسال الجماعي...**"
+            eta = (total - done) / rate if rate > 0 else 0
+            timing = f"\n⚡ المعدل: {rate:.1f} رسالة/ثانية\n⏰ المتبقي: {eta / 60:.0f} دقيقة"
+
+        progress_publisher.publish(
+            state['admin_chat_id'], state['status_message_id'],
+            f"{header}\n\n"
+            f"📊 التقدم: {done}/{total} ({(done / total * 100) if total else 100:.1f}%)\n"
+            f"📤 تم الإرسال لـ: {state['sent']} مستخدم\n"
+            f"❌ فشل الإرسال لـ: {state['failed']} مستخدم"
+            f"{timing}",
+            final=final
+        )
+
+    def get_stats(self) -> Dict:
+        """إحصائيات المحرك"""
+        return {'active_broadcasts': len(self._jobs)}
+
+# إنشاء مثيل عام للاستخدام
+broadcast_engine = BroadcastEngine()
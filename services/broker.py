@@ -0,0 +1,272 @@
+"""
+وسيط المهام بين واجهة البوت وعمال الزحف
+Task Broker Between Bot Front-End and Crawl Workers
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+from utils.logger import logger
+import config
+
+class JobStatus:
+    """حالات المهمة في الوسيط"""
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FINISHED = (DONE, FAILED, CANCELLED)
+
+class Broker(ABC):
+    """واجهة الوسيط: الواجهة تضيف المهام والعمال يحجزونها بعقود قابلة للتجديد"""
+
+    lease_timeout: float
+
+    @abstractmethod
+    async def start(self):
+        """فتح الاتصال بالوسيط"""
+
+    @abstractmethod
+    async def stop(self):
+        """إغلاق الاتصال بالوسيط"""
+
+    @abstractmethod
+    async def submit(self, kind: str, payload: Dict[str, Any], priority: int = 2) -> str:
+        """إضافة مهمة وإرجاع معرفها"""
+
+    @abstractmethod
+    async def claim(self, worker_id: str) -> Optional[Dict]:
+        """حجز المهمة التالية (أو مهمة انتهى عقد عاملها)"""
+
+    @abstractmethod
+    async def heartbeat(self, job_id: str, worker_id: str, progress: float = None,
+                        message: str = None) -> bool:
+        """تجديد العقد ونشر التقدم؛ False إذا فُقد العقد أو أُلغيت المهمة"""
+
+    @abstractmethod
+    async def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> bool:
+        """تسجيل نتيجة المهمة (فقط من العامل الحامل للعقد)"""
+
+    @abstractmethod
+    async def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """تسجيل فشل المهمة (فقط من العامل الحامل للعقد)"""
+
+    @abstractmethod
+    async def cancel(self, job_id: str) -> bool:
+        """إلغاء مهمة منتظرة أو جارية"""
+
+    @abstractmethod
+    async def get(self, job_id: str) -> Optional[Dict]:
+        """حالة المهمة ونتيجتها"""
+
+    @abstractmethod
+    async def purge_finished(self, max_age: float = 86400) -> int:
+        """حذف المهام المنتهية الأقدم من max_age ثانية"""
+
+    @abstractmethod
+    async def get_stats(self) -> Dict:
+        """عدد المهام في كل حالة"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS broker_jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 2,
+    status TEXT NOT NULL,
+    worker_id TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_broker_jobs_claim ON broker_jobs (status, priority, created_at);
+"""
+
+class SQLiteBroker(Broker):
+    """وسيط على ملف SQLite مشترك (WAL) بين عمليات على نفس الجهاز أو نفس المجلد المشترك"""
+
+    def __init__(self, path: str = None, lease_timeout: float = None, max_attempts: int = None):
+        self.path = path or os.path.join(config.Config.DATA_DIR, "broker.db")
+        self.lease_timeout = lease_timeout or config.Config.BROKER_LEASE_TIMEOUT
+        self.max_attempts = max_attempts or config.Config.QUEUE_MAX_RETRIES + 1
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """فتح قاعدة بيانات الوسيط"""
+        if self._conn:
+            return
+
+        await asyncio.to_thread(self._open)
+        logger.info(f"📮 تم فتح وسيط المهام: {self.path}")
+
+    async def stop(self):
+        """إغلاق قاعدة بيانات الوسيط"""
+        if self._conn:
+            async with self._lock:
+                await asyncio.to_thread(self._conn.close)
+            self._conn = None
+            logger.info("📮 تم إغلاق وسيط المهام")
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(_SCHEMA)
+
+    async def _run(self, func, *args):
+        """تنفيذ عملية متزامنة على الاتصال في خيط منفصل"""
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def submit(self, kind: str, payload: Dict[str, Any], priority: int = 2) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        await self._run(self._conn.execute,
+            "INSERT INTO broker_jobs (id, kind, payload, priority, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload, default=str), priority, JobStatus.QUEUED, now, now)
+        )
+        return job_id
+
+    async def claim(self, worker_id: str) -> Optional[Dict]:
+        return await self._run(self._claim, worker_id, time.time())
+
+    def _claim(self, worker_id: str, now: float) -> Optional[Dict]:
+        # BEGIN IMMEDIATE يأخذ قفل الكتابة فوراً فلا يحجز عاملان نفس المهمة
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = self._conn.execute(
+                    "SELECT * FROM broker_jobs "
+                    "WHERE status = ? OR (status = ? AND lease_until < ?) "
+                    "ORDER BY priority, created_at LIMIT 1",
+                    (JobStatus.QUEUED, JobStatus.RUNNING, now)
+                ).fetchone()
+
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+
+                # مهمة تسقط عاملها مراراً تفشل بدلاً من الدوران للأبد
+                if row['attempts'] >= self.max_attempts:
+                    self._conn.execute(
+                        "UPDATE broker_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                        (JobStatus.FAILED, "تجاوزت المهمة عدد المحاولات بعد انقطاع العمال", now, row['id'])
+                    )
+                    continue
+
+                self._conn.execute(
+                    "UPDATE broker_jobs SET status = ?, worker_id = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (JobStatus.RUNNING, worker_id, now + self.lease_timeout, now, row['id'])
+                )
+                self._conn.execute("COMMIT")
+
+                job = self._row_to_dict(row)
+                job['attempts'] += 1
+                job['status'] = JobStatus.RUNNING
+                job['worker_id'] = worker_id
+                return job
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def heartbeat(self, job_id: str, worker_id: str, progress: float = None,
+                        message: str = None) -> bool:
+        now = time.time()
+        cursor = await self._run(self._conn.execute,
+            "UPDATE broker_jobs SET lease_until = ?, progress = COALESCE(?, progress), "
+            "message = COALESCE(?, message), updated_at = ? "
+            "WHERE id = ? AND worker_id = ? AND status = ?",
+            (now + self.lease_timeout, progress, message, now, job_id, worker_id, JobStatus.RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    async def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> bool:
+        return await self._finish(job_id, worker_id, JobStatus.DONE,
+                                  result=json.dumps(result, default=str))
+
+    async def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return await self._finish(job_id, worker_id, JobStatus.FAILED, error=error)
+
+    async def _finish(self, job_id: str, worker_id: str, status: str,
+                      result: str = None, error: str = None) -> bool:
+        # العامل الذي فقد عقده لا يكتب فوق نتيجة من حجز المهمة بعده
+        cursor = await self._run(self._conn.execute,
+            "UPDATE broker_jobs SET status = ?, result = ?, error = ?, progress = ?, "
+            "lease_until = NULL, updated_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+            (status, result, error, 100.0 if status == JobStatus.DONE else 0.0,
+             time.time(), job_id, worker_id, JobStatus.RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    async def cancel(self, job_id: str) -> bool:
+        cursor = await self._run(self._conn.execute,
+            "UPDATE broker_jobs SET status = ?, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND status IN (?, ?)",
+            (JobStatus.CANCELLED, time.time(), job_id, JobStatus.QUEUED, JobStatus.RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        row = await self._run(self._fetch_one, job_id)
+        return self._row_to_dict(row) if row else None
+
+    def _fetch_one(self, job_id: str):
+        return self._conn.execute("SELECT * FROM broker_jobs WHERE id = ?", (job_id,)).fetchone()
+
+    async def purge_finished(self, max_age: float = 86400) -> int:
+        """حذف المهام المنتهية الأقدم من max_age ثانية"""
+        placeholders = ", ".join("?" * len(JobStatus.FINISHED))
+        cursor = await self._run(self._conn.execute,
+            f"DELETE FROM broker_jobs WHERE status IN ({placeholders}) AND updated_at < ?",
+            (*JobStatus.FINISHED, time.time() - max_age)
+        )
+        return cursor.rowcount
+
+    async def get_stats(self) -> Dict:
+        rows = await self._run(self._count_by_status)
+        stats = {status: 0 for status in (JobStatus.QUEUED, JobStatus.RUNNING, *JobStatus.FINISHED)}
+        stats.update({row['status']: row['total'] for row in rows})
+        return stats
+
+    def _count_by_status(self):
+        return self._conn.execute(
+            "SELECT status, COUNT(*) AS total FROM broker_jobs GROUP BY status"
+        ).fetchall()
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+def create_broker(url: str = None) -> Broker:
+    """إنشاء الوسيط من BROKER_URL (حالياً sqlite:///path)"""
+    url = url or config.Config.BROKER_URL
+
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(path=url[len("sqlite:///"):])
+
+    raise ValueError(f"❌ نوع وسيط غير مدعوم: {url}")
@@ -4,145 +4,109 @@ Advanced Database Management System
 """
 
 import asyncio
+import contextlib
 import sqlite3
 import aiosqlite
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, Text, JSON
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import case, delete, event, func, insert, or_, select, update
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-import json
+from typing import Any, Dict, List, Optional, Tuple
 import os
 
 from utils.logger import logger
+import database
+from database import (CacheEntry, DailyStats, DomainStats, Download, GlobalStats, SecurityEvent, SystemLog,
+                      TERMINAL_STATUSES, User)
 import config
 
-Base = declarative_base()
-
-class User(Base):
-    """جدول المستخدمين"""
-    __tablename__ = 'users'
-    
-    id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
-    username = Column(String(255))
-    first_name = Column(String(255))
-    last_name = Column(String(255))
-    language_code = Column(String(10), default='ar')
-    is_banned = Column(Boolean, default=False)
-    ban_reason = Column(Text)
-    warnings_count = Column(Integer, default=0)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    last_activity = Column(DateTime, default=datetime.utcnow)
-    total_downloads = Column(Integer, default=0)
-    successful_downloads = Column(Integer, default=0)
-    failed_downloads = Column(Integer, default=0)
-    settings = Column(JSON, default=dict)
-
-class Download(Base):
-    """جدول التنزيلات"""
-    __tablename__ = 'downloads'
-    
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
-    url = Column(Text, nullable=False)
-    status = Column(String(50), default='pending')  # pending, processing, completed, failed, cancelled
-    file_path = Column(Text)
-    file_size = Column(Integer, default=0)
-    download_time = Column(Float, default=0.0)
-    error_message = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    started_at = Column(DateTime)
-    completed_at = Column(DateTime)
-    metadata = Column(JSON, default=dict)
-
-class SystemLog(Base):
-    """جدول سجلات النظام"""
-    __tablename__ = 'system_logs'
-    
-    id = Column(Integer, primary_key=True)
-    level = Column(String(20), nullable=False)  # INFO, WARNING, ERROR, CRITICAL
-    message = Column(Text, nullable=False)
-    module = Column(String(100))
-    user_id = Column(Integer)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-    metadata = Column(JSON, default=dict)
-
-class SecurityEvent(Base):
-    """جدول الأحداث الأمنية"""
-    __tablename__ = 'security_events'
-    
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
-    event_type = Column(String(100), nullable=False)
-    severity = Column(String(20), nullable=False)  # low, medium, high, critical
-    description = Column(Text, nullable=False)
-    ip_address = Column(String(45))
-    user_agent = Column(Text)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-    metadata = Column(JSON, default=dict)
-
-class CacheEntry(Base):
-    """جدول الكاش"""
-    __tablename__ = 'cache_entries'
-    
-    id = Column(Integer, primary_key=True)
-    key = Column(String(255), unique=True, nullable=False)
-    value = Column(Text, nullable=False)
-    expires_at = Column(DateTime, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    access_count = Column(Integer, default=0)
-    last_accessed = Column(DateTime, default=datetime.utcnow)
+_COUNTER_COLUMNS = ('users', 'downloads', 'completed', 'failed', 'cancelled', 'total_size')
 
 class DatabaseManager:
-    """مدير قاعدة البيانات المتقدم"""
-    
-    def __init__(self):
+    """مدير قاعدة البيانات المتقدم
+
+    طبقة الوصول غير المتزامنة التي تستخدمها المعالجات: الاستعلامات تمر عبر
+    aiosqlite الذي ينفذها في خيط الاتصال، فلا يوقف قرص بطيء حلقة الأحداث
+    ولا بقية المستخدمين. الكائنات المعادة منفصلة عن الجلسة (expire_on_commit=False)
+    ويمكن قراءة أعمدتها بعد إغلاقها.
+    """
+    
+    def __init__(self, database_url: str = None):
+        self.database_url = database_url
         self.engine = None
         self.async_session = None
         self.connection_pool_size = 10
         self.max_overflow = 20
         self._initialized = False
+        self._init_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._serialize_writes = False
     
     async def initialize(self):
         """تهيئة قاعدة البيانات"""
-        try:
-            # إنشاء محرك قاعدة البيانات
-            database_url = config.Config.DATABASE_URL
-            if database_url.startswith('sqlite'):
-                # تحويل SQLite URL للاستخدام مع aiosqlite
-                database_url = database_url.replace('sqlite:///', 'sqlite+aiosqlite:///')
-            
-            self.engine = create_async_engine(
-                database_url,
+        async with self._init_lock:
+            if self._initialized:
+                return
+            try:
+                await self._initialize()
+            except Exception as e:
+                logger.error(f"❌ خطأ في تهيئة قاعدة البيانات: {e}")
+                raise
+    
+    async def _initialize(self):
+        # إنشاء محرك قاعدة البيانات
+        database_url = self.database_url or config.Config.DATABASE_URL
+        engine_options = {'echo': config.Config.DEBUG_MODE}
+        is_sqlite = database_url.startswith('sqlite')
+        if is_sqlite:
+            # تحويل SQLite URL للاستخدام مع aiosqlite
+            database_url = database_url.replace('sqlite:///', 'sqlite+aiosqlite:///')
+            # انتظار القفل بدلاً من فشل الكتابات المتزامنة فوراً
+            engine_options['connect_args'] = {'timeout': 30}
+            if ':memory:' not in database_url:
+                # الافتراضي NullPool يفتح اتصالاً (وخيطاً) لكل جلسة: أغلى من الاستعلام نفسه
+                engine_options.update(poolclass=AsyncAdaptedQueuePool, pool_size=self.connection_pool_size)
+        else:
+            engine_options.update(
                 pool_size=self.connection_pool_size,
                 max_overflow=self.max_overflow,
-                pool_pre_ping=True,
-                echo=config.Config.DEBUG_MODE
+                pool_pre_ping=True
             )
-            
-            # إنشاء جلسة async
-            self.async_session = sessionmaker(
-                self.engine,
-                class_=AsyncSession,
-                expire_on_commit=False
-            )
-            
-            # إنشاء الجداول
-            async with self.engine.begin() as conn:
-                await conn.run_sync(Base.metadata.create_all)
-            
-            self._initialized = True
-            logger.info("✅ تم تهيئة قاعدة البيانات بنجاح")
-            
-        except Exception as e:
-            logger.error(f"❌ خطأ في تهيئة قاعدة البيانات: {e}")
-            raise
+        
+        self.engine = create_async_engine(database_url, **engine_options)
+        self._serialize_writes = is_sqlite
+        if is_sqlite:
+            event.listen(self.engine.sync_engine, 'connect', self._configure_sqlite)
+        
+        # إنشاء جلسة async
+        self.async_session = sessionmaker(
+            self.engine,
+            class_=AsyncSession,
+            expire_on_commit=False
+        )
+        
+        # ترحيل المخطط الموحد (database.py) حتى آخر إصدار
+        async with self.engine.begin() as conn:
+            version = await conn.run_sync(database.migrate)
+        
+        self._initialized = True
+        logger.info(f"✅ تم تهيئة قاعدة البيانات بنجاح (إصدار المخطط {version})")
+    
+    @staticmethod
+    def _configure_sqlite(dbapi_connection, connection_record):
+        """WAL: القراءات لا تنتظر الكتابة الجارية"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
     
     async def close(self):
         """إغلاق اتصالات قاعدة البيانات"""
         if self.engine:
             await self.engine.dispose()
+            self.engine = None
+        self._initialized = False
         logger.info("✅ تم إغلاق اتصالات قاعدة البيانات")
     
     async def get_session(self) -> AsyncSession:
@@ -151,66 +115,201 @@ class DatabaseManager:
             await self.initialize()
         return self.async_session()
     
-    # === إدارة المستخدمين ===
+    def _writer(self):
+        """SQLite يقبل كاتباً واحداً: انتظار قفل asyncio أرخص من تراجع مهلة القفل في SQLite
+        
+        كل دالة تكتب (بما فيها السجلات والكاش والتنظيف) تأخذه، وإلا تراجعت هي أو غيرها في مهلة القفل.
+        """
+        return self._write_lock if self._serialize_writes else contextlib.nullcontext()
     
-    async def get_or_create_user(self, telegram_id: int, **kwargs) -> User:
-        """الحصول على مستخدم أو إنشاؤه"""
-        async with await self.get_session() as session:
-            # البحث عن المستخدم
-            result = await session.execute(
-                "SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)
+    async def get_connection(self) -> AsyncConnection:
+        """اتصال Core للقراءات التجميعية: أخف من الجلسة حين لا حاجة لكائنات ORM"""
+        if not self._initialized:
+            await self.initialize()
+        return self.engine.connect()
+    
+    # === بيانات المعالجات ===
+    
+    async def save_user(self, telegram_id: int, username: str = None, first_name: str = None,
+                        last_name: str = None, language_code: str = None) -> Tuple[User, bool]:
+        """حفظ مستخدم جديد أو تحديث آخر نشاط له؛ يعيد (المستخدم، هل هو جديد)"""
+        async with await self.get_session() as session, self._writer():
+            db_user = await session.scalar(
+                select(User).where(User.telegram_id == telegram_id)
             )
-            user_data = result.fetchone()
-            
-            if user_data:
-                # تحديث آخر نشاط
-                await session.execute(
-                    "UPDATE users SET last_activity = ? WHERE telegram_id = ?",
-                    (datetime.utcnow(), telegram_id)
+            created = db_user is None
+            if created:
+                db_user = User(
+                    telegram_id=telegram_id,
+                    username=username,
+                    first_name=first_name,
+                    last_name=last_name,
+                    language_code=language_code
                 )
-                await session.commit()
-                
-                # تحويل البيانات إلى كائن User
-                user = User()
-                for key, value in zip(user_data.keys(), user_data):
-                    setattr(user, key, value)
-                return user
+                session.add(db_user)
+                await self._increment(session, GlobalStats, {'id': 1}, users=1)
+                await self._increment(session, DailyStats, {'day': datetime.utcnow().date()}, new_users=1)
             else:
-                # إنشاء مستخدم جديد
-                user_data = {
-                    'telegram_id': telegram_id,
-                    'username': kwargs.get('username'),
-                    'first_name': kwargs.get('first_name'),
-                    'last_name': kwargs.get('last_name'),
-                    'language_code': kwargs.get('language_code', 'ar'),
-                    'created_at': datetime.utcnow(),
-                    'last_activity': datetime.utcnow(),
-                    'settings': json.dumps({})
-                }
-                
+                db_user.last_activity = datetime.utcnow()
+            await session.commit()
+            return db_user, created
+    
+    async def is_premium(self, telegram_id: int) -> bool:
+        """اشتراك المستخدم (وزنه في الجدولة العادلة)"""
+        async with await self.get_session() as session:
+            premium = await session.scalar(
+                select(User.is_premium).where(User.telegram_id == telegram_id)
+            )
+            return bool(premium)
+    
+    async def create_download(self, user_id: int, url: str, **fields) -> int:
+        """إنشاء سجل تنزيل جديد وزيادة عداداته في نفس المعاملة"""
+        fields.setdefault('created_at', datetime.utcnow())
+        async with await self.get_session() as session, self._writer():
+            download = Download(user_id=user_id, url=url, **fields)
+            session.add(download)
+            await self._increment(session, GlobalStats, {'id': 1}, downloads=1)
+            await self._increment(session, DailyStats, {'day': download.created_at.date()}, downloads=1)
+            if download.domain:
+                await self._increment(session, DomainStats, {'domain': download.domain}, downloads=1)
+            await session.execute(
+                update(User).where(User.telegram_id == user_id)
+                .values(total_downloads=func.coalesce(User.total_downloads, 0) + 1)
+            )
+            await session.commit()
+            return download.id
+    
+    async def update_download(self, download_id: int, **fields):
+        """تحديث سجل التنزيل؛ انتهاؤه يُحتسب في العدادات مرة واحدة وفي نفس المعاملة"""
+        column = TERMINAL_STATUSES.get(fields.get('status'))
+        async with await self.get_session() as session, self._writer():
+            finished = None
+            if column:
+                # الشرط على الحالة السابقة يمنع احتساب نفس التنزيل مرتين
+                finished = (await session.execute(
+                    update(Download)
+                    .where(Download.id == download_id,
+                           or_(Download.status.is_(None), Download.status.notin_(TERMINAL_STATUSES)))
+                    .values(**fields)
+                    .returning(Download.user_id, Download.file_size)
+                )).first()
+            
+            if finished is None:
                 await session.execute(
-                    """INSERT INTO users (telegram_id, username, first_name, last_name, 
-                       language_code, created_at, last_activity, settings) 
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                    tuple(user_data.values())
+                    update(Download).where(Download.id == download_id).values(**fields)
                 )
-                await session.commit()
-                
-                # إرجاع المستخدم الجديد
-                user = User()
-                for key, value in user_data.items():
-                    setattr(user, key, value)
-                return user
+            else:
+                user_id, file_size = finished
+                size = (file_size or 0.0) if column == 'completed' else 0.0
+                await self._increment(session, GlobalStats, {'id': 1}, **{column: 1}, total_size=size)
+                await self._increment(session, DailyStats, {'day': datetime.utcnow().date()},
+                                      **{column: 1}, total_size=size)
+                user_column = {'completed': 'successful_downloads', 'failed': 'failed_downloads'}.get(column)
+                if user_column:
+                    await session.execute(
+                        update(User).where(User.telegram_id == user_id).values(**{
+                            user_column: func.coalesce(getattr(User, user_column), 0) + 1,
+                            'total_size': func.coalesce(User.total_size, 0.0) + size
+                        })
+                    )
+            await session.commit()
+    
+    @staticmethod
+    async def _increment(session: AsyncSession, model, key: Dict, **amounts):
+        """زيادة أعمدة صف عدادات، وإنشاؤه بهذه القيم إن لم يوجد"""
+        result = await session.execute(
+            update(model)
+            .where(*(getattr(model, name) == value for name, value in key.items()))
+            .values({getattr(model, name): getattr(model, name) + amount for name, amount in amounts.items()})
+        )
+        if not result.rowcount:
+            await session.execute(insert(model).values(**key, **amounts))
+    
+    async def get_download(self, download_id: int) -> Optional[Download]:
+        """سجل تنزيل واحد"""
+        async with await self.get_session() as session:
+            return await session.get(Download, download_id)
+    
+    async def get_user_downloads(self, user_id: int, limit: int = 10) -> List[Download]:
+        """آخر تنزيلات المستخدم"""
+        async with await self.get_session() as session:
+            result = await session.scalars(
+                select(Download)
+                .where(Download.user_id == user_id)
+                .order_by(Download.created_at.desc())
+                .limit(limit)
+            )
+            return list(result)
+    
+    async def get_user_summary(self, user_id: int) -> Dict:
+        """ملخص تنزيلات المستخدم لأمر /stats في استعلام تجميعي واحد"""
+        completed = Download.status == 'completed'
+        async with await self.get_connection() as conn:
+            row = (await conn.execute(
+                select(
+                    func.count(),
+                    func.sum(case((completed, 1), else_=0)),
+                    func.sum(case((completed, Download.file_size), else_=0)),
+                    func.max(Download.created_at)
+                ).where(Download.user_id == user_id)
+            )).one()
+            total, successful, total_size, last_download_at = row
+            return {
+                'total': total or 0,
+                'successful': successful or 0,
+                'total_size': total_size or 0,
+                'last_download_at': last_download_at
+            }
+    
+    # === العدادات المجمعة (لوحات المشرف) ===
+    
+    async def get_global_stats(self) -> Dict:
+        """إجماليات المستخدمين والتنزيلات من صف العدادات"""
+        async with await self.get_connection() as conn:
+            row = (await conn.execute(select(GlobalStats).where(GlobalStats.id == 1))).first()
+        stats = dict(row._mapping) if row else {}
+        stats.pop('id', None)
+        return {name: stats.get(name) or 0 for name in _COUNTER_COLUMNS}
+    
+    async def get_recent_stats(self, days: int) -> Dict:
+        """مجموع آخر days يوماً (اليوم الحالي منها) من الحاويات اليومية"""
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+        async with await self.get_connection() as conn:
+            row = (await conn.execute(
+                select(*(func.coalesce(func.sum(getattr(DailyStats, name)), 0).label(name)
+                         for name in ('new_users',) + _COUNTER_COLUMNS[1:]))
+                .where(DailyStats.day >= since)
+            )).one()
+        return dict(row._mapping)
+    
+    async def get_top_domains(self, limit: int = 5) -> List[Tuple[str, int]]:
+        """أكثر النطاقات تنزيلاً"""
+        async with await self.get_connection() as conn:
+            result = await conn.execute(
+                select(DomainStats.domain, DomainStats.downloads)
+                .order_by(DomainStats.downloads.desc())
+                .limit(limit)
+            )
+            return [tuple(row) for row in result]
+    
+    # === إدارة المستخدمين ===
+    
+    async def get_or_create_user(self, telegram_id: int, **kwargs) -> User:
+        """الحصول على مستخدم أو إنشاؤه"""
+        user, _ = await self.save_user(
+            telegram_id,
+            username=kwargs.get('username'),
+            first_name=kwargs.get('first_name'),
+            last_name=kwargs.get('last_name'),
+            language_code=kwargs.get('language_code', 'ar')
+        )
+        return user
     
     async def update_user(self, telegram_id: int, **kwargs):
         """تحديث بيانات المستخدم"""
-        async with await self.get_session() as session:
-            set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
-            values = list(kwargs.values()) + [telegram_id]
-            
+        async with await self.get_session() as session, self._writer():
             await session.execute(
-                f"UPDATE users SET {set_clause} WHERE telegram_id = ?",
-                values
+                update(User).where(User.telegram_id == telegram_id).values(**kwargs)
             )
             await session.commit()
     
@@ -234,250 +333,153 @@ class DatabaseManager:
     
     async def add_user_warning(self, telegram_id: int, reason: str = ""):
         """إضافة تحذير للمستخدم"""
-        async with await self.get_session() as session:
-            # زيادة عدد التحذيرات
-            await session.execute(
-                "UPDATE users SET warnings_count = warnings_count + 1 WHERE telegram_id = ?",
-                (telegram_id,)
-            )
-            
-            # الحصول على عدد التحذيرات الحالي
-            result = await session.execute(
-                "SELECT warnings_count FROM users WHERE telegram_id = ?",
-                (telegram_id,)
+        async with await self.get_session() as session, self._writer():
+            # زيادة عدد التحذيرات والحصول على العدد الحالي
+            warnings_count = await session.scalar(
+                update(User)
+                .where(User.telegram_id == telegram_id)
+                .values(warnings_count=func.coalesce(User.warnings_count, 0) + 1)
+                .returning(User.warnings_count)
             )
-            warnings_count = result.fetchone()[0]
-            
             await session.commit()
-            
-            # حظر تلقائي بعد 3 تحذيرات
-            if warnings_count >= 3:
-                await self.ban_user(telegram_id, f"تجاوز حد التحذيرات: {reason}")
-            
-            return warnings_count
+        
+        # حظر تلقائي بعد 3 تحذيرات
+        if warnings_count and warnings_count >= 3:
+            await self.ban_user(telegram_id, f"تجاوز حد التحذيرات: {reason}")
+        
+        return warnings_count or 0
     
     async def get_user_stats(self, telegram_id: int) -> Dict:
         """الحصول على إحصائيات المستخدم"""
         async with await self.get_session() as session:
-            # بيانات المستخدم
-            user_result = await session.execute(
-                "SELECT * FROM users WHERE telegram_id = ?",
-                (telegram_id,)
-            )
-            user_data = user_result.fetchone()
-            
-            if not user_data:
+            user = await session.scalar(select(User).where(User.telegram_id == telegram_id))
+            if not user:
                 return {}
             
             # إحصائيات التنزيلات
-            download_result = await session.execute(
-                """SELECT 
-                   COUNT(*) as total,
-                   SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as successful,
-                   SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed,
-                   AVG(download_time) as avg_time,
-                   SUM(file_size) as total_size
-                   FROM downloads WHERE user_id = ?""",
-                (telegram_id,)
-            )
-            download_stats = download_result.fetchone()
+            download_stats = (await session.execute(
+                select(
+                    func.count().label('total'),
+                    func.sum(case((Download.status == 'completed', 1), else_=0)).label('successful'),
+                    func.sum(case((Download.status == 'failed', 1), else_=0)).label('failed'),
+                    func.avg(Download.download_time).label('avg_time'),
+                    func.sum(Download.file_size).label('total_size')
+                ).where(Download.user_id == telegram_id)
+            )).one()
             
             return {
-                'user_info': dict(zip(user_data.keys(), user_data)),
-                'download_stats': dict(zip(download_stats.keys(), download_stats)) if download_stats else {}
+                'user_info': {column.key: getattr(user, column.key) for column in User.__table__.columns},
+                'download_stats': dict(download_stats._mapping)
             }
     
-    # === إدارة التنزيلات ===
-    
-    async def create_download(self, user_id: int, url: str, **kwargs) -> int:
-        """إنشاء سجل تنزيل جديد"""
-        async with await self.get_session() as session:
-            download_data = {
-                'user_id': user_id,
-                'url': url,
-                'status': kwargs.get('status', 'pending'),
-                'created_at': datetime.utcnow(),
-                'metadata': json.dumps(kwargs.get('metadata', {}))
-            }
-            
-            result = await session.execute(
-                """INSERT INTO downloads (user_id, url, status, created_at, metadata) 
-                   VALUES (?, ?, ?, ?, ?)""",
-                tuple(download_data.values())
-            )
-            
-            download_id = result.lastrowid
-            await session.commit()
-            
-            return download_id
-    
-    async def update_download(self, download_id: int, **kwargs):
-        """تحديث سجل التنزيل"""
-        async with await self.get_session() as session:
-            # معالجة خاصة للـ metadata
-            if 'metadata' in kwargs:
-                kwargs['metadata'] = json.dumps(kwargs['metadata'])
-            
-            set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
-            values = list(kwargs.values()) + [download_id]
-            
-            await session.execute(
-                f"UPDATE downloads SET {set_clause} WHERE id = ?",
-                values
-            )
-            await session.commit()
-    
-    async def get_user_downloads(self, user_id: int, limit: int = 10) -> List[Dict]:
-        """الحصول على تنزيلات المستخدم"""
-        async with await self.get_session() as session:
-            result = await session.execute(
-                """SELECT * FROM downloads WHERE user_id = ? 
-                   ORDER BY created_at DESC LIMIT ?""",
-                (user_id, limit)
-            )
-            
-            downloads = []
-            for row in result.fetchall():
-                download = dict(zip(row.keys(), row))
-                if download.get('metadata'):
-                    download['metadata'] = json.loads(download['metadata'])
-                downloads.append(download)
-            
-            return downloads
+    # === إحصائيات التنزيلات ===
     
     async def get_download_stats(self) -> Dict:
         """الحصول على إحصائيات التنزيلات العامة"""
         async with await self.get_session() as session:
-            result = await session.execute(
-                """SELECT 
-                   COUNT(*) as total,
-                   SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as successful,
-                   SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed,
-                   SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
-                   AVG(download_time) as avg_time,
-                   SUM(file_size) as total_size
-                   FROM downloads"""
-            )
-            
-            stats = result.fetchone()
-            return dict(zip(stats.keys(), stats)) if stats else {}
+            stats = (await session.execute(
+                select(
+                    func.count().label('total'),
+                    func.sum(case((Download.status == 'completed', 1), else_=0)).label('successful'),
+                    func.sum(case((Download.status == 'failed', 1), else_=0)).label('failed'),
+                    func.sum(case((Download.status == 'pending', 1), else_=0)).label('pending'),
+                    func.avg(Download.download_time).label('avg_time'),
+                    func.sum(Download.file_size).label('total_size')
+                )
+            )).one()
+            return dict(stats._mapping)
     
     # === إدارة السجلات ===
     
     async def log_event(self, level: str, message: str, module: str = None, 
                        user_id: int = None, **metadata):
         """تسجيل حدث في قاعدة البيانات"""
-        async with await self.get_session() as session:
-            await session.execute(
-                """INSERT INTO system_logs (level, message, module, user_id, timestamp, metadata) 
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (level, message, module, user_id, datetime.utcnow(), json.dumps(metadata))
-            )
+        async with await self.get_session() as session, self._writer():
+            session.add(SystemLog(level=level, message=message, module=module,
+                                  user_id=user_id, meta=metadata))
             await session.commit()
     
     async def log_security_event(self, user_id: int, event_type: str, severity: str,
                                 description: str, **kwargs):
         """تسجيل حدث أمني"""
-        async with await self.get_session() as session:
-            await session.execute(
-                """INSERT INTO security_events 
-                   (user_id, event_type, severity, description, ip_address, user_agent, timestamp, metadata) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                (user_id, event_type, severity, description,
-                 kwargs.get('ip_address'), kwargs.get('user_agent'),
-                 datetime.utcnow(), json.dumps(kwargs.get('metadata', {})))
-            )
+        async with await self.get_session() as session, self._writer():
+            session.add(SecurityEvent(
+                user_id=user_id, event_type=event_type, severity=severity,
+                description=description, ip_address=kwargs.get('ip_address'),
+                user_agent=kwargs.get('user_agent'), meta=kwargs.get('metadata', {})
+            ))
             await session.commit()
     
     async def get_recent_logs(self, level: str = None, limit: int = 100) -> List[Dict]:
         """الحصول على السجلات الحديثة"""
+        query = select(SystemLog)
+        if level:
+            query = query.where(SystemLog.level == level)
+        query = query.order_by(SystemLog.timestamp.desc()).limit(limit)
+        
         async with await self.get_session() as session:
-            query = "SELECT * FROM system_logs"
-            params = []
-            
-            if level:
-                query += " WHERE level = ?"
-                params.append(level)
-            
-            query += " ORDER BY timestamp DESC LIMIT ?"
-            params.append(limit)
-            
-            result = await session.execute(query, params)
-            
-            logs = []
-            for row in result.fetchall():
-                log = dict(zip(row.keys(), row))
-                if log.get('metadata'):
-                    log['metadata'] = json.loads(log['metadata'])
-                logs.append(log)
-            
-            return logs
+            logs = await session.scalars(query)
+            return [{
+                'id': log.id,
+                'level': log.level,
+                'message': log.message,
+                'module': log.module,
+                'user_id': log.user_id,
+                'timestamp': log.timestamp,
+                'metadata': log.meta or {}
+            } for log in logs]
     
     # === إدارة الكاش ===
     
     async def set_cache(self, key: str, value: str, ttl: int = 3600):
         """حفظ قيمة في الكاش"""
-        async with await self.get_session() as session:
-            expires_at = datetime.utcnow() + timedelta(seconds=ttl)
-            
-            # محاولة التحديث أولاً
-            result = await session.execute(
-                """UPDATE cache_entries SET value = ?, expires_at = ?, access_count = 0, last_accessed = ?
-                   WHERE key = ?""",
-                (value, expires_at, datetime.utcnow(), key)
-            )
-            
-            # إذا لم يتم التحديث، أدخل سجل جديد
-            if result.rowcount == 0:
-                await session.execute(
-                    """INSERT INTO cache_entries (key, value, expires_at, created_at, last_accessed) 
-                       VALUES (?, ?, ?, ?, ?)""",
-                    (key, value, expires_at, datetime.utcnow(), datetime.utcnow())
-                )
+        async with await self.get_session() as session, self._writer():
+            now = datetime.utcnow()
+            expires_at = now + timedelta(seconds=ttl)
+            
+            entry = await session.scalar(select(CacheEntry).where(CacheEntry.key == key))
+            if entry:
+                entry.value = value
+                entry.expires_at = expires_at
+                entry.access_count = 0
+                entry.last_accessed = now
+            else:
+                session.add(CacheEntry(key=key, value=value, expires_at=expires_at,
+                                       created_at=now, last_accessed=now))
             
             await session.commit()
     
     async def get_cache(self, key: str) -> Optional[str]:
         """الحصول على قيمة من الكاش"""
-        async with await self.get_session() as session:
-            result = await session.execute(
-                "SELECT value, expires_at FROM cache_entries WHERE key = ?",
-                (key,)
-            )
-            
-            row = result.fetchone()
-            if not row:
+        async with await self.get_session() as session, self._writer():
+            entry = await session.scalar(select(CacheEntry).where(CacheEntry.key == key))
+            if not entry:
                 return None
             
-            value, expires_at = row
-            
             # فحص انتهاء الصلاحية
-            if datetime.utcnow() > expires_at:
-                await session.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            if datetime.utcnow() > entry.expires_at:
+                await session.delete(entry)
                 await session.commit()
                 return None
             
             # تحديث عداد الوصول
-            await session.execute(
-                "UPDATE cache_entries SET access_count = access_count + 1, last_accessed = ? WHERE key = ?",
-                (datetime.utcnow(), key)
-            )
+            entry.access_count = (entry.access_count or 0) + 1
+            entry.last_accessed = datetime.utcnow()
             await session.commit()
             
-            return value
+            return entry.value
     
     async def delete_cache(self, key: str):
         """حذف قيمة من الكاش"""
-        async with await self.get_session() as session:
-            await session.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        async with await self.get_session() as session, self._writer():
+            await session.execute(delete(CacheEntry).where(CacheEntry.key == key))
             await session.commit()
     
     async def cleanup_expired_cache(self):
         """تنظيف الكاش المنتهي الصلاحية"""
-        async with await self.get_session() as session:
+        async with await self.get_session() as session, self._writer():
             result = await session.execute(
-                "DELETE FROM cache_entries WHERE expires_at < ?",
-                (datetime.utcnow(),)
+                delete(CacheEntry).where(CacheEntry.expires_at < datetime.utcnow())
             )
             deleted_count = result.rowcount
             await session.commit()
@@ -489,65 +491,66 @@ class DatabaseManager:
     
     async def get_system_stats(self) -> Dict:
         """الحصول على إحصائيات النظام"""
+        day_ago = datetime.utcnow() - timedelta(days=1)
         async with await self.get_session() as session:
-            stats = {}
-            
             # إحصائيات المستخدمين
-            user_result = await session.execute(
-                """SELECT 
-                   COUNT(*) as total_users,
-                   SUM(CASE WHEN is_banned = 1 THEN 1 ELSE 0 END) as banned_users,
-                   SUM(CASE WHEN last_activity > datetime('now', '-1 day') THEN 1 ELSE 0 END) as active_24h
-                   FROM users"""
-            )
-            stats['users'] = dict(zip(user_result.fetchone().keys(), user_result.fetchone()))
+            users = (await session.execute(
+                select(
+                    func.count().label('total_users'),
+                    func.sum(case((User.is_banned.is_(True), 1), else_=0)).label('banned_users'),
+                    func.sum(case((User.last_activity > day_ago, 1), else_=0)).label('active_24h')
+                )
+            )).one()
             
             # إحصائيات التنزيلات
-            download_result = await session.execute(
-                """SELECT 
-                   COUNT(*) as total_downloads,
-                   SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as successful,
-                   SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed,
-                   AVG(download_time) as avg_time
-                   FROM downloads"""
-            )
-            stats['downloads'] = dict(zip(download_result.fetchone().keys(), download_result.fetchone()))
+            downloads = (await session.execute(
+                select(
+                    func.count().label('total_downloads'),
+                    func.sum(case((Download.status == 'completed', 1), else_=0)).label('successful'),
+                    func.sum(case((Download.status == 'failed', 1), else_=0)).label('failed'),
+                    func.avg(Download.download_time).label('avg_time')
+                )
+            )).one()
             
             # إحصائيات الأمان
-            security_result = await session.execute(
-                """SELECT 
-                   COUNT(*) as total_events,
-                   SUM(CASE WHEN severity = 'critical' THEN 1 ELSE 0 END) as critical_events,
-                   SUM(CASE WHEN timestamp > datetime('now', '-1 day') THEN 1 ELSE 0 END) as recent_events
-                   FROM security_events"""
-            )
-            stats['security'] = dict(zip(security_result.fetchone().keys(), security_result.fetchone()))
+            security = (await session.execute(
+                select(
+                    func.count().label('total_events'),
+                    func.sum(case((SecurityEvent.severity == 'critical', 1), else_=0)).label('critical_events'),
+                    func.sum(case((SecurityEvent.timestamp > day_ago, 1), else_=0)).label('recent_events')
+                )
+            )).one()
             
-            return stats
+            return {
+                'users': dict(users._mapping),
+                'downloads': dict(downloads._mapping),
+                'security': dict(security._mapping)
+            }
     
     async def cleanup_old_data(self, days: int = 30):
         """تنظيف البيانات القديمة"""
-        async with await self.get_session() as session:
+        async with await self.get_session() as session, self._writer():
             cutoff_date = datetime.utcnow() - timedelta(days=days)
             
             # حذف السجلات القديمة
             logs_result = await session.execute(
-                "DELETE FROM system_logs WHERE timestamp < ?",
-                (cutoff_date,)
+                delete(SystemLog).where(SystemLog.timestamp < cutoff_date)
             )
             
             # حذف الأحداث الأمنية القديمة
             security_result = await session.execute(
-                "DELETE FROM security_events WHERE timestamp < ?",
-                (cutoff_date,)
+                delete(SecurityEvent).where(SecurityEvent.timestamp < cutoff_date)
             )
             
             # حذف التنزيلات القديمة المكتملة
             downloads_result = await session.execute(
-                "DELETE FROM downloads WHERE completed_at < ? AND status = 'completed'",
-                (cutoff_date,)
+                delete(Download).where(Download.end_time < cutoff_date, Download.status == 'completed')
             )
             
+            # الحاويات اليومية الأقدم من أطول نافذة تعرضها اللوحات (الإجماليات لا تُحذف)
+            daily_cutoff = datetime.utcnow().date() - timedelta(days=config.Config.STATS_DAILY_RETENTION_DAYS)
+            await session.execute(delete(DailyStats).where(DailyStats.day < daily_cutoff))
+            
             await session.commit()
             
             logger.info(f"🧹 تم تنظيف البيانات القديمة: "
@@ -0,0 +1,325 @@
+"""
+تسليم الأرشيفات للمستخدم ضمن حد رفع تيليجرام
+Archive Delivery (size check, split volumes, concurrent part uploads, file_id reuse)
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from telegram.error import BadRequest, NetworkError
+
+from utils.logger import logger
+import config
+
+class DeliveryError(Exception):
+    """تعذر تسليم الأرشيف بعد كل المحاولات (الأرشيف يبقى على القرص)"""
+
+class FileIdStore:
+    """معرفات ملفات تيليجرام (file_id) للأرشيفات المرسلة سابقاً
+
+    المفتاح إما بصمة محتوى الأرشيف (دائم) أو الرابط مع خيارات التنزيل (له
+    مدة صلاحية لأن الموقع يتغير). القيمة قائمة file_id بترتيب الأجزاء.
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS file_ids (
+        key TEXT PRIMARY KEY,
+        file_ids TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        hits INTEGER DEFAULT 0
+    );
+    """
+
+    def __init__(self, path: str = None, url_ttl: float = None):
+        self.path = path or config.Config.FILE_ID_DB_PATH
+        self.url_ttl = url_ttl or config.Config.FILE_ID_URL_TTL
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """فتح قاعدة البيانات"""
+        if self._conn:
+            return
+        await asyncio.to_thread(self._open)
+
+    async def stop(self):
+        """إغلاق قاعدة البيانات"""
+        if self._conn:
+            async with self._lock:
+                await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._SCHEMA)
+
+    async def _run(self, func, *args):
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        """file_id المحفوظة للمفتاح (None إذا غير موجودة أو انتهت صلاحية مفتاح الرابط)"""
+        if not self._conn or not key:
+            return None
+
+        def fetch():
+            row = self._conn.execute("SELECT file_ids, created_at FROM file_ids WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if key.startswith("url:") and time.time() - row[1] > self.url_ttl:
+                return None
+            self._conn.execute("UPDATE file_ids SET hits = hits + 1 WHERE key = ?", (key,))
+            return json.loads(row[0])
+        return await self._run(fetch)
+
+    async def put(self, keys: List[str], file_ids: List[str]):
+        """حفظ نفس file_id تحت عدة مفاتيح"""
+        if not self._conn:
+            return
+        now = time.time()
+        value = json.dumps(file_ids)
+        await self._run(
+            self._conn.executemany,
+            "INSERT OR REPLACE INTO file_ids (key, file_ids, created_at) VALUES (?, ?, ?)",
+            [(key, value, now) for key in keys if key]
+        )
+
+    async def forget(self, *keys: str):
+        """حذف مفاتيح أصبحت file_id الخاصة بها غير صالحة"""
+        if not self._conn:
+            return
+        await self._run(self._conn.executemany, "DELETE FROM file_ids WHERE key = ?",
+                        [(key,) for key in keys if key])
+
+def url_cache_key(url: str, options: Dict = None) -> str:
+    """مفتاح الرابط مع خيارات التنزيل (أرشيف بحصة مختلفة ليس نفس الأرشيف)"""
+    return f"url:{url.strip()}|{json.dumps(options or {}, sort_keys=True)}"
+
+def content_hash(path: str) -> str:
+    """بصمة SHA-256 لمحتوى الأرشيف (متزامنة)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+class ArchiveDelivery:
+    """إرسال أرشيف كملف واحد أو كأجزاء مرقمة إذا تجاوز حد الرفع
+
+    الأجزاء تقسيم ثنائي للـ ZIP (site.zip.001، site.zip.002، ...) يُجمع بـ
+    `cat site.zip.* > site.zip` أو 7-Zip، وتُنشأ بجانب الأرشيف فيحذفها
+    التنظيف الدوري معه. كل جزء يُرفع بمحاولات مستقلة، وعدة أجزاء بالتوازي.
+
+    file_id التي يعيدها تيليجرام تُحفظ ببصمة المحتوى وبالرابط، فالأرشيف
+    المرسل سابقاً يُعاد إرساله بمعرفه دون رفع، وطلب نفس الرابط لاحقاً يُخدم
+    دون زحف (deliver_cached).
+
+    مع خادم Bot API محلي (local_mode) يُمرر مسار الملف فيقرؤه الخادم من القرص
+    مباشرة بدلاً من رفع محتواه عبر HTTP؛ يجب أن يرى الخادم نفس مجلد التنزيلات.
+    """
+
+    def __init__(self, upload_limit: int = None, part_size: int = None,
+                 concurrency: int = None, max_retries: int = None, store: FileIdStore = None,
+                 local_mode: bool = None):
+        self.upload_limit = upload_limit or config.Config.TELEGRAM_UPLOAD_LIMIT
+        self.part_size = min(part_size or config.Config.DELIVERY_PART_SIZE, self.upload_limit)
+        self.concurrency = concurrency or config.Config.DELIVERY_CONCURRENCY
+        self.max_retries = config.Config.DELIVERY_MAX_RETRIES if max_retries is None else max_retries
+        self.store = store
+        self.local_mode = config.Config.TELEGRAM_LOCAL_MODE if local_mode is None else local_mode
+        self.stats = {'archives': 0, 'split_archives': 0, 'parts': 0, 'retries': 0, 'failures': 0,
+                      'reused': 0}
+
+    async def start(self):
+        """فتح مخزن file_id"""
+        if self.store:
+            await self.store.start()
+
+    async def stop(self):
+        """إغلاق مخزن file_id"""
+        if self.store:
+            await self.store.stop()
+
+    def part_count(self, path: str) -> int:
+        """عدد الرسائل اللازمة للأرشيف (قبل أي رفع)"""
+        size = os.path.getsize(path)
+        return 1 if size <= self.upload_limit else math.ceil(size / self.part_size)
+
+    def split(self, path: str) -> List[str]:
+        """تقسيم الأرشيف لأجزاء مرقمة (متزامنة؛ الأجزاء الموجودة مسبقاً تُعاد استخدامها)"""
+        size = os.path.getsize(path)
+        count = math.ceil(size / self.part_size)
+        parts = [f"{path}.{index:03d}" for index in range(1, count + 1)]
+
+        # أرشيف مشترك بين طلبات مدمجة قد قُسم من قبل
+        expected = [min(self.part_size, size - i * self.part_size) for i in range(count)]
+        if all(os.path.exists(p) and os.path.getsize(p) == n for p, n in zip(parts, expected)):
+            return parts
+
+        with open(path, 'rb') as source:
+            for part in parts:
+                with open(part, 'wb') as target:
+                    remaining = self.part_size
+                    while remaining:
+                        chunk = source.read(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        remaining -= len(chunk)
+        return parts
+
+    @staticmethod
+    def _part_caption(index: int, total: int, caption: Optional[str]) -> Optional[str]:
+        """التعليق ولوحة الأزرار مع الجزء الأخير فقط"""
+        if total == 1:
+            return caption
+        part_caption = f"📦 الجزء {index}/{total}"
+        if index == total and caption:
+            part_caption = f"{caption}\n\n{part_caption}"
+        return part_caption
+
+    async def deliver_cached(self, bot, chat_id: int, url_key: str, caption: str = None,
+                             parse_mode: str = 'Markdown', reply_markup=None) -> Optional[List]:
+        """إرسال أرشيف سابق لنفس الرابط بمعرفاته (بدون زحف ولا رفع)؛ None إذا غير متوفر"""
+        file_ids = await self.store.get(url_key) if self.store else None
+        if not file_ids:
+            return None
+
+        messages = await self._send_file_ids(bot, chat_id, file_ids, caption, parse_mode, reply_markup)
+        if messages is None:
+            await self.store.forget(url_key)
+        return messages
+
+    async def deliver(self, bot, chat_id: int, path: str, filename: str, caption: str = None,
+                      parse_mode: str = 'Markdown', reply_markup=None, url_key: str = None) -> List:
+        """إرسال الأرشيف وإرجاع رسائل تيليجرام المرسلة"""
+        self.stats['archives'] += 1
+
+        # أرشيف بنفس المحتوى أُرسل سابقاً (موقع لم يتغير): إعادة الإرسال بالمعرف
+        hash_key = await asyncio.to_thread(content_hash, path) if self.store else None
+        file_ids = await self.store.get(hash_key) if hash_key else None
+        if file_ids:
+            messages = await self._send_file_ids(bot, chat_id, file_ids, caption, parse_mode, reply_markup)
+            if messages is not None:
+                await self.store.put([url_key], file_ids)
+                return messages
+            await self.store.forget(hash_key)
+
+        messages = await self._upload(bot, chat_id, path, filename, caption, parse_mode, reply_markup)
+
+        if self.store:
+            file_ids = [message.document.file_id for message in messages]
+            await self.store.put([hash_key, url_key], file_ids)
+        return messages
+
+    async def _upload(self, bot, chat_id: int, path: str, filename: str, caption: str,
+                      parse_mode: str, reply_markup) -> List:
+        if self.part_count(path) == 1:
+            message = await self._send_part(bot, chat_id, path, filename, caption, parse_mode, reply_markup)
+            return [message]
+
+        self.stats['split_archives'] += 1
+        parts = await asyncio.to_thread(self.split, path)
+        total = len(parts)
+        logger.info(f"✂️ تقسيم {filename} إلى {total} أجزاء للإرسال")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(index: int, part: str):
+            async with semaphore:
+                return await self._send_part(
+                    bot, chat_id, part, f"{filename}.{index:03d}", self._part_caption(index, total, caption),
+                    parse_mode, reply_markup if index == total else None
+                )
+
+        tasks = [asyncio.create_task(send(i, part)) for i, part in enumerate(parts, 1)]
+        try:
+            return list(await asyncio.gather(*tasks))
+        finally:
+            # فشل جزء يعني فشل التسليم: إيقاف رفع بقية الأجزاء بدلاً من إكمالها في الخلفية
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send_file_ids(self, bot, chat_id: int, file_ids: List[str], caption: str,
+                             parse_mode: str, reply_markup) -> Optional[List]:
+        """إعادة إرسال ملفات بمعرفاتها؛ None إذا رفض تيليجرام المعرف"""
+        total = len(file_ids)
+        messages = []
+        try:
+            for index, file_id in enumerate(file_ids, 1):
+                messages.append(await bot.send_document(
+                    chat_id=chat_id,
+                    document=file_id,
+                    caption=self._part_caption(index, total, caption),
+                    parse_mode=parse_mode,
+                    reply_markup=reply_markup if index == total else None
+                ))
+        except BadRequest as e:
+            logger.warning(f"⚠️ معرف ملف غير صالح، إعادة الرفع: {e}")
+            return None
+
+        self.stats['reused'] += 1
+        return messages
+
+    async def _send_part(self, bot, chat_id: int, path: str, filename: str, caption: str,
+                         parse_mode: str, reply_markup):
+        """رفع ملف واحد مع إعادة المحاولة عند أخطاء الشبكة والمهلات"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.local_mode:
+                    # يصبح file:// فلا يُقرأ الملف في هذه العملية (الاسم من اسم الملف على القرص)
+                    message = await bot.send_document(
+                        chat_id=chat_id,
+                        document=Path(path),
+                        caption=caption,
+                        parse_mode=parse_mode,
+                        reply_markup=reply_markup
+                    )
+                else:
+                    with open(path, 'rb') as file:
+                        message = await bot.send_document(
+                            chat_id=chat_id,
+                            document=file,
+                            filename=filename,
+                            caption=caption,
+                            parse_mode=parse_mode,
+                            reply_markup=reply_markup,
+                            write_timeout=config.Config.DELIVERY_UPLOAD_TIMEOUT,
+                            read_timeout=config.Config.DELIVERY_UPLOAD_TIMEOUT
+                        )
+                self.stats['parts'] += 1
+                return message
+            except BadRequest as e:
+                # طلب مرفوض (ليس خطأ شبكة) لن ينجح بإعادته
+                self.stats['failures'] += 1
+                raise DeliveryError(f"تعذر رفع {filename}: {e}") from e
+            except NetworkError as e:
+                # NetworkError يشمل TimedOut؛ RetryAfter يعالجه محدد المعدل
+                if attempt >= self.max_retries:
+                    self.stats['failures'] += 1
+                    raise DeliveryError(f"تعذر رفع {filename}: {e}") from e
+                self.stats['retries'] += 1
+                delay = 2 ** attempt
+                logger.warning(f"🔄 إعادة رفع {filename} بعد {delay} ثانية: {e}")
+                await asyncio.sleep(delay)
+
+    def get_stats(self):
+        """إحصائيات التسليم"""
+        return dict(self.stats)
+
+# إنشاء مثيل عام للاستخدام
+archive_delivery = ArchiveDelivery(store=FileIdStore())
@@ -1,5 +1,6 @@
 import asyncio
 import aiohttp
+import copy
 import aiofiles
 import os
 import hashlib
@@ -11,9 +12,10 @@ from playwright.async_api import async_playwright
 from pathlib import Path
 import magic
 from datetime import datetime, timedelta
-import psutil
 import gc
+import time
 import weakref
+from dataclasses import dataclass, field
 from typing import Dict, Optional, Callable, Any
 
 # استيرادات مطلقة بدلاً من نسبية
@@ -21,8 +23,77 @@ from utils.logger import logger
 from utils.helpers import sanitize_filename, human_readable_size
 from services.cache_manager import cache_manager
 from services.security_manager import security_manager
+from services.memory_governor import memory_governor
+from services.autoscaler import autoscaler
 import config
 
+class QuotaExceeded(Exception):
+    """تجاوز حصة الموارد المخصصة لمهمة التنزيل"""
+    
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+@dataclass
+class DownloadQuota:
+    """حصة الموارد لمهمة تنزيل واحدة (صفحات، بايتات، موارد لكل صفحة، وقت، حجم ملف)"""
+    max_pages: int = field(default_factory=lambda: config.Config.QUOTA_MAX_PAGES)
+    max_bytes: int = field(default_factory=lambda: config.Config.MAX_WEBSITE_SIZE)
+    max_assets_per_page: int = field(default_factory=lambda: config.Config.QUOTA_MAX_ASSETS_PER_PAGE)
+    max_wall_time: float = field(default_factory=lambda: config.Config.DOWNLOAD_TIMEOUT)
+    max_file_size: int = field(default_factory=lambda: config.Config.MAX_FILE_SIZE)
+    
+    # الاستهلاك الحالي
+    pages_used: int = 0
+    bytes_used: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    exceeded: Optional[str] = None
+    
+    @property
+    def elapsed(self) -> float:
+        """الوقت المنقضي منذ بدء المهمة بالثواني"""
+        return time.monotonic() - self.started_at
+    
+    @property
+    def remaining_time(self) -> float:
+        """الوقت المتبقي قبل تجاوز حد الوقت"""
+        return max(0.0, self.max_wall_time - self.elapsed)
+    
+    @property
+    def remaining_bytes(self) -> int:
+        """البايتات المتبقية في الحصة"""
+        return max(0, self.max_bytes - self.bytes_used)
+    
+    def trip(self, reason: str):
+        """تسجيل تجاوز الحصة ورفع الاستثناء"""
+        if not self.exceeded:
+            self.exceeded = reason
+        raise QuotaExceeded(self.exceeded)
+    
+    def check(self):
+        """فحص الحصة قبل أي عملية جلب جديدة"""
+        if self.exceeded:
+            raise QuotaExceeded(self.exceeded)
+        if self.elapsed >= self.max_wall_time:
+            self.trip("wall_time")
+        if self.bytes_used >= self.max_bytes:
+            self.trip("max_bytes")
+    
+    def charge_page(self):
+        """حجز صفحة جديدة من الحصة"""
+        self.check()
+        if self.pages_used >= self.max_pages:
+            self.trip("max_pages")
+        self.pages_used += 1
+    
+    def charge_bytes(self, size: int):
+        """خصم بايتات من الحصة"""
+        self.bytes_used += size
+    
+    def timeout_ms(self, default_ms: int) -> int:
+        """مهلة Playwright مقيدة بالوقت المتبقي"""
+        return max(1000, min(default_ms, int(self.remaining_time * 1000)))
+
 class WebsiteDownloader:
     def __init__(self):
         self.playwright = None
@@ -193,18 +264,37 @@ class WebsiteDownloader:
         return context
     
     async def _check_memory_usage(self):
-        """فحص استهلاك الذاكرة"""
-        process = psutil.Process()
-        memory_info = process.memory_info()
-        memory_mb = memory_info.rss / 1024 / 1024
-        
-        if memory_mb > self.memory_limit:
-            logger.warning(f"⚠️ استهلاك ذاكرة عالي: {memory_mb:.1f}MB")
-            # تشغيل جامع القمامة
-            gc.collect()
+        """فحص ضغط الذاكرة من منظم الذاكرة (بدون قراءة RSS في المسار الساخن)"""
+        if memory_governor.is_critical():
+            logger.warning(f"⚠️ ضغط ذاكرة حرج: {memory_governor.total_rss_mb:.1f}MB")
             return False
         return True
     
+    async def _acquire_page_slot(self, quota: DownloadQuota):
+        """انتظار سماح منظم الذاكرة بصفحة جديدة ضمن الوقت المتبقي للمهمة"""
+        try:
+            await memory_governor.acquire_page(timeout=quota.remaining_time)
+        except asyncio.TimeoutError:
+            quota.trip("memory_pressure")
+    
+    def fork(self, progress_callback: Optional[Callable] = None) -> 'WebsiteDownloader':
+        """نسخة خفيفة لمهمة واحدة: تشارك المتصفح والجلسة ومجموعة السياقات
+        
+        العدادات والملفات المنزلة وإشارة الإلغاء ودالة التقدم خاصة بالنسخة، لذا
+        يمكن تشغيل عدة مهام متزامنة على نفس المحرك. لا تُغلق النسخة بـ close().
+        """
+        job = copy.copy(self)
+        job.reset_state()
+        job.progress_callback = progress_callback
+        return job
+    
+    def reset_state(self):
+        """إعادة تعيين عدادات التنزيل قبل مهمة جديدة على نفس المحرك"""
+        self.downloaded_files = set()
+        self.total_size = 0
+        self.total_files = 0
+        self.cancel_event = asyncio.Event()
+    
     def set_progress_callback(self, callback: Callable[[float, str], None]):
         """تعيين دالة تحديث التقدم"""
         self.progress_callback = callback
@@ -221,8 +311,12 @@ class WebsiteDownloader:
             except Exception as e:
                 logger.error(f"خطأ في تحديث التقدم: {e}")
     
-    async def download_website(self, url, output_dir, max_depth=2, max_size=50*1024*1024, user_id=None):
-        """تنزيل الموقع بالكامل مع دعم الكاش والأمان"""
+    async def download_website(self, url, output_dir, max_depth=2, max_size=50*1024*1024, user_id=None,
+                               quota: Optional[DownloadQuota] = None):
+        """تنزيل الموقع بالكامل مع دعم الكاش والأمان ضمن حصة موارد المهمة"""
+        if quota is None:
+            quota = DownloadQuota(max_bytes=max_size)
+        
         try:
             # فحص الأمان
             if user_id:
@@ -251,46 +345,52 @@ class WebsiteDownloader:
             
             await self._update_progress(10.0, "تنزيل الصفحة الرئيسية...")
             
-            # تنزيل الصفحة الرئيسية أولاً
-            main_page_path = await self.download_page(url, domain_dir, base_url)
-            
-            if main_page_path:
-                await self._update_progress(30.0, "استخراج الروابط...")
-                
-                # استخراج الروابط من الصفحة الرئيسية
-                links = await self.extract_links(url, domain_dir, base_url)
-                
-                # تنزيل الروابط الداخلية
-                total_links = min(len(links), 10)  # حد 10 صفحات للبداية
+            try:
+                # تنزيل الصفحة الرئيسية أولاً
+                main_page_path = await self.download_page(url, domain_dir, base_url, quota)
                 
-                for i, link in enumerate(links[:total_links]):
-                    if self.cancel_event.is_set():
-                        logger.info("🚫 تم إلغاء التنزيل")
-                        break
+                if main_page_path:
+                    await self._update_progress(30.0, "استخراج الروابط...")
+                    
+                    # استخراج الروابط من الصفحة الرئيسية
+                    links = await self.extract_links(url, domain_dir, base_url, quota)
                     
-                    if self.total_size < max_size:
+                    # تنزيل الروابط الداخلية ضمن حد الصفحات
+                    total_links = min(len(links), max(0, quota.max_pages - quota.pages_used))
+                    
+                    for i, link in enumerate(links[:total_links]):
+                        if self.cancel_event.is_set():
+                            logger.info("🚫 تم إلغاء التنزيل")
+                            break
+                        
                         progress = 30 + (i / total_links) * 60
                         await self._update_progress(progress, f"تنزيل الصفحة {i+1}/{total_links}...")
-                        await self.download_page(link, domain_dir, base_url)
+                        await self.download_page(link, domain_dir, base_url, quota)
                         
                         # فحص استهلاك الذاكرة
                         if not await self._check_memory_usage():
                             logger.warning("⚠️ تم إيقاف التنزيل بسبب استهلاك الذاكرة")
                             break
             
+            except QuotaExceeded as e:
+                # إكمال أرشيف جزئي بما تم تنزيله بدلاً من إهدار العمل
+                logger.warning(f"⚠️ تم بلوغ حصة الموارد ({e.reason}) للموقع {url} - إنشاء أرشيف جزئي")
+                await self._update_progress(90.0, f"تم بلوغ حد الموارد ({e.reason})، إنشاء أرشيف جزئي...")
+            
             await self._update_progress(90.0, "إنشاء الأرشيف...")
             
             # إنشاء ملف ZIP
             zip_path = await self._create_zip_archive(domain_dir)
             
-            # حفظ في الكاش
-            cache_data = {
-                'path': zip_path,
-                'files': self.total_files,
-                'size': self.total_size,
-                'created_at': datetime.utcnow().isoformat()
-            }
-            await cache_manager.set(cache_key, cache_data, ttl=3600)  # كاش لساعة واحدة
+            # حفظ في الكاش (الأرشيفات الجزئية لا تُخزن)
+            if not quota.exceeded:
+                cache_data = {
+                    'path': zip_path,
+                    'files': self.total_files,
+                    'size': self.total_size,
+                    'created_at': datetime.utcnow().isoformat()
+                }
+                await cache_manager.set(cache_key, cache_data, ttl=3600)  # كاش لساعة واحدة
             
             await self._update_progress(100.0, "تم إكمال التنزيل بنجاح")
             
@@ -301,29 +401,56 @@ class WebsiteDownloader:
             await self._update_progress(0.0, f"خطأ: {str(e)}")
             raise
     
-    async def download_page(self, url, output_dir, base_url):
+    async def salvage_partial(self, url, output_dir):
+        """أرشفة ما نُزّل من الموقع بعد إيقاف الزحف قسرياً؛ None إذا لم يُنزل شيء"""
+        domain_dir = os.path.join(output_dir, sanitize_filename(urlparse(url).netloc))
+        if not os.path.isdir(domain_dir) or not any(files for _, _, files in os.walk(domain_dir)):
+            return None
+        
+        zip_path = await self._create_zip_archive(domain_dir)
+        return zip_path, self.total_files, self.total_size
+    
+    async def download_page(self, url, output_dir, base_url, quota: Optional[DownloadQuota] = None):
         """تنزيل صفحة فردية مع إدارة محسنة للذاكرة"""
+        page = None
+        slot_acquired = False
         try:
             if url in self.downloaded_files or self.cancel_event.is_set():
                 return None
+            
+            if quota is None:
+                quota = DownloadQuota()
+            
+            # حجز صفحة من حصة المهمة قبل أي جلب
+            quota.charge_page()
                 
             self.downloaded_files.add(url)
             
-            # الحصول على سياق من المجموعة
+            # الحصول على سياق من المجموعة بعد سماح منظم الذاكرة
+            await self._acquire_page_slot(quota)
+            slot_acquired = True
             context = await self._get_context()
             page = await context.new_page()
             
             try:
-                # تعيين مهلة أطول للصفحات الثقيلة
-                await page.goto(url, timeout=60000, wait_until='domcontentloaded')
+                render_started = time.monotonic()
+                
+                # تعيين مهلة أطول للصفحات الثقيلة (ضمن الوقت المتبقي للمهمة)
+                await page.goto(url, timeout=quota.timeout_ms(config.Config.PAGE_LOAD_TIMEOUT),
+                                wait_until='domcontentloaded')
                 
                 # انتظار تحميل الصفحة مع مهلة قصيرة
                 try:
-                    await page.wait_for_load_state('networkidle', timeout=15000)
+                    await page.wait_for_load_state(
+                        'networkidle', timeout=quota.timeout_ms(config.Config.NETWORK_IDLE_TIMEOUT)
+                    )
                 except Exception:
                     # المتابعة حتى لو لم تكتمل الشبكة
                     pass
                 
+                # زمن العرض إشارة لمتحكم التزامن
+                autoscaler.record_page_latency(time.monotonic() - render_started)
+                
                 # تحسين الصفحة وتقليل حجمها
                 await page.evaluate("""() => {
                     // حذف العناصر غير الضرورية
@@ -377,6 +504,14 @@ class WebsiteDownloader:
             if len(content) > 1024 * 1024:  # 1MB
                 content = await self._compress_html(content)
             
+            # الصفحة الواحدة تخضع لحد حجم الملف والبايتات المتبقية
+            content_size = len(content.encode('utf-8'))
+            if content_size > quota.max_file_size:
+                logger.warning(f"⏭️ تخطي صفحة أكبر من حد الملف: {url} ({human_readable_size(content_size)})")
+                return None
+            if content_size > quota.remaining_bytes:
+                quota.trip("max_bytes")
+            
             async with aiofiles.open(filepath, 'w', encoding='utf-8') as f:
                 await f.write(content)
             
@@ -384,20 +519,35 @@ class WebsiteDownloader:
             file_size = os.path.getsize(filepath)
             self.total_size += file_size
             self.total_files += 1
+            quota.charge_bytes(file_size)
             
-            # استخراج وتنزيل الموارد المهمة فقط
-            await self.download_resources(content, output_dir, base_url)
-            
+            # إغلاق الصفحة قبل جلب الموارد لتحرير ذاكرة المتصفح
             await page.close()
+            page = None
+            await memory_governor.release_page()
+            slot_acquired = False
+            
+            # استخراج وتنزيل الموارد المهمة فقط
+            await self.download_resources(content, output_dir, base_url, quota)
             
             # فحص الذاكرة بعد كل صفحة
             await self._check_memory_usage()
             
             return filepath
             
+        except QuotaExceeded:
+            raise
         except Exception as e:
             logger.error(f"❌ خطأ في تنزيل الصفحة {url}: {e}")
             return None
+        finally:
+            if page:
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+            if slot_acquired:
+                await memory_governor.release_page()
     
     async def _compress_html(self, html_content: str) -> str:
         """ضغط محتوى HTML"""
@@ -442,42 +592,67 @@ class WebsiteDownloader:
             logger.error(f"❌ خطأ في إنشاء الأرشيف: {e}")
             return directory_path
     
-    async def download_resources(self, html_content, output_dir, base_url):
-        """تنزيل الموارد المرتبطة بالصفحة"""
+    async def download_resources(self, html_content, output_dir, base_url, quota: Optional[DownloadQuota] = None):
+        """تنزيل الموارد المرتبطة بالصفحة ضمن حد الموارد لكل صفحة"""
+        if quota is None:
+            quota = DownloadQuota()
+        
         soup = BeautifulSoup(html_content, 'html.parser')
         
+        resources = []
+        
         # روابط CSS
         for link in soup.find_all('link', rel='stylesheet'):
             href = link.get('href')
             if href:
-                await self.download_resource(href, output_dir, base_url, 'css')
+                resources.append((href, 'css'))
         
         # سكريبتات JS
         for script in soup.find_all('script', src=True):
             src = script.get('src')
             if src:
-                await self.download_resource(src, output_dir, base_url, 'js')
+                resources.append((src, 'js'))
         
         # صور
         for img in soup.find_all('img', src=True):
             src = img.get('src')
             if src:
-                await self.download_resource(src, output_dir, base_url, 'images')
+                resources.append((src, 'images'))
+        
+        if len(resources) > quota.max_assets_per_page:
+            logger.debug(f"📉 تقليص موارد الصفحة من {len(resources)} إلى {quota.max_assets_per_page}")
+        
+        for resource_url, resource_type in resources[:quota.max_assets_per_page]:
+            await self.download_resource(resource_url, output_dir, base_url, resource_type, quota)
     
-    async def download_resource(self, resource_url, output_dir, base_url, resource_type):
-        """تنزيل مورد فردي"""
+    async def download_resource(self, resource_url, output_dir, base_url, resource_type,
+                                quota: Optional[DownloadQuota] = None):
+        """تنزيل مورد فردي مع احترام حد حجم الملف والبايتات المتبقية"""
+        if quota is None:
+            quota = DownloadQuota()
+        
+        filepath = None
         try:
             if not resource_url.startswith(('http', '//')):
                 resource_url = urljoin(base_url, resource_url)
             
             if resource_url in self.downloaded_files:
                 return
+            
+            quota.check()
                 
             self.downloaded_files.add(resource_url)
             
-            async with self.session.get(resource_url) as response:
+            request_timeout = aiohttp.ClientTimeout(total=max(1.0, quota.remaining_time))
+            async with self.session.get(resource_url, timeout=request_timeout) as response:
                 if response.status == 200:
-                    content = await response.read()
+                    # رفض الملفات الكبيرة قبل قراءتها اعتماداً على Content-Length
+                    if response.content_length is not None:
+                        if response.content_length > quota.max_file_size:
+                            logger.debug(f"⏭️ تخطي مورد كبير: {resource_url} ({human_readable_size(response.content_length)})")
+                            return
+                        if response.content_length > quota.remaining_bytes:
+                            quota.trip("max_bytes")
                     
                     # إنشاء مجلد للمورد
                     resource_dir = os.path.join(output_dir, resource_type)
@@ -490,34 +665,64 @@ class WebsiteDownloader:
                     
                     filepath = os.path.join(resource_dir, filename)
                     
+                    # قراءة متدفقة مع إيقاف فوري عند تجاوز الحد
+                    file_size = 0
                     async with aiofiles.open(filepath, 'wb') as f:
-                        await f.write(content)
+                        async for chunk in response.content.iter_chunked(64 * 1024):
+                            file_size += len(chunk)
+                            if file_size > quota.max_file_size:
+                                raise QuotaExceeded("max_file_size")
+                            if file_size > quota.remaining_bytes:
+                                quota.trip("max_bytes")
+                            await f.write(chunk)
                     
                     # تحديث الإحصائيات
-                    file_size = len(content)
                     self.total_size += file_size
                     self.total_files += 1
+                    quota.charge_bytes(file_size)
                     
+        except QuotaExceeded as e:
+            # الملف الواحد الكبير يُتخطى، أما نفاد حصة المهمة فيوقف الزحف
+            if filepath and os.path.exists(filepath):
+                os.remove(filepath)
+            if quota.exceeded:
+                raise
+            logger.debug(f"⏭️ تخطي مورد تجاوز الحد ({e.reason}): {resource_url}")
         except Exception as e:
             logger.error(f"Error downloading resource {resource_url}: {e}")
     
-    async def extract_links(self, url, output_dir, base_url):
+    async def extract_links(self, url, output_dir, base_url, quota: Optional[DownloadQuota] = None):
         """استخراج الروابط من الصفحة"""
+        if quota is None:
+            quota = DownloadQuota()
+        
         try:
-            page = await self.context.new_page()
-            await page.goto(url, wait_until='networkidle')
+            quota.check()
             
-            # الحصول على جميع الروابط الداخلية
-            links = await page.evaluate('''() => {
-                return Array.from(document.querySelectorAll('a[href]'))
-                    .map(a => a.href)
-                    .filter(href => href.startsWith(window.location.origin))
-                    .filter(href => !href.includes('#'))
-            }''')
+            await self._acquire_page_slot(quota)
+            try:
+                context = await self._get_context()
+                page = await context.new_page()
+                try:
+                    await page.goto(url, wait_until='networkidle',
+                                    timeout=quota.timeout_ms(config.Config.PAGE_LOAD_TIMEOUT))
+                    
+                    # الحصول على جميع الروابط الداخلية
+                    links = await page.evaluate('''() => {
+                        return Array.from(document.querySelectorAll('a[href]'))
+                            .map(a => a.href)
+                            .filter(href => href.startsWith(window.location.origin))
+                            .filter(href => !href.includes('#'))
+                    }''')
+                finally:
+                    await page.close()
+            finally:
+                await memory_governor.release_page()
             
-            await page.close()
             return list(set(links))  # إزالة التكرارات
             
+        except QuotaExceeded:
+            raise
         except Exception as e:
             logger.error(f"Error extracting links: {e}")
             return []
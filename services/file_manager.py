@@ -46,25 +46,37 @@ class FileManager:
             
             def cleanup_sync():
                 nonlocal cleaned_count, cleaned_size
-                for filename in os.listdir(directory):
-                    file_path = os.path.join(directory, filename)
-                    if os.path.isfile(file_path):
-                        file_age = current_time - os.path.getctime(file_path)
-                        if file_age > max_age_seconds:
-                            file_size = os.path.getsize(file_path)
-                            os.remove(file_path)
-                            cleaned_count += 1
-                            cleaned_size += file_size
-                    elif os.path.isdir(file_path):
-                        # تنظيف المجلدات الفارغة القديمة
+                # مسح تصاعدي: الأرشيفات في مجلدات المهام (DOWNLOADS_DIR/<task_id>/) ثم المجلدات التي فرغت
+                emptied = set()
+                for root, dirs, files in os.walk(directory, topdown=False):
+                    removed_here = any(os.path.join(root, d) in emptied for d in dirs)
+                    for filename in files:
+                        file_path = os.path.join(root, filename)
                         try:
-                            if not os.listdir(file_path):  # مجلد فارغ
-                                dir_age = current_time - os.path.getctime(file_path)
-                                if dir_age > max_age_seconds:
-                                    os.rmdir(file_path)
-                                    cleaned_count += 1
+                            file_age = current_time - os.path.getctime(file_path)
+                            if file_age > max_age_seconds:
+                                file_size = os.path.getsize(file_path)
+                                os.remove(file_path)
+                                cleaned_count += 1
+                                cleaned_size += file_size
+                                removed_here = True
                         except OSError:
                             pass
+                    
+                    if root == directory:
+                        continue
+                    
+                    # المجلد الذي أفرغه هذا المسح يُحذف فوراً (الحذف يحدّث وقته)،
+                    # والمجلد الفارغ أصلاً يُحذف إذا كان قديماً
+                    try:
+                        if not os.listdir(root):
+                            dir_age = current_time - os.path.getctime(root)
+                            if removed_here or dir_age > max_age_seconds:
+                                os.rmdir(root)
+                                emptied.add(root)
+                                cleaned_count += 1
+                    except OSError:
+                        pass
             
             await asyncio.get_event_loop().run_in_executor(None, cleanup_sync)
             
@@ -0,0 +1,187 @@
+"""
+منظم الذاكرة والتحكم في القبول
+Memory Governor and Admission Control
+"""
+
+import asyncio
+import time
+from enum import Enum
+from typing import Dict, Optional, Tuple
+
+import psutil
+
+from utils.logger import logger
+import config
+
+class MemoryPressure(Enum):
+    """مستويات ضغط الذاكرة"""
+    NORMAL = 0
+    ELEVATED = 1
+    HIGH = 2
+    CRITICAL = 3
+
+class MemoryGovernor:
+    """منظم ذاكرة يعمل في الخلفية ويقيد إنشاء الصفحات والسياقات قبل نفاد الذاكرة"""
+
+    # عتبات الضغط كنسبة من ميزانية الذاكرة
+    THRESHOLDS = {
+        MemoryPressure.ELEVATED: 0.70,
+        MemoryPressure.HIGH: 0.85,
+        MemoryPressure.CRITICAL: 0.95,
+    }
+    HYSTERESIS = 0.05  # هامش النزول لتجنب التذبذب بين المستويات
+
+    def __init__(self, budget_mb: int = None, interval: float = None):
+        self.budget_mb = budget_mb or config.Config.MEMORY_BUDGET_MB
+        self.interval = interval or config.Config.MEMORY_SAMPLE_INTERVAL
+        self.pressure = MemoryPressure.NORMAL
+        self.bot_rss_mb = 0.0
+        self.browser_rss_mb = 0.0
+        self.last_sample_at = 0.0
+
+        # حدود الصفحات المتزامنة حسب مستوى الضغط (None = بدون حد)
+        self.page_limits = {
+            MemoryPressure.NORMAL: None,
+            MemoryPressure.ELEVATED: config.Config.MAX_CONTEXTS_POOL * 2,
+            MemoryPressure.HIGH: 1,
+            MemoryPressure.CRITICAL: 0,
+        }
+
+        self._process = psutil.Process()
+        self._active_pages = 0
+        self._capacity_changed = asyncio.Condition()
+        self._sampler_task = None
+        self._is_running = False
+
+    async def start(self):
+        """بدء أخذ العينات في الخلفية"""
+        if self._is_running:
+            return
+
+        self._is_running = True
+        await self.sample()
+        self._sampler_task = asyncio.create_task(self._sample_loop())
+        logger.info(f"🧠 تم بدء منظم الذاكرة (الميزانية: {self.budget_mb}MB)")
+
+    async def stop(self):
+        """إيقاف أخذ العينات وتحرير المنتظرين"""
+        self._is_running = False
+
+        if self._sampler_task:
+            self._sampler_task.cancel()
+            try:
+                await self._sampler_task
+            except asyncio.CancelledError:
+                pass
+
+        # عدم ترك أي مهمة عالقة في الانتظار بعد الإيقاف
+        self.pressure = MemoryPressure.NORMAL
+        async with self._capacity_changed:
+            self._capacity_changed.notify_all()
+
+        logger.info("⏹️ تم إيقاف منظم الذاكرة")
+
+    async def _sample_loop(self):
+        """حلقة أخذ العينات الدورية"""
+        while self._is_running:
+            try:
+                await asyncio.sleep(self.interval)
+                await self.sample()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في منظم الذاكرة: {e}")
+
+    def _read_rss(self) -> Tuple[float, float]:
+        """قراءة ذاكرة البوت وشجرة عمليات المتصفح (متزامنة)"""
+        bot_rss = self._process.memory_info().rss
+        browser_rss = 0
+
+        # Chromium وسائق Playwright يعملان كعمليات فرعية
+        for child in self._process.children(recursive=True):
+            try:
+                browser_rss += child.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        return bot_rss / 1024 / 1024, browser_rss / 1024 / 1024
+
+    async def sample(self):
+        """أخذ عينة وتحديث مستوى الضغط"""
+        self.bot_rss_mb, self.browser_rss_mb = await asyncio.to_thread(self._read_rss)
+        self.last_sample_at = time.time()
+        self._set_pressure(self._compute_pressure(self.total_rss_mb))
+
+    @property
+    def total_rss_mb(self) -> float:
+        """إجمالي ذاكرة البوت والمتصفح"""
+        return self.bot_rss_mb + self.browser_rss_mb
+
+    def _compute_pressure(self, used_mb: float) -> MemoryPressure:
+        """حساب مستوى الضغط مع هامش نزول"""
+        ratio = used_mb / max(1, self.budget_mb)
+
+        level = MemoryPressure.NORMAL
+        for candidate, threshold in self.THRESHOLDS.items():
+            # البقاء في المستوى الحالي حتى النزول تحت العتبة بهامش
+            if candidate.value <= self.pressure.value:
+                threshold -= self.HYSTERESIS
+            if ratio >= threshold:
+                level = candidate
+        return level
+
+    def _set_pressure(self, level: MemoryPressure):
+        """تحديث المستوى وإيقاظ المنتظرين عند انخفاضه"""
+        previous = self.pressure
+        self.pressure = level
+
+        if level != previous:
+            log = logger.warning if level.value > previous.value else logger.info
+            log(f"🧠 ضغط الذاكرة: {previous.name} → {level.name} "
+                f"(البوت {self.bot_rss_mb:.0f}MB + المتصفح {self.browser_rss_mb:.0f}MB)")
+
+            if level.value < previous.value:
+                asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        """إيقاظ المهام المنتظرة للسعة"""
+        async with self._capacity_changed:
+            self._capacity_changed.notify_all()
+
+    def _has_capacity(self) -> bool:
+        """هل يسمح المستوى الحالي بصفحة جديدة"""
+        limit = self.page_limits[self.pressure]
+        return limit is None or self._active_pages < limit
+
+    def is_critical(self) -> bool:
+        """هل الذاكرة في حالة حرجة"""
+        return self.pressure == MemoryPressure.CRITICAL
+
+    async def acquire_page(self, timeout: Optional[float] = None):
+        """حجز مكان لصفحة جديدة، مع الانتظار تحت الضغط"""
+        async with self._capacity_changed:
+            await asyncio.wait_for(
+                self._capacity_changed.wait_for(self._has_capacity),
+                timeout=timeout
+            )
+            self._active_pages += 1
+
+    async def release_page(self):
+        """تحرير مكان الصفحة"""
+        async with self._capacity_changed:
+            self._active_pages = max(0, self._active_pages - 1)
+            self._capacity_changed.notify(1)
+
+    def get_stats(self) -> Dict:
+        """إحصائيات منظم الذاكرة"""
+        return {
+            'pressure': self.pressure.name,
+            'bot_rss_mb': round(self.bot_rss_mb, 1),
+            'browser_rss_mb': round(self.browser_rss_mb, 1),
+            'budget_mb': self.budget_mb,
+            'active_pages': self._active_pages,
+            'page_limit': self.page_limits[self.pressure],
+        }
+
+# إنشاء مثيل عام للاستخدام
+memory_governor = MemoryGovernor()
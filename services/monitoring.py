@@ -297,7 +297,8 @@ class MetricsCollector:
         """الحصول على مقاييس النظام الحالية"""
         try:
             # معلومات CPU
-            cpu_percent = psutil.cpu_percent(interval=1)
+            # بدون interval: القراءة منذ آخر استدعاء بدلاً من حجز حلقة الأحداث ثانية كاملة
+            cpu_percent = psutil.cpu_percent(interval=None)
             
             # معلومات الذاكرة
             memory = psutil.virtual_memory()
@@ -0,0 +1,244 @@
+"""
+ناشر رسائل التقدم مع دمج التحديثات وحدود تيليجرام
+Throttled Telegram Progress Publisher
+"""
+
+import asyncio
+import heapq
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from utils.logger import logger
+import config
+
+MAX_TRACKED_MESSAGES = 10000  # آخر نص مرسل لكل رسالة (لتخطي التعديلات المتطابقة)
+
+@dataclass
+class ProgressUpdate:
+    """أحدث حالة مطلوبة لرسالة واحدة"""
+    text: str
+    reply_markup: Any = None
+    parse_mode: Optional[str] = 'Markdown'
+    final: bool = False  # حالة نهائية لا تُسقط تحت الضغط
+
+def _retry_seconds(error: RetryAfter) -> float:
+    """مدة الانتظار من RetryAfter (رقم أو timedelta حسب الإصدار)"""
+    retry_after = error.retry_after
+    return float(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+
+class ProgressPublisher:
+    """ناشر واحد لتعديلات رسائل التقدم في كل المحادثات
+
+    كل رسالة تحتفظ بآخر نص مطلوب فقط (الحالات الوسيطة تُستبدل)، ويُرسل بعد
+    مرور الحد الأدنى منذ آخر تعديل لها. الإرسال يمر بمعدل عام، وعند
+    RetryAfter يتوقف كل الإرسال حتى انتهاء المدة بدلاً من تكرار الخطأ.
+    """
+
+    def __init__(self, bot=None, min_interval: float = None, global_rate: float = None,
+                 max_pending: int = None):
+        self.bot = bot
+        self.min_interval = min_interval or config.Config.PROGRESS_MIN_INTERVAL
+        self.final_interval = min(self.min_interval, config.Config.PROGRESS_FINAL_MIN_INTERVAL)
+        self.global_rate = global_rate or config.Config.PROGRESS_GLOBAL_RATE
+        self.max_pending = max_pending or config.Config.PROGRESS_MAX_PENDING
+
+        self._pending: Dict[Tuple[int, int], ProgressUpdate] = {}
+        self._due: list = []  # heap (موعد الإرسال، تسلسل، المفتاح) مع مداخل قديمة تُتخطى
+        self._seq = 0
+        self._last_sent: OrderedDict = OrderedDict()  # {المفتاح: (النص، وقت الإرسال)}
+        self._blocked_until = 0.0  # توقف عام بعد RetryAfter
+        self._next_send_at = 0.0
+
+        self._wakeup = asyncio.Event()
+        self._flush_task = None
+        self._is_running = False
+        self.stats = {'published': 0, 'sent': 0, 'coalesced': 0, 'skipped': 0,
+                      'dropped': 0, 'retry_after': 0, 'errors': 0}
+
+    async def start(self, bot=None):
+        """بدء حلقة الإرسال"""
+        if self._is_running:
+            return
+
+        if bot is not None:
+            self.bot = bot
+        self._is_running = True
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info("📨 تم بدء ناشر رسائل التقدم")
+
+    async def stop(self):
+        """إرسال الحالات النهائية المتبقية ثم الإيقاف"""
+        self._is_running = False
+
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        # الحالات الوسيطة لم تعد مهمة؛ النهائية تُرسل إن لم يكن هناك حظر
+        for key, update in list(self._pending.items()):
+            if update.final and time.monotonic() >= self._blocked_until:
+                await self._send(key, update)
+        self._pending.clear()
+        self._due.clear()
+
+        logger.info("⏹️ تم إيقاف ناشر رسائل التقدم")
+
+    def publish(self, chat_id: int, message_id: int, text: str, reply_markup: Any = None,
+                final: bool = False, parse_mode: Optional[str] = 'Markdown') -> bool:
+        """طلب تعديل رسالة (بدون انتظار)؛ False إذا تُخطي أو أُسقط"""
+        key = (chat_id, message_id)
+        self.stats['published'] += 1
+
+        previous = self._pending.get(key)
+        if previous is None:
+            last = self._last_sent.get(key)
+            if last and last[0] == text:
+                self.stats['skipped'] += 1
+                return False
+
+            # ضغط عكسي: رسائل جديدة بحالات وسيطة تُسقط عند امتلاء المعلقات
+            if not final and len(self._pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                return False
+        else:
+            self.stats['coalesced'] += 1
+
+        update = ProgressUpdate(text, reply_markup, parse_mode, final or bool(previous and previous.final))
+        self._pending[key] = update
+        if previous is None or (final and not previous.final):
+            self._schedule(key, self._due_at(key, update))
+        return True
+
+    def blocked_for(self) -> float:
+        """الثواني المتبقية من حظر RetryAfter العام (لمرسلين آخرين)"""
+        return max(0.0, self._blocked_until - time.monotonic())
+
+    def note_retry_after(self, seconds: float):
+        """تسجيل RetryAfter من مرسل آخر كي يحترمه الناشر أيضاً"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self.stats['retry_after'] += 1
+        logger.warning(f"⏳ تيليجرام طلب التوقف {seconds:.0f} ثانية، تأجيل كل تعديلات التقدم")
+
+    def _due_at(self, key: Tuple[int, int], update: ProgressUpdate, now: float = None) -> float:
+        """موعد الإرسال المسموح؛ الرسالة التي لم تُعدل بعد مستحقة الآن"""
+        last = self._last_sent.get(key)
+        if last is None:
+            return time.monotonic() if now is None else now
+        return last[1] + (self.final_interval if update.final else self.min_interval)
+
+    def _schedule(self, key: Tuple[int, int], due_at: float):
+        self._seq += 1
+        heapq.heappush(self._due, (due_at, self._seq, key))
+        self._wakeup.set()
+
+    def _next_due_in(self) -> Optional[float]:
+        """الثواني حتى أقرب إرسال (None إذا لا شيء معلق)"""
+        if not self._due:
+            return None
+        due_at = max(self._due[0][0], self._blocked_until)
+        return max(0.0, due_at - time.monotonic())
+
+    async def _flush_loop(self):
+        """إرسال التحديثات المستحقة عند مواعيدها"""
+        while self._is_running:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_due_in())
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self._flush_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في ناشر رسائل التقدم: {e}")
+
+    async def _flush_due(self):
+        """إرسال كل ما حان موعده ضمن المعدل العام"""
+        while self._due:
+            due_at, _, key = self._due[0]
+            now = time.monotonic()
+            if due_at > now or now < self._blocked_until:
+                return
+
+            heapq.heappop(self._due)
+            update = self._pending.get(key)
+            if update is None:
+                continue  # مدخل قديم لرسالة أُرسلت
+
+            # موعد المدخل قد يسبق إرسالاً تم بعد جدولته
+            actual_due = self._due_at(key, update, now)
+            if actual_due > now:
+                self._schedule(key, actual_due)
+                continue
+
+            del self._pending[key]
+            await self._wait_send_slot()
+            await self._send(key, update)
+
+    async def _wait_send_slot(self):
+        """تباعد الإرسال بحسب المعدل العام"""
+        now = time.monotonic()
+        wait = self._next_send_at - now
+        self._next_send_at = max(now, self._next_send_at) + 1.0 / self.global_rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _send(self, key: Tuple[int, int], update: ProgressUpdate):
+        """تنفيذ التعديل مع التعامل مع أخطاء تيليجرام"""
+        last = self._last_sent.get(key)
+        if last and last[0] == update.text:
+            self.stats['skipped'] += 1
+            return
+
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=update.text,
+                parse_mode=update.parse_mode,
+                reply_markup=update.reply_markup
+            )
+            self.stats['sent'] += 1
+        except RetryAfter as e:
+            self.note_retry_after(_retry_seconds(e))
+            # إعادة الحالة ما لم تصل حالة أحدث أثناء الإرسال
+            if key not in self._pending:
+                self._pending[key] = update
+                self._schedule(key, self._blocked_until)
+            return
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                # الرسالة حُذفت أو لا يمكن تعديلها: لا فائدة من إعادة المحاولة
+                self.stats['errors'] += 1
+                logger.warning(f"⚠️ تعذر تعديل رسالة التقدم {message_id}: {e}")
+                return
+        except TelegramError as e:
+            self.stats['errors'] += 1
+            logger.error(f"❌ خطأ في إرسال تحديث التقدم: {e}")
+            return
+
+        self._last_sent.pop(key, None)
+        self._last_sent[key] = (update.text, time.monotonic())
+        if len(self._last_sent) > MAX_TRACKED_MESSAGES:
+            self._last_sent.popitem(last=False)
+
+    def get_stats(self) -> Dict:
+        """إحصائيات الناشر"""
+        return {
+            'pending': len(self._pending),
+            'blocked_for': round(self.blocked_for(), 1),
+            **self.stats,
+        }
+
+# إنشاء مثيل عام للاستخدام
+progress_publisher = ProgressPublisher()
@@ -4,17 +4,36 @@ Advanced Queue Management System
 """
 
 import asyncio
+import hashlib
 import heapq
+import json
+import random
 import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Callable, Any
+from urllib.parse import urlparse
 from enum import Enum
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 import uuid
 
+from services.queue_store import QueueStore
+from utils.helpers import normalize_url
 from utils.logger import logger
 import config
 
+USER_HISTORY_SIZE = 10  # عدد المهام المنتهية المعروضة لكل مستخدم
+MAX_SKIPS = 3  # أقصى عدد مرات تتجاوز فيه مهمة أقصر مهمةً في رأس القائمة
+MAX_DOMAIN_ESTIMATES = 5000
+DEADLINE_CHECK_INTERVAL = 1.0  # ثواني بين فحوص المهمة التي أوقف معالجها ساعة المهلة
+
+class QueueFullError(Exception):
+    """رفض مهمة جديدة لأن القائمة مشبعة (ضغط عكسي)"""
+    
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after  # الوقت المتوقع لتفريغ القائمة بالثواني
+
 class Priority(Enum):
     """أولويات المهام"""
     LOW = 3
@@ -47,40 +66,212 @@ class QueueTask:
     max_retries: int = 3
     callback: Optional[Callable] = None
     context: Dict[str, Any] = field(default_factory=dict)
+    weight: float = 1.0  # حصة المستخدم في الجدولة العادلة
+    handler: str = ""  # اسم المعالج المسجل (لإعادة ربط callback بعد الاستعادة)
+    virtual_finish: float = 0.0  # وسم الانتهاء الافتراضي داخل فئة الأولوية
+    listener: Optional[Callable] = None  # يُستدعى عند تغير التقدم أو الحالة
+    result: Optional[Dict[str, Any]] = None  # نتيجة المعالج (مشتركة بين المشتركين)
+    coalesce_key: str = ""  # مفتاح دمج الطلبات المتطابقة
+    subscribers: List['QueueTask'] = field(default_factory=list)  # طلبات ملحقة بهذه المهمة
+    detached: bool = False  # ألغاها صاحبها وتستمر لأجل المشتركين فقط
+    timeout: float = field(default_factory=lambda: config.Config.DOWNLOAD_TIMEOUT)  # المهلة الناعمة بالثواني
+    deadline: Optional[float] = None  # موعد الإنهاء الناعم (monotonic) يُحدد عند البدء
+    skips: int = 0  # عدد مرات تجاوزها لصالح مهمة أقصر
     
     def __lt__(self, other):
-        """للمقارنة في heap queue"""
+        """للمقارنة في heap queue: الأولوية أولاً ثم الحصة العادلة ثم وقت الإنشاء"""
         if self.priority.value != other.priority.value:
             return self.priority.value < other.priority.value
+        if self.virtual_finish != other.virtual_finish:
+            return self.virtual_finish < other.virtual_finish
         return self.created_at < other.created_at
 
+class _RankNode:
+    """عقدة في شجرة الترتيب: مفتاح المهمة وتقدير مدتها مع حجم ومجموع الشجرة الفرعية"""
+    __slots__ = ('key', 'estimate', 'heap_priority', 'left', 'right', 'size', 'total')
+    
+    def __init__(self, key: tuple, estimate: float):
+        self.key = key
+        self.estimate = estimate
+        self.heap_priority = random.random()
+        self.left = self.right = None
+        self.size = 1
+        self.total = estimate
+    
+    def update(self):
+        self.size = 1
+        self.total = self.estimate
+        for child in (self.left, self.right):
+            if child is not None:
+                self.size += child.size
+                self.total += child.total
+
+class PendingRank:
+    """شجرة ترتيب إحصائية (treap) للمهام المنتظرة
+    
+    مرتبة بنفس ترتيب الـ heap (الأولوية ثم وسم الانتهاء ثم وقت الإنشاء) وتحفظ لكل
+    شجرة فرعية عدد المهام ومجموع مددها المقدرة، فيُحسب ترتيب المهمة ومجموع ما قبلها
+    بـ O(log n) بدلاً من مسح القائمة. التقدير يُلتقط عند دخول المهمة للانتظار.
+    """
+    
+    def __init__(self):
+        self._root: Optional[_RankNode] = None
+    
+    def __len__(self) -> int:
+        return self._root.size if self._root else 0
+    
+    @property
+    def total(self) -> float:
+        """مجموع المدد المقدرة لكل المهام المنتظرة"""
+        return self._root.total if self._root else 0.0
+    
+    @staticmethod
+    def key(task: QueueTask) -> tuple:
+        return (task.priority.value, task.virtual_finish, task.created_at, task.id)
+    
+    def add(self, task: QueueTask, estimate: float):
+        self._root = self._insert(self._root, _RankNode(self.key(task), estimate))
+    
+    def remove(self, task: QueueTask):
+        self._root = self._delete(self._root, self.key(task))
+    
+    def rank(self, task: QueueTask) -> tuple:
+        """(عدد المهام قبل المهمة، مجموع مددها المقدرة)"""
+        key = self.key(task)
+        count, total = 0, 0.0
+        node = self._root
+        while node is not None:
+            if node.key < key:
+                if node.left is not None:
+                    count += node.left.size
+                    total += node.left.total
+                count += 1
+                total += node.estimate
+                node = node.right
+            else:
+                node = node.left
+        return count, total
+    
+    def _split(self, node: Optional[_RankNode], key: tuple) -> tuple:
+        """فصل الشجرة إلى مفاتيح أصغر من key والباقي"""
+        if node is None:
+            return None, None
+        if node.key < key:
+            node.right, right = self._split(node.right, key)
+            node.update()
+            return node, right
+        left, node.left = self._split(node.left, key)
+        node.update()
+        return left, node
+    
+    def _merge(self, left: Optional[_RankNode], right: Optional[_RankNode]) -> Optional[_RankNode]:
+        if left is None or right is None:
+            return left or right
+        if left.heap_priority > right.heap_priority:
+            left.right = self._merge(left.right, right)
+            left.update()
+            return left
+        right.left = self._merge(left, right.left)
+        right.update()
+        return right
+    
+    def _insert(self, node: Optional[_RankNode], new: _RankNode) -> _RankNode:
+        if node is None:
+            return new
+        if new.heap_priority > node.heap_priority:
+            new.left, new.right = self._split(node, new.key)
+            new.update()
+            return new
+        if new.key < node.key:
+            node.left = self._insert(node.left, new)
+        else:
+            node.right = self._insert(node.right, new)
+        node.update()
+        return node
+    
+    def _delete(self, node: Optional[_RankNode], key: tuple) -> Optional[_RankNode]:
+        if node is None:
+            return None
+        if key == node.key:
+            return self._merge(node.left, node.right)
+        if key < node.key:
+            node.left = self._delete(node.left, key)
+        else:
+            node.right = self._delete(node.right, key)
+        node.update()
+        return node
+
 class DownloadQueue:
     """نظام قوائم الانتظار للتنزيلات"""
     
-    def __init__(self, max_concurrent: int = None):
+    def __init__(self, max_concurrent: int = None, store: Optional[QueueStore] = None):
         self.max_concurrent = max_concurrent or config.Config.MAX_CONCURRENT_DOWNLOADS
-        self.pending_queue = []  # heap queue للمهام المنتظرة
+        self.store = store  # مخزن دائم اختياري؛ الـ heap يبقى ذاكرة التشغيل السريعة
+        self.worker_id = str(uuid.uuid4())
+        self._handlers: Dict[str, Callable] = {}
+        self._listeners: Dict[str, Callable] = {}  # مستمع افتراضي لكل معالج (يُعاد ربطه بعد الاستعادة)
+        self.max_pending = config.Config.QUEUE_MAX_PENDING  # حد المهام المنتظرة قبل رفض الجديدة
+        self._heartbeat_task = None
+        self.pending_queue = []  # heap queue للمهام المنتظرة (مع شواهد حذف كسول)
         self.running_tasks = {}  # المهام قيد التنفيذ
-        self.completed_tasks = {}  # المهام المكتملة
-        self.user_queues = {}  # قوائم انتظار المستخدمين
+        self.completed_tasks: OrderedDict = OrderedDict()  # سجل محدود للمهام المنتهية (الأقدم أولاً)
+        self.history_size = config.Config.QUEUE_HISTORY_SIZE
+        self.history_max_age = timedelta(seconds=config.Config.QUEUE_HISTORY_MAX_AGE)
+        self.user_queues = {}  # المهام الحية لكل مستخدم {user_id: {task_id: task}}
         self.queue_lock = asyncio.Lock()
+        
+        # فهارس للوصول المباشر بدلاً من المسح الخطي
+        self._pending_index: Dict[str, QueueTask] = {}  # المهام المنتظرة حسب المعرف
+        self._rank = PendingRank()  # ترتيب المهام المنتظرة ومجموع مددها لحساب الموقع
+        self._user_completed: Dict[int, deque] = {}  # آخر المهام المكتملة لكل مستخدم
+        self._tombstones = 0  # عدد المهام الملغاة التي ما زالت في الـ heap
+        
+        # جدولة عادلة موزونة (WFQ ذاتية التوقيت) داخل كل فئة أولوية
+        self._virtual_time: Dict[int, float] = {}  # الزمن الافتراضي لكل أولوية
+        self._user_finish: Dict[int, Dict[int, float]] = {}  # آخر وسم انتهاء {user_id: {priority: tag}}
+        
+        # دمج الطلبات المتطابقة: مهمة واحدة تخدم كل من يطلب نفس الرابط والخيارات
+        self._inflight: Dict[str, QueueTask] = {}  # المهمة الأساسية لكل مفتاح
+        self._subscribers: Dict[str, QueueTask] = {}  # الطلبات الملحقة حسب المعرف
+        
+        # إعادة المحاولة المؤجلة: heap حسب موعد الجاهزية بدلاً من النوم داخل خانة التنفيذ
+        self.retry_base_delay = config.Config.QUEUE_RETRY_DELAY
+        self.retry_max_delay = 30
+        self._delayed: List = []  # (ready_at, seq, task)
+        self._retry_index: Dict[str, QueueTask] = {}  # المهام المنتظرة لموعد إعادة المحاولة
+        self._retry_seq = 0
+        
+        # المهل وتقدير المدة: مهلة ناعمة يُنشأ عندها أرشيف جزئي ثم إلغاء قسري بعد هامش
+        self.deadline_grace = config.Config.TASK_DEADLINE_GRACE
+        self.lookahead = config.Config.QUEUE_LOOKAHEAD
+        self._duration_estimates: OrderedDict = OrderedDict()  # متوسط أسي لمدة كل نطاق
+        self._global_estimate: Optional[float] = None
         self.stats = {
             'total_tasks': 0,
             'completed_tasks': 0,
             'failed_tasks': 0,
-            'cancelled_tasks': 0
+            'cancelled_tasks': 0,
+            'coalesced_tasks': 0,
+            'timed_out_tasks': 0
         }
         
-        # بدء معالج القائمة
+        # بدء معالج القائمة (يستيقظ عند الإضافة والإكمال والإلغاء بدلاً من الاستطلاع)
         self._queue_processor_task = None
         self._is_running = False
+        self._wakeup = asyncio.Event()
     
     async def start(self):
         """بدء معالج القائمة"""
         if self._is_running:
             return
         
+        if self.store:
+            await self.store.start()
+            await self._recover_tasks()
+            self._heartbeat_task = asyncio.create_task(self._lease_heartbeat())
+        
         self._is_running = True
+        self._wakeup.set()  # تشغيل ما تراكم قبل البدء
         self._queue_processor_task = asyncio.create_task(self._process_queue())
         logger.info("🚀 تم بدء معالج قوائل الانتظار")
     
@@ -95,44 +286,88 @@ class DownloadQueue:
             except asyncio.CancelledError:
                 pass
         
-        # إلغاء جميع المهام قيد التنفيذ
-        for task_id, task_info in self.running_tasks.items():
-            if 'asyncio_task' in task_info:
-                task_info['asyncio_task'].cancel()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+        
+        # إلغاء جميع المهام قيد التنفيذ (مع المخزن تعود للانتظار بعد إعادة التشغيل)
+        running = [
+            task_info['asyncio_task'] for task_info in list(self.running_tasks.values())
+            if 'asyncio_task' in task_info
+        ]
+        for asyncio_task in running:
+            asyncio_task.cancel()
+        
+        if self.store:
+            await asyncio.gather(*running, return_exceptions=True)
+            await self.store.stop()
         
         logger.info("⏹️ تم إيقاف معالج قوائل الانتظار")
     
+    @property
+    def is_running(self) -> bool:
+        """هل القائمة تعمل (False أثناء الإيقاف)"""
+        return self._is_running
+    
+    def save_task(self, task: QueueTask):
+        """حفظ تغييرات المهمة (مثل سياقها) في المخزن الدائم"""
+        self._persist(task)
+    
     async def add_task(self, user_id: int, url: str, priority: Priority = Priority.NORMAL, 
-                      callback: Callable = None, context: Dict = None) -> str:
-        """إضافة مهمة جديدة للقائمة"""
+                      callback: Callable = None, context: Dict = None,
+                      is_premium: bool = False, handler: str = None,
+                      options: Dict = None, listener: Callable = None,
+                      timeout: float = None) -> str:
+        """إضافة مهمة جديدة للقائمة (المستخدم المميز يحصل على حصة أكبر من الخانات)
+        
+        المهام المسجلة بمعالج (handler) تُدمج: إذا كان نفس الرابط والخيارات قيد
+        الانتظار أو التنفيذ يُلحق الطلب بالمهمة القائمة بدلاً من زحف جديد.
+        """
         async with self.queue_lock:
             # فحص حدود المستخدم
             user_pending_count = self._get_user_pending_count(user_id)
-            max_user_queue = 5  # حد أقصى 5 مهام لكل مستخدم
+            max_user_queue = config.Config.MAX_USER_QUEUE_SIZE
             
             if user_pending_count >= max_user_queue:
-                raise Exception(f"تجاوز الحد الأقصى للمهام المنتظرة ({max_user_queue})")
+                raise QueueFullError(f"تجاوز الحد الأقصى للمهام المنتظرة ({max_user_queue})")
             
             # إنشاء المهمة
             task = QueueTask(
                 user_id=user_id,
                 url=url,
                 priority=priority,
-                callback=callback,
-                context=context or {}
+                callback=callback or self._handlers.get(handler),
+                context=context or {},
+                weight=config.Config.PREMIUM_USER_WEIGHT if is_premium else 1.0,
+                handler=handler or "",
+                listener=listener or self._listeners.get(handler)
             )
+            if timeout:
+                task.timeout = timeout
+            if options:
+                task.context['options'] = options
             
-            # إضافة للقائمة
-            heapq.heappush(self.pending_queue, task)
+            # الطلب الملحق بزحف قائم لا يضيف حملاً؛ غيره يُرفض عند تشبع القائمة
+            key = self._coalesce_key(task)
+            if len(self._pending_index) >= self.max_pending and not (key and key in self._inflight):
+                raise QueueFullError(
+                    f"قائمة الانتظار ممتلئة ({self.max_pending} مهمة)",
+                    retry_after=self._estimate_drain()
+                )
             
-            # تحديث إحصائيات المستخدم
-            if user_id not in self.user_queues:
-                self.user_queues[user_id] = []
-            self.user_queues[user_id].append(task.id)
+            # إضافة للقائمة والفهارس أو إلحاقها بمهمة مطابقة
+            coalesced = self._enqueue(task)
             
             self.stats['total_tasks'] += 1
             
-            logger.info(f"📝 تم إضافة مهمة جديدة: {task.id} للمستخدم {user_id}")
+            if coalesced:
+                logger.info(f"🔗 تم إلحاق المهمة {task.id} للمستخدم {user_id} بمهمة مطابقة قائمة")
+            else:
+                logger.info(f"📝 تم إضافة مهمة جديدة: {task.id} للمستخدم {user_id}")
+                self._notify_dispatcher()
             return task.id
     
     async def cancel_task(self, task_id: str, user_id: int = None) -> bool:
@@ -147,6 +382,13 @@ class DownloadQueue:
                 if user_id and task.user_id != user_id:
                     return False
                 
+                if task.subscribers:
+                    # طلبات أخرى تنتظر نفس الزحف: فصل صاحب المهمة فقط
+                    self._detach_owner(task)
+                    self.stats['cancelled_tasks'] += 1
+                    logger.info(f"🚫 تم إلغاء المهمة: {task_id} (تستمر لأجل {len(task.subscribers)} مشترك)")
+                    return True
+                
                 # إلغاء المهمة
                 if 'asyncio_task' in task_info:
                     task_info['asyncio_task'].cancel()
@@ -155,79 +397,123 @@ class DownloadQueue:
                 task.completed_at = datetime.utcnow()
                 
                 # نقل للمهام المكتملة
-                self.completed_tasks[task_id] = task
                 del self.running_tasks[task_id]
+                self._release_key(task)
+                self._mark_finished(task)
+                self._persist(task)
                 
                 self.stats['cancelled_tasks'] += 1
                 logger.info(f"🚫 تم إلغاء المهمة: {task_id}")
+                self._notify_dispatcher()
+                return True
+            
+            # البحث في المهام المنتظرة لموعد إعادة المحاولة (حذف كسول من heap التأجيل)
+            task = self._retry_index.get(task_id)
+            if task:
+                if user_id and task.user_id != user_id:
+                    return False
+                
+                del self._retry_index[task_id]
+                if task.subscribers:
+                    self._promote_subscriber(task)
+                else:
+                    self._release_key(task)
+                
+                task.status = TaskStatus.CANCELLED
+                task.completed_at = datetime.utcnow()
+                self._mark_finished(task)
+                self._persist(task)
+                
+                self.stats['cancelled_tasks'] += 1
+                logger.info(f"🚫 تم إلغاء المهمة المؤجلة: {task_id}")
+                return True
+            
+            # البحث في الطلبات الملحقة بمهمة أخرى
+            task = self._subscribers.get(task_id)
+            if task:
+                if user_id and task.user_id != user_id:
+                    return False
+                
+                self._detach_subscriber(task)
+                self.stats['cancelled_tasks'] += 1
+                logger.info(f"🚫 تم إلغاء الطلب الملحق: {task_id}")
                 return True
             
             # البحث في المهام المنتظرة
-            for i, task in enumerate(self.pending_queue):
-                if task.id == task_id:
-                    # فحص الصلاحية
-                    if user_id and task.user_id != user_id:
-                        return False
-                    
-                    # إزالة من القائمة
-                    self.pending_queue.pop(i)
-                    heapq.heapify(self.pending_queue)
-                    
-                    task.status = TaskStatus.CANCELLED
-                    task.completed_at = datetime.utcnow()
-                    self.completed_tasks[task_id] = task
-                    
-                    self.stats['cancelled_tasks'] += 1
-                    logger.info(f"🚫 تم إلغاء المهمة المنتظرة: {task_id}")
-                    return True
+            task = self._pending_index.get(task_id)
+            if task:
+                # فحص الصلاحية
+                if user_id and task.user_id != user_id:
+                    return False
+                
+                # حذف كسول: تبقى المهمة في الـ heap كشاهد ويتخطاها الموزع
+                self._unindex_pending(task)
+                self._tombstones += 1
+                
+                # ترقية أول مشترك ليصبح صاحب المهمة بدلاً من إلغاء الزحف
+                if task.subscribers:
+                    self._promote_subscriber(task)
+                else:
+                    self._release_key(task)
+                
+                task.status = TaskStatus.CANCELLED
+                task.completed_at = datetime.utcnow()
+                self._mark_finished(task)
+                self._persist(task)
+                self._compact_heap()
+                
+                self.stats['cancelled_tasks'] += 1
+                logger.info(f"🚫 تم إلغاء المهمة المنتظرة: {task_id}")
+                return True
             
             return False
     
     async def get_task_status(self, task_id: str) -> Optional[QueueTask]:
         """الحصول على حالة المهمة"""
-        # البحث في المهام قيد التنفيذ
+        # البحث في المهام قيد التنفيذ (الزحف المفصول عن صاحبه يظهر له ملغى من السجل)
         if task_id in self.running_tasks:
-            return self.running_tasks[task_id]['task']
+            task = self.running_tasks[task_id]['task']
+            if not task.detached:
+                return task
         
         # البحث في المهام المكتملة
         if task_id in self.completed_tasks:
             return self.completed_tasks[task_id]
         
-        # البحث في المهام المنتظرة
-        for task in self.pending_queue:
-            if task.id == task_id:
-                return task
-        
-        return None
+        # البحث في المهام المنتظرة ثم المؤجلة ثم الطلبات الملحقة
+        return (self._pending_index.get(task_id) or self._retry_index.get(task_id)
+                or self._subscribers.get(task_id))
     
     async def get_user_tasks(self, user_id: int) -> List[QueueTask]:
         """الحصول على مهام المستخدم"""
-        user_tasks = []
+        live_tasks = list(self.user_queues.get(user_id, {}).values())
         
-        # المهام قيد التنفيذ
-        for task_info in self.running_tasks.values():
-            if task_info['task'].user_id == user_id:
-                user_tasks.append(task_info['task'])
-        
-        # المهام المنتظرة
-        for task in self.pending_queue:
-            if task.user_id == user_id:
-                user_tasks.append(task)
-        
-        # آخر 10 مهام مكتملة
-        completed_user_tasks = [
-            task for task in self.completed_tasks.values()
-            if task.user_id == user_id
+        # المهام قيد التنفيذ ثم المنتظرة
+        user_tasks = [task for task in live_tasks if task.status == TaskStatus.RUNNING]
+        user_tasks.extend(task for task in live_tasks if task.status == TaskStatus.PENDING)
+        
+        # آخر 10 مهام مكتملة (الأحدث أولاً)
+        recent = [
+            self.completed_tasks[task_id]
+            for task_id in reversed(self._user_completed.get(user_id, ()))
+            if task_id in self.completed_tasks
         ]
-        completed_user_tasks.sort(key=lambda x: x.completed_at or x.created_at, reverse=True)
-        user_tasks.extend(completed_user_tasks[:10])
+        user_tasks.extend(recent)
+        
+        # السجل الأقدم الذي خرج من الذاكرة يُقرأ من المخزن الدائم
+        missing = USER_HISTORY_SIZE - len(recent)
+        if missing > 0 and self.store:
+            known_ids = {task.id for task in user_tasks}
+            rows = await self.store.load_user_history(user_id, missing + len(known_ids))
+            older = [self._task_from_row(row) for row in rows if row['id'] not in known_ids]
+            user_tasks.extend(older[:missing])
         
         return user_tasks
     
     def get_queue_stats(self) -> Dict:
         """الحصول على إحصائيات القائمة"""
         return {
-            'pending_tasks': len(self.pending_queue),
+            'pending_tasks': len(self._pending_index),
             'running_tasks': len(self.running_tasks),
             'completed_tasks': len(self.completed_tasks),
             'total_tasks': self.stats['total_tasks'],
@@ -235,76 +521,567 @@ class DownloadQueue:
                 self.stats['completed_tasks'] / max(1, self.stats['total_tasks']) * 100
             ),
             'max_concurrent': self.max_concurrent,
-            'active_users': len(self.user_queues)
+            'active_users': len(self.user_queues),
+            'coalesced_tasks': self.stats['coalesced_tasks'],
+            'subscribers': len(self._subscribers),
+            'retrying_tasks': len(self._retry_index),
+            'timed_out_tasks': self.stats['timed_out_tasks']
         }
     
     def _get_user_pending_count(self, user_id: int) -> int:
-        """عدد المهام المنتظرة للمستخدم"""
-        count = 0
+        """عدد المهام المنتظرة وقيد التنفيذ للمستخدم"""
+        return len(self.user_queues.get(user_id, ()))
+    
+    def _push_pending(self, task: QueueTask):
+        """إضافة مهمة للـ heap والفهارس"""
+        self._assign_virtual_finish(task)
+        heapq.heappush(self.pending_queue, task)
+        self._index_pending(task)
+        if not task.detached:
+            self.user_queues.setdefault(task.user_id, {})[task.id] = task
+        self._persist(task)
+    
+    def _assign_virtual_finish(self, task: QueueTask):
+        """حساب وسم الانتهاء: كل مهمة تكلف وحدة مقسومة على وزن المستخدم"""
+        level = task.priority.value
+        user_tags = self._user_finish.setdefault(task.user_id, {})
+        start = max(self._virtual_time.get(level, 0.0), user_tags.get(level, 0.0))
+        task.virtual_finish = start + 1.0 / max(task.weight, 0.01)
+        user_tags[level] = task.virtual_finish
+    
+    def _pop_valid(self) -> Optional[QueueTask]:
+        """أخذ رأس الـ heap مع تخطي الشواهد الملغاة"""
+        while self.pending_queue:
+            task = heapq.heappop(self.pending_queue)
+            if self._pending_index.get(task.id) is task:
+                self._unindex_pending(task)
+                return task
+            self._tombstones = max(0, self._tombstones - 1)
+        return None
+    
+    def _requeue(self, task: QueueTask):
+        """إرجاع مهمة للـ heap بنفس وسمها (بدون إعادة حساب الحصة)"""
+        heapq.heappush(self.pending_queue, task)
+        self._index_pending(task)
+    
+    def _index_pending(self, task: QueueTask):
+        """تسجيل المهمة في فهرس الانتظار وشجرة الترتيب"""
+        self._pending_index[task.id] = task
+        self._rank.add(task, self.estimate_duration(task))
+    
+    def _unindex_pending(self, task: QueueTask):
+        """إزالة المهمة من فهرس الانتظار وشجرة الترتيب (يبقى شاهدها في الـ heap)"""
+        del self._pending_index[task.id]
+        self._rank.remove(task)
+    
+    def _advance_virtual_time(self, task: QueueTask):
+        """تقدم الزمن الافتراضي للفئة إلى وسم المهمة المخدومة"""
+        level = task.priority.value
+        self._virtual_time[level] = max(self._virtual_time.get(level, 0.0), task.virtual_finish)
+    
+    def _pop_pending(self) -> Optional[QueueTask]:
+        """أخذ المهمة المنتظرة التالية مع تخطي الشواهد الملغاة"""
+        task = self._pop_valid()
+        if task:
+            self._advance_virtual_time(task)
+        return task
+    
+    def _pop_best_fit(self) -> Optional[QueueTask]:
+        """أخذ المهمة التالية مع تفضيل الأقصر تقديراً ضمن نافذة صغيرة من رأس الـ heap
         
-        # المهام قيد التنفيذ
+        النافذة محصورة في نفس فئة الأولوية، والمهمة التي تُتجاوز MAX_SKIPS مرات
+        تُنفذ فوراً كي لا تجوع المهام الطويلة.
+        """
+        first = self._pop_valid()
+        if first is None:
+            return None
+        
+        candidates = [first]
+        if first.skips < MAX_SKIPS:
+            while len(candidates) < self.lookahead:
+                candidate = self._pop_valid()
+                if candidate is None:
+                    break
+                if candidate.priority != first.priority:
+                    self._requeue(candidate)
+                    break
+                candidates.append(candidate)
+        
+        chosen_at = min(range(len(candidates)), key=lambda i: self.estimate_duration(candidates[i]))
+        chosen = candidates[chosen_at]
+        for position, candidate in enumerate(candidates):
+            if position == chosen_at:
+                continue
+            if position < chosen_at:
+                candidate.skips += 1
+            self._requeue(candidate)
+        
+        self._advance_virtual_time(chosen)
+        return chosen
+    
+    def estimate_duration(self, task: QueueTask) -> float:
+        """تقدير مدة المهمة من تاريخ نطاقها (أو المتوسط العام للنطاقات الجديدة)"""
+        domain = urlparse(task.url).hostname or ""
+        estimate = self._duration_estimates.get(domain, self._global_estimate)
+        return estimate if estimate is not None else task.timeout / 2
+    
+    def _remaining_running(self) -> float:
+        """مجموع الوقت المتبقي المقدر للمهام قيد التنفيذ"""
+        now = time.monotonic()
+        remaining = 0.0
         for task_info in self.running_tasks.values():
-            if task_info['task'].user_id == user_id:
-                count += 1
+            task = task_info['task']
+            elapsed = now - (task.deadline - task.timeout) if task.deadline else 0.0
+            remaining += max(0.0, self.estimate_duration(task) - elapsed)
+        return remaining
+    
+    def _estimate_drain(self) -> float:
+        """الوقت المتوقع لإنهاء كل ما في القائمة بالمعدل الحالي"""
+        return (self._rank.total + self._remaining_running()) / max(1, self.max_concurrent)
+    
+    def get_queue_position(self, task_id: str) -> Optional[Dict]:
+        """ترتيب المهمة في القائمة والوقت المتوقع لبدئها من المدد التاريخية للنطاقات
         
-        # المهام المنتظرة
-        for task in self.pending_queue:
-            if task.user_id == user_id:
-                count += 1
+        الترتيب ومجموع مدد ما قبلها من شجرة الترتيب بـ O(log n)، فيُستدعى مع كل إضافة
+        وتحديث حالة. مدد المنتظرين مقدرة لحظة دخولهم للانتظار.
+        """
+        task = self._subscribers.get(task_id)
+        if task is not None:
+            task = self._inflight.get(task.coalesce_key, task)  # الطلب الملحق يتبع مهمته الأساسية
+        else:
+            task = self._pending_index.get(task_id) or self._retry_index.get(task_id)
+        
+        if task is None:
+            return {'position': 0, 'eta': 0.0} if task_id in self.running_tasks else None
+        if task.id in self.running_tasks:
+            return {'position': 0, 'eta': 0.0}
         
-        return count
+        ahead, queued = self._rank.rank(task)
+        return {
+            'position': ahead + 1,
+            'eta': (queued + self._remaining_running()) / max(1, self.max_concurrent),
+        }
+    
+    def _record_duration(self, task: QueueTask, duration: float, alpha: float = 0.3):
+        """تحديث المتوسط الأسي لمدة النطاق بعد اكتمال مهمة"""
+        domain = urlparse(task.url).hostname or ""
+        previous = self._duration_estimates.pop(domain, None)
+        self._duration_estimates[domain] = (
+            duration if previous is None else alpha * duration + (1 - alpha) * previous
+        )
+        if len(self._duration_estimates) > MAX_DOMAIN_ESTIMATES:
+            self._duration_estimates.popitem(last=False)
+        
+        self._global_estimate = (
+            duration if self._global_estimate is None
+            else alpha * duration + (1 - alpha) * self._global_estimate
+        )
+    
+    def _mark_finished(self, task: QueueTask):
+        """إزالة المهمة من فهارس المهام الحية ونقلها للسجل"""
+        user_tasks = self.user_queues.get(task.user_id)
+        if user_tasks is not None:
+            user_tasks.pop(task.id, None)
+            if not user_tasks:
+                del self.user_queues[task.user_id]
+                # المستخدم الخامل لا يحتفظ برصيد أو دين في الجدولة
+                self._user_finish.pop(task.user_id, None)
+        
+        self.completed_tasks[task.id] = task
+        self.completed_tasks.move_to_end(task.id)
+        self._user_completed.setdefault(task.user_id, deque(maxlen=USER_HISTORY_SIZE)).append(task.id)
+        self._evict_history()
+    
+    def _evict_history(self):
+        """إخراج أقدم المهام المنتهية عند تجاوز الحجم أو العمر (O(1) مستهلكة لكل إضافة)"""
+        cutoff = datetime.utcnow() - self.history_max_age
+        
+        while self.completed_tasks:
+            task_id, task = next(iter(self.completed_tasks.items()))
+            finished_at = task.completed_at or task.created_at
+            if len(self.completed_tasks) <= self.history_size and finished_at >= cutoff:
+                break
+            
+            self.completed_tasks.popitem(last=False)
+            
+            # الأقدم عالمياً هو الأقدم في سجل مستخدمه أيضاً
+            user_history = self._user_completed.get(task.user_id)
+            if user_history and user_history[0] == task_id:
+                user_history.popleft()
+                if not user_history:
+                    del self._user_completed[task.user_id]
+    
+    def _compact_heap(self):
+        """إعادة بناء الـ heap عندما تتجاوز الشواهد نصف حجمه (تكلفة مستهلكة O(1))"""
+        if self._tombstones > 1024 and self._tombstones * 2 > len(self.pending_queue):
+            self.pending_queue = [
+                task for task in self.pending_queue
+                if self._pending_index.get(task.id) is task
+            ]
+            heapq.heapify(self.pending_queue)
+            self._tombstones = 0
+    
+    def register_listener(self, name: str, listener: Callable):
+        """تسجيل مستمع افتراضي لمهام معالج معين (يشمل المهام المستعادة من المخزن)"""
+        self._listeners[name] = listener
+    
+    def register_handler(self, name: str, callback: Callable):
+        """تسجيل معالج باسم ثابت كي تُربط به المهام المستعادة من المخزن"""
+        self._handlers[name] = callback
+    
+    def _persist(self, task: QueueTask):
+        """حفظ حالة المهمة في المخزن الدائم (كتابة مؤجلة)"""
+        if not self.store:
+            return
+        
+        if task.status == TaskStatus.RUNNING:
+            self.store.save(task, self.worker_id, time.time() + self.store.lease_timeout)
+        else:
+            self.store.save(task)
+    
+    async def _recover_tasks(self, include_pending: bool = True):
+        """استعادة المهام المنتظرة والمهام التي انتهى عقدها من المخزن"""
+        rows = await self.store.load_recoverable(include_pending)
+        recovered = failed = 0
+        
+        async with self.queue_lock:
+            for row in rows:
+                if (row['id'] in self._pending_index or row['id'] in self.running_tasks
+                        or row['id'] in self._retry_index or row['id'] in self._subscribers):
+                    continue
+                
+                task = self._task_from_row(row)
+                task.status = TaskStatus.PENDING
+                task.started_at = None
+                task.completed_at = None
+                
+                # مهمة كانت قيد التنفيذ عند الانهيار تحتسب كمحاولة
+                if row['status'] == TaskStatus.RUNNING.value:
+                    task.retry_count += 1
+                    if task.retry_count > task.max_retries:
+                        task.status = TaskStatus.FAILED
+                        task.error_message = "تجاوزت المهمة عدد المحاولات بعد انقطاع العامل"
+                        task.completed_at = datetime.utcnow()
+                        self._mark_finished(task)
+                        self._persist(task)
+                        failed += 1
+                        continue
+                
+                self._enqueue(task)
+                recovered += 1
+        
+        if recovered or failed:
+            logger.info(f"♻️ تم استعادة {recovered} مهمة من المخزن ({failed} فشلت نهائياً)")
+            self._notify_dispatcher()
+    
+    def _task_from_row(self, row: Dict) -> QueueTask:
+        """بناء مهمة من صف في المخزن الدائم"""
+        return QueueTask(
+            id=row['id'],
+            user_id=row['user_id'],
+            url=row['url'],
+            priority=Priority(row['priority']),
+            created_at=row['created_at'] or datetime.utcnow(),
+            started_at=row['started_at'],
+            completed_at=row['completed_at'],
+            status=TaskStatus(row['status']),
+            retry_count=row['retry_count'] or 0,
+            max_retries=row['max_retries'] or 0,
+            error_message=row['error_message'],
+            callback=self._handlers.get(row['handler']),
+            context=row['context'],
+            weight=row['weight'] or 1.0,
+            handler=row['handler'] or "",
+            listener=self._listeners.get(row['handler'])
+        )
+    
+    async def _lease_heartbeat(self):
+        """تجديد عقود المهام قيد التنفيذ واستعادة مهام العمال المتوقفين"""
+        interval = max(1.0, self.store.lease_timeout / 3)
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                leased = list(self.running_tasks) + [
+                    task_id for task_id, task in self._subscribers.items()
+                    if task.status == TaskStatus.RUNNING
+                ]
+                await self.store.renew_leases(leased, self.worker_id)
+                await self._recover_tasks(include_pending=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في تجديد عقود المهام: {e}")
+    
+    async def report_progress(self, task: QueueTask, progress: float):
+        """تحديث تقدم المهمة وبثه لصاحبها ولكل المشتركين فيها"""
+        task.progress = progress
+        await self._sync_subscribers(task)
+    
+    def _coalesce_key(self, task: QueueTask) -> str:
+        """مفتاح الدمج: المعالج + الرابط الموحد + الخيارات (بنفس أسلوب مفتاح الكاش)"""
+        if not task.handler:
+            return ""  # callback خاص بكل طلب لا يمكن مشاركته
+        
+        key_data = {
+            'handler': task.handler,
+            'url': normalize_url(task.url),
+            'options': task.context.get('options') or {}
+        }
+        key_string = json.dumps(key_data, sort_keys=True, default=str)
+        return hashlib.sha256(key_string.encode()).hexdigest()[:16]
+    
+    def _enqueue(self, task: QueueTask) -> bool:
+        """إضافة المهمة للـ heap أو إلحاقها بمهمة مطابقة قائمة"""
+        task.coalesce_key = self._coalesce_key(task)
+        primary = self._inflight.get(task.coalesce_key) if task.coalesce_key else None
+        
+        if primary is None:
+            if task.coalesce_key:
+                self._inflight[task.coalesce_key] = task
+            self._push_pending(task)
+            return False
+        
+        primary.subscribers.append(task)
+        self._subscribers[task.id] = task
+        self.user_queues.setdefault(task.user_id, {})[task.id] = task
+        task.status = primary.status
+        task.started_at = primary.started_at
+        task.progress = primary.progress
+        self._persist(task)
+        self.stats['coalesced_tasks'] += 1
+        return True
+    
+    def _release_key(self, task: QueueTask):
+        """إزالة المهمة من سجل المهام القابلة للدمج"""
+        if task.coalesce_key and self._inflight.get(task.coalesce_key) is task:
+            del self._inflight[task.coalesce_key]
+    
+    def _promote_subscriber(self, task: QueueTask):
+        """نقل مهمة منتظرة ألغاها صاحبها إلى أول مشترك فيها"""
+        heir = task.subscribers.pop(0)
+        del self._subscribers[heir.id]
+        
+        heir.subscribers, task.subscribers = task.subscribers, []
+        self._inflight[task.coalesce_key] = heir
+        heir.status = TaskStatus.PENDING
+        self._push_pending(heir)
+    
+    def _detach_owner(self, task: QueueTask):
+        """فصل صاحب مهمة قيد التنفيذ مع استمرار الزحف لأجل المشتركين
+        
+        الزحف المشترك يبقى RUNNING، أما صاحبه فيرى نسخة ملغاة في السجل.
+        """
+        task.detached = True
+        task.listener = None
+        self._mark_finished(replace(
+            task, status=TaskStatus.CANCELLED, completed_at=datetime.utcnow(),
+            subscribers=[], listener=None, callback=None
+        ))
+    
+    def _detach_subscriber(self, subscriber: QueueTask):
+        """فصل طلب ملحق عن مهمته الأساسية"""
+        primary = self._inflight.get(subscriber.coalesce_key)
+        if primary is not None and subscriber in primary.subscribers:
+            primary.subscribers.remove(subscriber)
+            
+            # لا أحد ينتظر الزحف بعد الآن
+            if primary.detached and not primary.subscribers:
+                task_info = self.running_tasks.get(primary.id)
+                if task_info and 'asyncio_task' in task_info:
+                    task_info['asyncio_task'].cancel()
+                else:
+                    self._drop_detached(primary)
+        
+        del self._subscribers[subscriber.id]
+        subscriber.status = TaskStatus.CANCELLED
+        subscriber.completed_at = datetime.utcnow()
+        subscriber.listener = None
+        self._mark_finished(subscriber)
+        self._persist(subscriber)
+    
+    def _drop_detached(self, task: QueueTask):
+        """إسقاط زحف مفصول ينتظر إعادة المحاولة بعد رحيل آخر مشترك فيه
+        
+        الحذف كسول كما في cancel_task: يبقى في heap التأجيل أو الانتظار كشاهد يتخطاه الموزع.
+        سجل صاحبه الملغى موجود مسبقاً من _detach_owner.
+        """
+        if self._retry_index.get(task.id) is task:
+            del self._retry_index[task.id]
+        elif self._pending_index.get(task.id) is task:
+            self._unindex_pending(task)
+            self._tombstones += 1
+            self._compact_heap()
+        else:
+            return
+        
+        self._release_key(task)
+        task.status = TaskStatus.CANCELLED
+        task.completed_at = datetime.utcnow()
+        self._persist(task)
+    
+    def _resolve_subscribers(self, task: QueueTask) -> List[QueueTask]:
+        """نقل نتيجة المهمة للمشتركين؛ يعيد المشتركين الذين انتهوا"""
+        for subscriber in task.subscribers:
+            subscriber.status = task.status
+            subscriber.progress = task.progress
+            subscriber.error_message = task.error_message
+            subscriber.result = task.result
+            subscriber.started_at = task.started_at
+            subscriber.completed_at = task.completed_at
+            self._persist(subscriber)
+        
+        if task.status == TaskStatus.PENDING:
+            return []  # إعادة محاولة أو إيقاف: يبقى المشتركون ملحقين
+        
+        finished, task.subscribers = task.subscribers, []
+        for subscriber in finished:
+            self._subscribers.pop(subscriber.id, None)
+            self._mark_finished(subscriber)
+        self._release_key(task)
+        return finished
+    
+    async def _sync_subscribers(self, task: QueueTask):
+        """مزامنة حالة المشتركين مع المهمة الأساسية وإبلاغ الجميع"""
+        for subscriber in task.subscribers:
+            subscriber.status = task.status
+            subscriber.progress = task.progress
+            subscriber.started_at = task.started_at
+        
+        await self._notify_listeners([task, *task.subscribers])
+    
+    async def _notify_listeners(self, tasks: List[QueueTask]):
+        """استدعاء مستمعي التقدم دون أن يوقف خطأ أحدهم المهمة"""
+        for task in tasks:
+            if not task.listener:
+                continue
+            try:
+                await task.listener(task)
+            except Exception as e:
+                logger.error(f"❌ خطأ في مستمع المهمة {task.id}: {e}")
+    
+    def _notify_dispatcher(self):
+        """إيقاظ الموزع لملء الخانات الفارغة"""
+        self._wakeup.set()
+    
+    def _schedule_retry(self, task: QueueTask) -> float:
+        """جدولة إعادة المحاولة بعد تأخير متزايد مع تذبذب عشوائي لتفادي موجات الإعادة"""
+        delay = min(self.retry_base_delay * task.retry_count, self.retry_max_delay)
+        delay *= random.uniform(0.8, 1.2)
+        
+        self._retry_seq += 1
+        heapq.heappush(self._delayed, (time.monotonic() + delay, self._retry_seq, task))
+        self._retry_index[task.id] = task
+        self._persist(task)
+        return delay
+    
+    def _promote_due_retries(self):
+        """نقل المهام التي حان موعدها من heap التأجيل إلى قائمة الانتظار"""
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, task = heapq.heappop(self._delayed)
+            if self._retry_index.get(task.id) is task:
+                del self._retry_index[task.id]
+                self._push_pending(task)
+    
+    def _next_retry_in(self) -> Optional[float]:
+        """الوقت حتى أقرب موعد إعادة محاولة (None إذا لا يوجد)"""
+        if not self._delayed:
+            return None
+        return max(0.0, self._delayed[0][0] - time.monotonic())
     
     async def _process_queue(self):
-        """معالج القائمة الرئيسي"""
+        """معالج القائمة الرئيسي (مدفوع بالأحداث ومواعيد إعادة المحاولة)"""
         while self._is_running:
             try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_retry_in())
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
                 await self._process_pending_tasks()
-                await self._cleanup_completed_tasks()
-                await asyncio.sleep(1)  # فحص كل ثانية
                 
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logger.error(f"❌ خطأ في معالج القائمة: {e}")
-                await asyncio.sleep(5)
+                await asyncio.sleep(1)
+                self._notify_dispatcher()
     
     async def _process_pending_tasks(self):
-        """معالجة المهام المنتظرة"""
+        """معالجة المهام المنتظرة وملء جميع الخانات الفارغة دفعة واحدة"""
         async with self.queue_lock:
-            # فحص إذا كان هناك مساحة للمهام الجديدة
-            if len(self.running_tasks) >= self.max_concurrent:
-                return
-            
-            # فحص إذا كان هناك مهام منتظرة
-            if not self.pending_queue:
-                return
-            
-            # أخذ المهمة التالية
-            task = heapq.heappop(self.pending_queue)
-            
-            # بدء تنفيذ المهمة
-            task.status = TaskStatus.RUNNING
-            task.started_at = datetime.utcnow()
-            
-            # إنشاء مهمة asyncio
-            asyncio_task = asyncio.create_task(self._execute_task(task))
+            self._promote_due_retries()
             
-            self.running_tasks[task.id] = {
-                'task': task,
-                'asyncio_task': asyncio_task
-            }
-            
-            logger.info(f"▶️ بدء تنفيذ المهمة: {task.id}")
+            # أخذ المهام التالية طالما هناك مساحة ومهام منتظرة
+            while self._pending_index and len(self.running_tasks) < self.max_concurrent:
+                task = self._pop_best_fit()
+                if task is None:
+                    break
+                
+                # بدء تنفيذ المهمة
+                task.status = TaskStatus.RUNNING
+                task.started_at = datetime.utcnow()
+                
+                # إنشاء مهمة asyncio
+                asyncio_task = asyncio.create_task(self._execute_task(task))
+                
+                self.running_tasks[task.id] = {
+                    'task': task,
+                    'asyncio_task': asyncio_task
+                }
+                self._persist(task)
+                
+                logger.info(f"▶️ بدء تنفيذ المهمة: {task.id}")
+    
+    async def _run_with_deadline(self, task: QueueTask) -> Dict:
+        """تشغيل المعالج حتى task.deadline + الهامش
+        
+        المعالج قد يوقف الساعة (deadline = None) أثناء انتظار خارجي لا يستهلك
+        موارد المهمة، مثل انتظار عامل يحجز المهمة من الوسيط، ثم يعيد ضبطها.
+        """
+        runner = asyncio.ensure_future(self._run_callback(task))
+        try:
+            while not runner.done():
+                if task.deadline is None:
+                    timeout = DEADLINE_CHECK_INTERVAL
+                else:
+                    timeout = task.deadline + self.deadline_grace - time.monotonic()
+                    if timeout <= 0:
+                        runner.cancel()
+                        await asyncio.gather(runner, return_exceptions=True)
+                        raise asyncio.TimeoutError()
+                await asyncio.wait({runner}, timeout=timeout)
+            return runner.result()
+        except asyncio.CancelledError:
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+            raise
+    
+    async def _run_callback(self, task: QueueTask) -> Dict:
+        """تشغيل المعالج مع تمييز مهلاته الداخلية عن مهلة القائمة"""
+        try:
+            return await task.callback(task)
+        except asyncio.TimeoutError as e:
+            raise Exception(f"انتهت مهلة داخلية: {e}") from e
     
     async def _execute_task(self, task: QueueTask):
-        """تنفيذ مهمة واحدة"""
+        """تنفيذ مهمة واحدة ضمن مهلتها"""
+        started = time.monotonic()
+        task.deadline = started + task.timeout
         try:
+            # إبلاغ صاحب المهمة والمشتركين ببدء التنفيذ
+            await self._sync_subscribers(task)
+            
             if task.callback:
-                # تنفيذ المهمة مع callback
-                result = await task.callback(task)
+                # المعالج يُنهي نفسه عند task.deadline بأرشيف جزئي؛ الإلغاء القسري بعد الهامش
+                result = await self._run_with_deadline(task)
+                task.result = result
                 
                 if result.get('success', False):
                     task.status = TaskStatus.COMPLETED
                     task.progress = 100.0
                     self.stats['completed_tasks'] += 1
+                    self._record_duration(task, time.monotonic() - started)
                 else:
                     raise Exception(result.get('error', 'Unknown error'))
             else:
@@ -314,26 +1091,35 @@ class DownloadQueue:
                 task.progress = 100.0
                 self.stats['completed_tasks'] += 1
             
+        except asyncio.TimeoutError:
+            # مهمة عالقة تجاوزت المهلة والهامش (معالج التنزيل يسلّم أرشيفه الجزئي قبل ذلك،
+            # فهذا لمعالجات لا تحترم task.deadline): لا إعادة محاولة كي لا تحجز الخانة مجدداً
+            task.status = TaskStatus.FAILED
+            task.error_message = f"تجاوزت المهمة المهلة ({task.timeout:.0f} ثانية)"
+            self.stats['failed_tasks'] += 1
+            self.stats['timed_out_tasks'] += 1
+            self._record_duration(task, time.monotonic() - started)
+            logger.error(f"⏱️ تم إيقاف المهمة العالقة: {task.id}")
+            
         except asyncio.CancelledError:
-            task.status = TaskStatus.CANCELLED
-            self.stats['cancelled_tasks'] += 1
-            logger.info(f"🚫 تم إلغاء المهمة: {task.id}")
+            if not self._is_running and self.store:
+                # إيقاف البوت وليس إلغاء المستخدم: تُستأنف المهمة بعد إعادة التشغيل
+                task.status = TaskStatus.PENDING
+                task.started_at = None
+                logger.info(f"💾 حفظ المهمة للاستئناف بعد إعادة التشغيل: {task.id}")
+            else:
+                task.status = TaskStatus.CANCELLED
+                self.stats['cancelled_tasks'] += 1
+                logger.info(f"🚫 تم إلغاء المهمة: {task.id}")
             
         except Exception as e:
             task.error_message = str(e)
             task.retry_count += 1
             
-            # إعادة المحاولة إذا لم نصل للحد الأقصى
+            # إعادة المحاولة إذا لم نصل للحد الأقصى (تُجدول في finally بعد تحرير الخانة)
             if task.retry_count <= task.max_retries:
                 task.status = TaskStatus.PENDING
                 task.started_at = None
-                
-                # إعادة إضافة للقائمة مع تأخير
-                await asyncio.sleep(min(task.retry_count * 5, 30))  # تأخير متزايد
-                async with self.queue_lock:
-                    heapq.heappush(self.pending_queue, task)
-                
-                logger.warning(f"🔄 إعادة محاولة المهمة: {task.id} (المحاولة {task.retry_count})")
             else:
                 task.status = TaskStatus.FAILED
                 self.stats['failed_tasks'] += 1
@@ -346,27 +1132,25 @@ class DownloadQueue:
             async with self.queue_lock:
                 if task.id in self.running_tasks:
                     del self.running_tasks[task.id]
-                self.completed_tasks[task.id] = task
-    
-    async def _cleanup_completed_tasks(self):
-        """تنظيف المهام المكتملة القديمة"""
-        if len(self.completed_tasks) <= 1000:  # احتفظ بآخر 1000 مهمة
-            return
-        
-        # ترتيب حسب تاريخ الإكمال
-        sorted_tasks = sorted(
-            self.completed_tasks.items(),
-            key=lambda x: x[1].completed_at or x[1].created_at
-        )
-        
-        # حذف النصف الأقدم
-        tasks_to_remove = sorted_tasks[:len(sorted_tasks)//2]
-        
-        async with self.queue_lock:
-            for task_id, _ in tasks_to_remove:
-                del self.completed_tasks[task_id]
-        
-        logger.info(f"🧹 تم تنظيف {len(tasks_to_remove)} مهمة قديمة")
+                finished_subscribers = self._resolve_subscribers(task)
+                if task.status == TaskStatus.PENDING:
+                    if self._is_running:
+                        delay = self._schedule_retry(task)
+                        logger.warning(f"🔄 إعادة محاولة المهمة: {task.id} بعد {delay:.1f} ثانية "
+                                       f"(المحاولة {task.retry_count})")
+                    else:
+                        self._persist(task)
+                elif task.detached:
+                    # صاحبها ألغاها سابقاً؛ النتيجة سُلمت للمشتركين فقط
+                    task.status = TaskStatus.CANCELLED
+                    self._persist(task)
+                elif task.id in self.user_queues.get(task.user_id, {}):
+                    self._mark_finished(task)
+                    self._persist(task)
+            
+            # تحرير الخانة فوراً للمهمة التالية
+            self._notify_dispatcher()
+            await self._notify_listeners([task, *finished_subscribers])
 
 # إنشاء مثيل عام للاستخدام
-download_queue = DownloadQueue()
+download_queue = DownloadQueue(store=QueueStore() if config.Config.QUEUE_PERSISTENCE else None)
@@ -0,0 +1,246 @@
+"""
+مخزن دائم لقائمة الانتظار
+Durable Queue Store (SQLite WAL)
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from utils.logger import logger
+import config
+
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+_COLUMNS = (
+    'id', 'user_id', 'url', 'priority', 'status', 'handler', 'context', 'weight',
+    'retry_count', 'max_retries', 'error_message', 'created_at', 'started_at',
+    'completed_at', 'lease_owner', 'lease_until', 'updated_at'
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue_tasks (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    handler TEXT,
+    context TEXT,
+    weight REAL DEFAULT 1.0,
+    retry_count INTEGER DEFAULT 0,
+    max_retries INTEGER DEFAULT 3,
+    error_message TEXT,
+    created_at TEXT,
+    started_at TEXT,
+    completed_at TEXT,
+    lease_owner TEXT,
+    lease_until REAL,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_queue_tasks_status_lease ON queue_tasks (status, lease_until);
+CREATE INDEX IF NOT EXISTS idx_queue_tasks_user_history ON queue_tasks (user_id, completed_at);
+"""
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+def _parse(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+class QueueStore:
+    """مخزن مهام دائم بكتابة مؤجلة على دفعات
+
+    الـ heap في الذاكرة يبقى المصدر السريع للجدولة؛ هذا المخزن يحفظ نسخة من
+    كل تغيير في الحالة على دفعات كل flush_interval، لذا قد تُفقد آخر أجزاء
+    الثانية فقط عند انهيار مفاجئ. المهام قيد التنفيذ محجوزة بعقد إيجار
+    (lease) يجدده العامل، وعند انتهائه تعود المهمة للانتظار.
+    """
+
+    def __init__(self, path: str = None, flush_interval: float = None,
+                 lease_timeout: float = None, batch_size: int = 500):
+        self.path = path or config.Config.QUEUE_DB_PATH
+        self.flush_interval = flush_interval or config.Config.QUEUE_FLUSH_INTERVAL
+        self.lease_timeout = lease_timeout or config.Config.QUEUE_LEASE_TIMEOUT
+        self.batch_size = batch_size
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._buffer: Dict[str, Tuple] = {}  # آخر حالة لكل مهمة (الكتابات المتكررة تندمج)
+        self._db_lock = asyncio.Lock()
+        self._flush_needed = asyncio.Event()
+        self._flush_task = None
+        self._is_running = False
+        self.stats = {'rows_written': 0, 'flushes': 0}
+
+    async def start(self):
+        """فتح قاعدة البيانات وبدء الكتابة الدورية"""
+        if self._is_running:
+            return
+
+        await asyncio.to_thread(self._open)
+        self._is_running = True
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"💾 تم فتح مخزن قائمة الانتظار: {self.path}")
+
+    async def stop(self):
+        """كتابة ما تبقى وإغلاق قاعدة البيانات"""
+        self._is_running = False
+
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+
+        await self.flush()
+        if self._conn:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+        logger.info("💾 تم إغلاق مخزن قائمة الانتظار")
+
+    def _open(self):
+        """إنشاء الاتصال والجدول (متزامنة)"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(_SCHEMA)
+
+        # حذف سجل المهام المنتهية القديمة
+        cutoff = time.time() - config.Config.QUEUE_STORE_RETENTION_DAYS * 86400
+        self._conn.execute(
+            f"DELETE FROM queue_tasks WHERE status IN {FINISHED_STATUSES} AND updated_at < ?",
+            (cutoff,)
+        )
+
+    def save(self, task, lease_owner: str = None, lease_until: float = None):
+        """تسجيل حالة المهمة في الدفعة التالية (بدون انتظار)"""
+        self._buffer[task.id] = (
+            task.id, task.user_id, task.url, task.priority.value, task.status.value,
+            task.handler, json.dumps(task.context, default=str), task.weight,
+            task.retry_count, task.max_retries, task.error_message,
+            _iso(task.created_at), _iso(task.started_at), _iso(task.completed_at),
+            lease_owner, lease_until, time.time()
+        )
+
+        if len(self._buffer) >= self.batch_size:
+            self._flush_needed.set()
+
+    async def _flush_loop(self):
+        """كتابة الدفعات دورياً أو عند امتلاء المخزن المؤقت"""
+        while self._is_running:
+            try:
+                try:
+                    await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_needed.clear()
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في كتابة مخزن قائمة الانتظار: {e}")
+
+    async def flush(self):
+        """كتابة الدفعة الحالية في معاملة واحدة"""
+        if not self._buffer or not self._conn:
+            return
+
+        rows, self._buffer = list(self._buffer.values()), {}
+        async with self._db_lock:
+            await asyncio.to_thread(self._write_rows, rows)
+
+        self.stats['rows_written'] += len(rows)
+        self.stats['flushes'] += 1
+
+    def _write_rows(self, rows: List[Tuple]):
+        placeholders = ", ".join("?" * len(_COLUMNS))
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO queue_tasks ({', '.join(_COLUMNS)}) VALUES ({placeholders})",
+                rows
+            )
+
+    async def renew_leases(self, task_ids: List[str], owner: str) -> None:
+        """تجديد عقود المهام قيد التنفيذ لهذا العامل"""
+        await self.flush()
+        if not task_ids or not self._conn:
+            return
+
+        lease_until = time.time() + self.lease_timeout
+        async with self._db_lock:
+            await asyncio.to_thread(self._execute_many,
+                "UPDATE queue_tasks SET lease_until = ? WHERE id = ? AND lease_owner = ?",
+                [(lease_until, task_id, owner) for task_id in task_ids]
+            )
+
+    def _execute_many(self, sql: str, params: List[Tuple]):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(sql, params)
+
+    async def load_recoverable(self, include_pending: bool = True) -> List[Dict]:
+        """المهام المنتظرة والمهام التي انتهى عقدها (عامل متوقف أو منهار)"""
+        await self.flush()
+        if not self._conn:
+            return []
+
+        async with self._db_lock:
+            return await asyncio.to_thread(self._select_recoverable, time.time(), include_pending)
+
+    def _select_recoverable(self, now: float, include_pending: bool) -> List[Dict]:
+        condition = "status = 'running' AND lease_until < ?"
+        if include_pending:
+            condition = f"status = 'pending' OR ({condition})"
+
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM queue_tasks WHERE {condition} ORDER BY created_at",
+            (now,)
+        )
+        return [self._row_to_dict(row) for row in cursor.fetchall()]
+
+    async def load_user_history(self, user_id: int, limit: int) -> List[Dict]:
+        """أحدث المهام المنتهية للمستخدم (للسجل الذي خرج من الذاكرة)"""
+        await self.flush()
+        if not self._conn:
+            return []
+
+        async with self._db_lock:
+            return await asyncio.to_thread(self._select_user_history, user_id, limit)
+
+    def _select_user_history(self, user_id: int, limit: int) -> List[Dict]:
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM queue_tasks "
+            f"WHERE user_id = ? AND status IN {FINISHED_STATUSES} "
+            "ORDER BY completed_at DESC LIMIT ?",
+            (user_id, limit)
+        )
+        return [self._row_to_dict(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _row_to_dict(row: Tuple) -> Dict:
+        data = dict(zip(_COLUMNS, row))
+        data['context'] = json.loads(data['context']) if data['context'] else {}
+        for key in ('created_at', 'started_at', 'completed_at'):
+            data[key] = _parse(data[key])
+        return data
+
+    def get_stats(self) -> Dict:
+        """إحصائيات المخزن"""
+        return {
+            'path': self.path,
+            'buffered': len(self._buffer),
+            'rows_written': self.stats['rows_written'],
+            'flushes': self.stats['flushes'],
+        }
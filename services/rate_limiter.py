@@ -0,0 +1,266 @@
+"""
+محدد معدل الطلبات الصادرة إلى Telegram Bot API
+Outbound Telegram Rate Limiter (global + per-chat token buckets)
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from utils.logger import logger
+import config
+
+PROM_REQUESTS = Counter('bot_telegram_requests_total', 'Outbound Telegram API requests', ['priority'])
+PROM_RETRY_AFTER = Counter('bot_telegram_retry_after_total', 'RetryAfter responses from Telegram')
+PROM_WAIT = Histogram('bot_telegram_request_wait_seconds', 'Time a request waited for a send slot',
+                      ['priority'], buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60))
+PROM_QUEUED = Gauge('bot_telegram_requests_queued', 'Requests waiting for a send slot')
+
+MAX_IDLE_BUCKETS = 10000  # حاويات المحادثات الممتلئة تُحذف بعد هذا العدد
+
+class Priority:
+    """أولوية الطلب الصادر (الأصغر أولاً)"""
+    INTERACTIVE = 0  # ردود مباشرة على المستخدم
+    PROGRESS = 1     # تعديلات رسائل التقدم
+    BULK = 2         # الرسائل الجماعية
+
+# نقاط نهاية لا تخص محادثة (أو ردود استعلام) لا تخضع لحد المحادثة
+_CHATLESS_ENDPOINTS = {'answerCallbackQuery', 'answerInlineQuery', 'getMe', 'getFile',
+                       'getChat', 'getChatMember', 'setMyCommands', 'setWebhook', 'deleteWebhook'}
+_PROGRESS_ENDPOINTS = {'editMessageText', 'editMessageReplyMarkup'}
+
+class TokenBucket:
+    """حاوية رموز: معدل تعبئة ثابت مع سعة للدفعات"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """الثواني حتى توفر رمز (0 إذا متوفر الآن)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundRateLimiter(BaseRateLimiter[Dict]):
+    """جدولة كل طلبات البوت الصادرة ضمن حدود تيليجرام
+
+    يُمرر للتطبيق عبر Application.builder().rate_limiter() فيشمل context.bot
+    وكل المرسلين. كل طلب ينتظر رمزاً من الحاوية العامة ومن حاوية محادثته،
+    والانتظار يُخدم بحسب الأولوية مع تخطي محادثة مشبعة إلى غيرها. عند
+    RetryAfter يتوقف كل الإرسال حتى انتهاء المدة ثم يُعاد الطلب.
+
+    الأولوية تُحدد بـ rate_limit_args={'priority': Priority.BULK} أو من نوع الطلب.
+    """
+
+    def __init__(self, global_rate: float = None, chat_rate: float = None, group_rate: float = None,
+                 chat_burst: float = None, max_retries: int = None):
+        self.global_rate = global_rate or config.Config.TELEGRAM_GLOBAL_RATE
+        self.chat_rate = chat_rate or config.Config.TELEGRAM_CHAT_RATE
+        self.group_rate = group_rate or config.Config.TELEGRAM_GROUP_RATE
+        self.chat_burst = chat_burst or config.Config.TELEGRAM_CHAT_BURST
+        self.max_retries = config.Config.TELEGRAM_MAX_RETRIES if max_retries is None else max_retries
+
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._waiting = {p: deque() for p in (Priority.INTERACTIVE, Priority.PROGRESS, Priority.BULK)}
+        self._blocked_until = 0.0
+
+        self._wakeup = asyncio.Event()
+        self._dispatch_task = None
+        self.stats = {'requests': 0, 'retry_after': 0, 'retried': 0}
+
+    async def initialize(self) -> None:
+        """بدء موزع الرموز (يستدعيه البوت عند تهيئته)"""
+        if self._dispatch_task is None:
+            self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+            logger.info(f"🚦 تم بدء محدد معدل تيليجرام ({self.global_rate:.0f} طلب/ثانية)")
+
+    async def shutdown(self) -> None:
+        """إيقاف الموزع؛ الطلبات المنتظرة تُرسل مباشرة كي لا تعلق"""
+        if self._dispatch_task:
+            self._dispatch_task.cancel()
+            await asyncio.gather(self._dispatch_task, return_exceptions=True)
+            self._dispatch_task = None
+
+        for waiting in self._waiting.values():
+            while waiting:
+                _, future = waiting.popleft()
+                if not future.done():
+                    future.set_result(None)
+        PROM_QUEUED.set(0)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict],
+    ):
+        """انتظار خانة إرسال ثم تنفيذ الطلب مع إعادة المحاولة عند RetryAfter"""
+        priority = self._priority(endpoint, rate_limit_args)
+        chat_id = None if endpoint in _CHATLESS_ENDPOINTS else data.get('chat_id')
+        self.stats['requests'] += 1
+        PROM_REQUESTS.labels(priority=priority).inc()
+
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            await self._acquire(priority, chat_id)
+            PROM_WAIT.labels(priority=priority).observe(time.monotonic() - started)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = float(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+                self._block(seconds)
+
+                # تعديلات التقدم لا تُعاد: الناشر يدمجها بحالة أحدث
+                if priority == Priority.PROGRESS or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.stats['retried'] += 1
+
+    def _priority(self, endpoint: str, rate_limit_args: Optional[Dict]) -> int:
+        if rate_limit_args and 'priority' in rate_limit_args:
+            return rate_limit_args['priority']
+        if endpoint in _PROGRESS_ENDPOINTS:
+            return Priority.PROGRESS
+        return Priority.INTERACTIVE
+
+    def _block(self, seconds: float):
+        """توقف عام لكل الإرسال بعد RetryAfter"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self.stats['retry_after'] += 1
+        PROM_RETRY_AFTER.inc()
+        logger.warning(f"⏳ تيليجرام طلب التوقف {seconds:.0f} ثانية، تأجيل كل الطلبات الصادرة")
+        self._wakeup.set()
+
+    def blocked_for(self) -> float:
+        """الثواني المتبقية من توقف RetryAfter العام"""
+        return max(0.0, self._blocked_until - time.monotonic())
+
+    async def _acquire(self, priority: int, chat_id):
+        """الانتظار في طابور الأولوية حتى يمنح الموزع رمزاً"""
+        if self._dispatch_task is None:
+            return  # المحدد غير مهيأ (اختبارات أو بعد الإيقاف)
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[priority].append((chat_id, future))
+        PROM_QUEUED.inc()
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # الطلب أُلغي قبل منحه رمزاً: إزالته من الطابور
+            try:
+                self._waiting[priority].remove((chat_id, future))
+                PROM_QUEUED.dec()
+            except ValueError:
+                pass
+            raise
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # المجموعات والقنوات (معرف سالب أو @اسم) حدها أقل بكثير من المحادثات الخاصة
+            is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+            if is_group:
+                bucket = TokenBucket(self.group_rate, 1.0)
+            else:
+                bucket = TokenBucket(self.chat_rate, max(1.0, self.chat_burst))
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _grant_ready(self, now: float) -> Optional[float]:
+        """منح الرموز المتاحة بترتيب الأولوية؛ يعيد ثواني الانتظار حتى المنح التالي"""
+        next_wait = None
+        for priority in (Priority.INTERACTIVE, Priority.PROGRESS, Priority.BULK):
+            waiting = self._waiting[priority]
+            index = 0
+            while index < len(waiting):
+                global_wait = self._global.wait_time(now)
+                if global_wait > 0:
+                    return global_wait
+
+                chat_id, future = waiting[index]
+                if future.done():
+                    del waiting[index]
+                    PROM_QUEUED.dec()
+                    continue
+
+                chat_wait = self._chat_bucket(chat_id).wait_time(now) if chat_id is not None else 0.0
+                if chat_wait > 0:
+                    # محادثة مشبعة لا تحجز الطابور عن غيرها
+                    next_wait = chat_wait if next_wait is None else min(next_wait, chat_wait)
+                    index += 1
+                    continue
+
+                del waiting[index]
+                PROM_QUEUED.dec()
+                self._global.take(now)
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).take(now)
+                future.set_result(None)
+        return next_wait
+
+    def _prune_buckets(self, now: float):
+        """حذف حاويات المحادثات الممتلئة (لا فرق بينها وبين حاوية جديدة)"""
+        if len(self._chats) > MAX_IDLE_BUCKETS:
+            for chat_id in [c for c, bucket in self._chats.items() if bucket.is_full(now)]:
+                del self._chats[chat_id]
+
+    async def _dispatch_loop(self):
+        """منح الرموز للطلبات المنتظرة عند توفرها"""
+        while True:
+            try:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    timeout = self._blocked_until - now
+                else:
+                    timeout = self._grant_ready(now)
+                    self._prune_buckets(now)
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في محدد معدل تيليجرام: {e}")
+                await asyncio.sleep(1)
+
+    def get_stats(self) -> Dict:
+        """إحصائيات المحدد"""
+        return {
+            'queued': {p: len(w) for p, w in self._waiting.items()},
+            'tracked_chats': len(self._chats),
+            'blocked_for': round(self.blocked_for(), 1),
+            **self.stats,
+        }
+
+# إنشاء مثيل عام للاستخدام
+outbound_limiter = OutboundRateLimiter()
@@ -0,0 +1,102 @@
+"""
+معالجة التحديثات بالتوازي مع الحفاظ على ترتيب كل محادثة
+Chat-Ordered Concurrent Update Processor
+"""
+
+import asyncio
+import functools
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from prometheus_client import Gauge, Histogram
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from utils.logger import logger
+import config
+
+PROM_HANDLER_DURATION = Histogram('bot_handler_duration_seconds', 'Telegram handler duration', ['handler'],
+                                  buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+PROM_UPDATES_ACTIVE = Gauge('bot_updates_in_progress', 'Updates being processed')
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """تحديثات المحادثات المختلفة تُعالج بالتوازي وتحديثات المحادثة الواحدة بالترتيب
+
+    التطبيق ينشئ مهمة لكل تحديث بترتيب وصوله؛ كل مهمة تنتظر أولاً قفل
+    محادثتها (أقفال asyncio تخدم المنتظرين بالترتيب) ثم خانة من الحد العام.
+    الانتظار على القفل قبل الخانة مقصود: محادثة ترسل رسائل كثيرة متتالية
+    لا تحجز خانات العمال عن بقية المستخدمين.
+    """
+
+    def __init__(self, max_concurrent_updates: int = None):
+        super().__init__(max_concurrent_updates or config.Config.UPDATE_CONCURRENCY)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+
+    async def initialize(self) -> None:
+        """لا موارد للتهيئة"""
+
+    async def shutdown(self) -> None:
+        """لا موارد للتحرير"""
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        """قفل المحادثة ثم خانة من الحد العام"""
+        key = self._chat_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+        self._chat_waiters[key] = self._chat_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            # آخر مستخدم للقفل يحذفه كي لا تتراكم أقفال كل المحادثات
+            self._chat_waiters[key] -= 1
+            if not self._chat_waiters[key]:
+                del self._chat_waiters[key]
+                del self._chat_locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        PROM_UPDATES_ACTIVE.inc()
+        try:
+            await coroutine
+        finally:
+            PROM_UPDATES_ACTIVE.dec()
+
+    def get_stats(self) -> Dict:
+        """إحصائيات المعالج"""
+        return {
+            'max_concurrent': self.max_concurrent_updates,
+            'active_chats': len(self._chat_locks),
+        }
+
+def timed_handler(callback: Callable, name: str = None) -> Callable:
+    """تغليف معالج تيليجرام لقياس مدته وتسجيل البطيء منه"""
+    name = name or getattr(callback, '__name__', 'handler')
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.monotonic()
+        try:
+            return await callback(update, context)
+        finally:
+            duration = time.monotonic() - started
+            PROM_HANDLER_DURATION.labels(handler=name).observe(duration)
+            if duration > config.Config.SLOW_HANDLER_THRESHOLD:
+                logger.warning(f"🐢 المعالج {name} استغرق {duration:.2f} ثانية")
+
+    return wrapper
@@ -0,0 +1,149 @@
+"""
+استقبال تحديثات تيليجرام عبر Webhook
+Webhook Receiver (FastAPI + uvicorn on the bot's event loop)
+"""
+
+import asyncio
+import hmac
+from typing import Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, Response
+from telegram import Update
+
+from utils.logger import logger
+import config
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class _EmbeddedServer(uvicorn.Server):
+    """خادم uvicorn داخل حلقة البوت: إشارات الإيقاف يعالجها main وليس الخادم"""
+
+    def install_signal_handlers(self):
+        pass
+
+class WebhookServer:
+    """نقطة Webhook تضع التحديثات في update_queue للتطبيق وترد فوراً
+
+    تيليجرام يرسل كل تحديث كطلب POST مع الترويسة السرية المسجلة في
+    setWebhook؛ الطلبات بدون السر الصحيح تُرفض، والخادم لا يعمل بدون سر لأن
+    النقطة عامة وأي طلب مزور باسم المشرف سيُنفذ. الرد لا ينتظر المعالجة،
+    فتيليجرام يرسل التحديثات التالية بالتوازي (حتى max_connections)، ويمكن
+    وضع عدة نسخ من البوت خلف موزع حمل؛ تسجيل العنوان (register) يتم من
+    نسخة واحدة فقط وليس عند بدء كل نسخة.
+    """
+
+    def __init__(self, application=None, url: str = None, path: str = None, secret: str = None,
+                 host: str = None, port: int = None):
+        self.application = application
+        self.url = (url if url is not None else config.Config.WEBHOOK_URL).rstrip("/")
+        self.path = path or config.Config.WEBHOOK_PATH
+        self.secret = secret if secret is not None else config.Config.WEBHOOK_SECRET
+        self.host = host or config.Config.WEBHOOK_HOST
+        self.port = port if port is not None else config.Config.WEBHOOK_PORT
+
+        self.app = FastAPI(title="WebMaster Bot Webhook", docs_url=None, redoc_url=None)
+        self._server: Optional[uvicorn.Server] = None
+        self._server_task = None
+        self.stats = {'received': 0, 'rejected': 0, 'invalid': 0}
+        self.setup_routes()
+
+    def setup_routes(self):
+        """إعداد مسارات الاستقبال"""
+
+        @self.app.post(self.path)
+        async def receive_update(request: Request):
+            if not self._authorized(request.headers.get(SECRET_HEADER)):
+                self.stats['rejected'] += 1
+                raise HTTPException(status_code=403, detail="invalid secret token")
+
+            try:
+                update = Update.de_json(await request.json(), self.application.bot)
+            except Exception as e:
+                # تحديث تالف: 200 كي لا يعيد تيليجرام إرساله بلا نهاية
+                self.stats['invalid'] += 1
+                logger.warning(f"⚠️ تحديث Webhook غير صالح: {e}")
+                return Response(status_code=200)
+
+            self.stats['received'] += 1
+            await self.application.update_queue.put(update)
+            return Response(status_code=200)
+
+        @self.app.get("/health")
+        async def health():
+            return {"status": "ok", **self.stats}
+
+    def _authorized(self, token: Optional[str]) -> bool:
+        if not self.secret or token is None:
+            return False
+        return hmac.compare_digest(token.encode(), self.secret.encode())
+
+    async def start(self, application=None):
+        """تشغيل خادم الاستقبال (دون تسجيل العنوان لدى تيليجرام)"""
+        if self._server_task:
+            return
+
+        if application is not None:
+            self.application = application
+        if not self.secret:
+            raise Exception("WEBHOOK_SECRET مطلوب لوضع Webhook: بدونه يمكن لأي أحد إرسال تحديثات مزورة")
+
+        self._server = _EmbeddedServer(uvicorn.Config(
+            self.app, host=self.host, port=self.port, log_level="warning", lifespan="off"
+        ))
+        self._server_task = asyncio.create_task(self._server.serve())
+        while not self._server.started:
+            if self._server_task.done():
+                # فشل الربط بالمنفذ مثلاً
+                self._server_task.result()
+                raise Exception("تعذر تشغيل خادم Webhook")
+            await asyncio.sleep(0.05)
+
+        logger.info(f"🪝 تم بدء استقبال Webhook على {self.host}:{self.port}{self.path}")
+
+    async def register(self, bot=None, allowed_updates: List[str] = None,
+                       drop_pending_updates: bool = False):
+        """تسجيل عنوان Webhook والسر لدى تيليجرام
+
+        يُستدعى من نسخة واحدة (WEBHOOK_REGISTER) لا من كل نسخة: إعادة التسجيل عند
+        كل إعادة تشغيل أو توسعة قد تُسقط التحديثات المنتظرة إن طُلب ذلك.
+        """
+        if not self.url:
+            raise Exception("WEBHOOK_URL مطلوب لتسجيل Webhook")
+        if not self.secret:
+            raise Exception("WEBHOOK_SECRET مطلوب لتسجيل Webhook")
+
+        bot = bot or self.application.bot
+        await bot.set_webhook(
+            url=f"{self.url}{self.path}",
+            secret_token=self.secret,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=drop_pending_updates,
+            max_connections=config.Config.WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info(f"🪝 تم تسجيل عنوان Webhook: {self.url}{self.path}")
+
+    async def stop(self):
+        """إيقاف الخادم (عنوان Webhook يبقى مسجلاً لبقية النسخ أو لإعادة التشغيل)"""
+        if not self._server_task:
+            return
+
+        self._server.should_exit = True
+        await asyncio.gather(self._server_task, return_exceptions=True)
+        self._server_task = None
+        self._server = None
+        logger.info("⏹️ تم إيقاف استقبال Webhook")
+
+    @property
+    def bound_port(self) -> Optional[int]:
+        """المنفذ الفعلي (مفيد عند port=0)"""
+        if not self._server or not self._server.servers:
+            return None
+        return self._server.servers[0].sockets[0].getsockname()[1]
+
+    def get_stats(self) -> Dict:
+        """إحصائيات الاستقبال"""
+        return dict(self.stats)
+
+# إنشاء مثيل عام للاستخدام
+webhook_server = WebhookServer()
@@ -0,0 +1,260 @@
+"""
+عامل الزحف ومعالجات تنفيذ مهام التنزيل
+Crawl Worker and Download Task Handlers
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from typing import Callable, Dict
+
+from services.broker import Broker, JobStatus
+from services.downloader import WebsiteDownloader, DownloadQuota
+from services.queue_manager import DownloadQueue, QueueTask, download_queue
+from utils.logger import logger
+import config
+
+DOWNLOAD_HANDLER = "download"
+
+def task_payload(task: QueueTask) -> Dict:
+    """البيانات اللازمة لتنفيذ مهمة التنزيل في أي عملية"""
+    options = dict(task.context.get('options') or {})
+
+    # المهلة المتبقية تصبح حد وقت الحصة، فيُنشأ أرشيف جزئي قبل إلغاء القائمة للمهمة.
+    # إذا كانت ساعة المهلة متوقفة (انتظار الوسيط) فالحصة كاملة وتبدأ عند حجز العامل لها
+    if task.deadline is not None:
+        remaining = max(1.0, task.deadline - time.monotonic())
+    else:
+        remaining = task.timeout
+    options['max_wall_time'] = min(options.get('max_wall_time', remaining), remaining)
+
+    return {
+        'task_id': task.id,
+        'user_id': task.user_id,
+        'url': task.url,
+        'options': options,
+    }
+
+async def run_download(downloader: WebsiteDownloader, payload: Dict,
+                       progress_callback: Callable = None) -> Dict:
+    """تنفيذ تنزيل واحد وإرجاع نتيجة قابلة للتسلسل (مسار الأرشيف على المجلد المشترك)
+
+    كل تنزيل يعمل على نسخة خاصة من المحرك (fork)، فلا تختلط عدادات المهام
+    المتزامنة ولا يصل تقدم مهمة إلى أخرى.
+    """
+    options = payload.get('options') or {}
+    quota = DownloadQuota(**{
+        key: options[key] for key in ('max_pages', 'max_bytes', 'max_assets_per_page', 'max_wall_time')
+        if key in options
+    })
+
+    job = downloader.fork(progress_callback)
+    output_dir = os.path.join(config.Config.DOWNLOADS_DIR, payload['task_id'])
+
+    # الحصة تُنهي الزحف عند max_wall_time، لكن عملية واحدة عالقة (صفحة أو ضغط) قد
+    # تتجاوزها؛ الإيقاف هنا قبل إلغاء القائمة القسري يحفظ ما نُزّل كأرشيف جزئي
+    hard_limit = quota.max_wall_time + config.Config.TASK_DEADLINE_GRACE / 2
+    try:
+        zip_path, files_count, total_size = await asyncio.wait_for(
+            job.download_website(payload['url'], output_dir, user_id=payload.get('user_id'), quota=quota),
+            timeout=hard_limit
+        )
+    except asyncio.TimeoutError:
+        salvaged = await job.salvage_partial(payload['url'], output_dir)
+        if salvaged is None:
+            raise Exception(f"توقف الزحف بعد {hard_limit:.0f} ثانية دون تنزيل أي ملف")
+
+        logger.warning(f"⏱️ إيقاف زحف عالق للمهمة {payload['task_id']} - تسليم أرشيف جزئي")
+        zip_path, files_count, total_size = salvaged
+        quota.exceeded = quota.exceeded or "wall_time"
+
+    return {
+        'success': True,
+        'zip_path': zip_path,
+        'files_count': files_count,
+        'total_size': total_size,
+        'partial': quota.exceeded is not None,
+    }
+
+def make_local_handler(downloader: WebsiteDownloader, queue: DownloadQueue = None) -> Callable:
+    """معالج ينفذ الزحف داخل عملية البوت نفسها (المتصفح مشترك، حالة الزحف لكل مهمة)"""
+    queue = queue or download_queue
+
+    async def local_download(task: QueueTask) -> Dict:
+        async def on_progress(progress: float, message: str = ""):
+            await queue.report_progress(task, progress)
+
+        return await run_download(downloader, task_payload(task), on_progress)
+
+    return local_download
+
+async def _attach_or_submit(broker: Broker, task: QueueTask, queue: DownloadQueue) -> str:
+    """إعادة الارتباط بمهمة الوسيط المحفوظة في سياق المهمة أو إرسال مهمة جديدة"""
+    job_id = task.context.get('broker_job_id')
+    if job_id:
+        job = await broker.get(job_id)
+        # بعد إعادة تشغيل الواجهة يستمر الزحف الجاري على العامل بدلاً من تكراره
+        if job and job['status'] not in (JobStatus.FAILED, JobStatus.CANCELLED):
+            logger.info(f"🔗 إعادة الارتباط بمهمة الوسيط {job_id} للمهمة {task.id}")
+            return job_id
+
+    job_id = await broker.submit(DOWNLOAD_HANDLER, task_payload(task), task.priority.value)
+    task.context['broker_job_id'] = job_id
+    queue.save_task(task)
+    return job_id
+
+def make_remote_handler(broker: Broker, poll_interval: float = None,
+                        queue: DownloadQueue = None) -> Callable:
+    """معالج يرسل المهمة للوسيط وينتظر نتيجتها من أحد العمال
+
+    ساعة مهلة المهمة متوقفة ما دامت المهمة تنتظر عاملاً في الوسيط، وتبدأ عند
+    حجزها، فلا يُحتسب وقت الانتظار في الوسيط من مهلة الزحف.
+    """
+    poll_interval = poll_interval or config.Config.BROKER_POLL_INTERVAL
+    queue = queue or download_queue
+
+    async def remote_download(task: QueueTask) -> Dict:
+        task.deadline = None
+        job_id = await _attach_or_submit(broker, task, queue)
+        last_progress = None
+
+        try:
+            while True:
+                job = await broker.get(job_id)
+                if job is None:
+                    return {'success': False, 'error': "اختفت المهمة من الوسيط"}
+
+                if job['status'] == JobStatus.RUNNING and task.deadline is None:
+                    task.deadline = time.monotonic() + task.timeout
+                elif job['status'] == JobStatus.QUEUED:
+                    task.deadline = None  # لم يحجزها عامل بعد (أو عادت بعد فقد العقد)
+
+                if job['progress'] != last_progress:
+                    last_progress = job['progress']
+                    await queue.report_progress(task, last_progress)
+
+                if job['status'] == JobStatus.DONE:
+                    return job['result'] or {'success': False, 'error': "نتيجة فارغة من العامل"}
+                if job['status'] in (JobStatus.FAILED, JobStatus.CANCELLED):
+                    return {'success': False, 'error': job['error'] or job['status']}
+
+                await asyncio.sleep(poll_interval)
+
+        except asyncio.CancelledError:
+            # إيقاف الواجهة ليس إلغاءً: المهمة تكمل على العامل وتُستأنف متابعتها بعد التشغيل
+            if queue.is_running:
+                await broker.cancel(job_id)
+            raise
+
+    return remote_download
+
+class CrawlWorker:
+    """عامل زحف يحجز المهام من الوسيط؛ لكل خانة متصفح مستقل"""
+
+    def __init__(self, broker: Broker, concurrency: int = None, poll_interval: float = None,
+                 downloader_factory: Callable = WebsiteDownloader):
+        self.broker = broker
+        self.concurrency = concurrency or config.Config.WORKER_CONCURRENCY
+        self.poll_interval = poll_interval or config.Config.BROKER_POLL_INTERVAL
+        self.downloader_factory = downloader_factory
+        self.worker_id = f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._slots = []
+        self._is_running = False
+        self.stats = {'completed': 0, 'failed': 0, 'lost_leases': 0}
+
+    async def start(self):
+        """بدء خانات العامل"""
+        if self._is_running:
+            return
+
+        self._is_running = True
+        await self.broker.start()
+        self._slots = [
+            asyncio.create_task(self._slot_loop(slot)) for slot in range(self.concurrency)
+        ]
+        logger.info(f"👷 تم بدء عامل الزحف {self.worker_id} ({self.concurrency} خانة)")
+
+    async def stop(self):
+        """إيقاف الخانات؛ المهام غير المكتملة تعود للوسيط عند انتهاء عقدها"""
+        self._is_running = False
+
+        for slot in self._slots:
+            slot.cancel()
+        await asyncio.gather(*self._slots, return_exceptions=True)
+        self._slots = []
+
+        await self.broker.stop()
+        logger.info(f"⏹️ تم إيقاف عامل الزحف {self.worker_id}")
+
+    async def _slot_loop(self, slot: int):
+        """حلقة خانة واحدة: حجز، تنفيذ، ثم التالي"""
+        downloader = self.downloader_factory()
+        await downloader.initialize()
+
+        try:
+            while self._is_running:
+                try:
+                    job = await self.broker.claim(self.worker_id)
+                    if job is None:
+                        await asyncio.sleep(self.poll_interval)
+                        continue
+
+                    await self._run_job(downloader, job)
+
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ خطأ في خانة العامل {slot}: {e}")
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            await downloader.close()
+
+    async def _run_job(self, downloader: WebsiteDownloader, job: Dict):
+        """تنفيذ مهمة مع تجديد العقد ونشر التقدم"""
+        job_id = job['id']
+        state = {'progress': None, 'message': None}
+        logger.info(f"▶️ العامل {self.worker_id} بدأ المهمة {job_id} (المحاولة {job['attempts']})")
+
+        async def on_progress(progress: float, message: str = ""):
+            state['progress'], state['message'] = progress, message
+
+        crawl = asyncio.create_task(run_download(downloader, job['payload'], on_progress))
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, state, crawl))
+
+        try:
+            result = await crawl
+            if await self.broker.complete(job_id, self.worker_id, result):
+                self.stats['completed'] += 1
+                logger.info(f"✅ العامل أكمل المهمة {job_id}: {result['zip_path']}")
+        except asyncio.CancelledError:
+            if self._is_running:
+                # أُلغيت من الواجهة أو فقدنا العقد
+                logger.info(f"🚫 توقفت المهمة {job_id} على العامل")
+                return
+            raise
+        except Exception as e:
+            self.stats['failed'] += 1
+            await self.broker.fail(job_id, self.worker_id, str(e))
+            logger.error(f"❌ فشلت المهمة {job_id} على العامل: {e}")
+        finally:
+            heartbeat.cancel()
+            if not crawl.done():
+                crawl.cancel()
+                await asyncio.gather(crawl, return_exceptions=True)
+
+    async def _heartbeat(self, job_id: str, state: Dict, crawl: asyncio.Task):
+        """تجديد العقد دورياً؛ إيقاف الزحف إذا أُلغيت المهمة أو حجزها عامل آخر"""
+        # التجديد ينقل التقدم أيضاً، لذا لا ينتظر ثلث مهلة العقد كاملاً
+        interval = min(self.broker.lease_timeout / 3, max(1.0, self.poll_interval))
+        while not crawl.done():
+            await asyncio.sleep(interval)
+            if not await self.broker.heartbeat(job_id, self.worker_id, state['progress'], state['message']):
+                self.stats['lost_leases'] += 1
+                logger.warning(f"⚠️ فقد العامل عقد المهمة {job_id}، إيقاف الزحف")
+                crawl.cancel()
+                return
+
+    def get_stats(self) -> Dict:
+        """إحصائيات العامل"""
+        return {'worker_id': self.worker_id, 'concurrency': self.concurrency, **self.stats}
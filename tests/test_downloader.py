@@ -8,9 +8,13 @@ import asyncio
 import tempfile
 import os
 from unittest.mock import Mock, patch, AsyncMock
-from services.downloader import WebsiteDownloader
+from services.downloader import WebsiteDownloader, DownloadQuota, QuotaExceeded
 from services.cache_manager import cache_manager
 from services.security_manager import security_manager
+from services.memory_governor import MemoryGovernor, MemoryPressure, memory_governor
+from services.autoscaler import ConcurrencyAutoscaler, ScaleAction
+from services.progress_publisher import ProgressPublisher
+from services.rate_limiter import OutboundRateLimiter, Priority
 import config
 
 class TestWebsiteDownloader:
@@ -46,12 +50,8 @@ class TestWebsiteDownloader:
     @pytest.mark.asyncio
     async def test_memory_check(self, downloader):
         """اختبار فحص الذاكرة"""
-        # محاكاة استهلاك ذاكرة عالي
-        with patch('psutil.Process') as mock_process:
-            mock_memory = Mock()
-            mock_memory.rss = 1024 * 1024 * 1024  # 1GB
-            mock_process.return_value.memory_info.return_value = mock_memory
-            
+        # محاكاة ضغط ذاكرة حرج من منظم الذاكرة
+        with patch.object(memory_governor, 'pressure', MemoryPressure.CRITICAL):
             result = await downloader._check_memory_usage()
             assert result is False  # يجب أن يعيد False للذاكرة العالية
     
@@ -152,6 +152,803 @@ class TestWebsiteDownloader:
             
             assert "رابط غير آمن" in str(exc_info.value)
 
+class TestDownloadQuota:
+    """اختبارات حصص موارد التنزيل"""
+    
+    def test_page_limit(self):
+        """اختبار حد الصفحات"""
+        quota = DownloadQuota(max_pages=2)
+        quota.charge_page()
+        quota.charge_page()
+        
+        with pytest.raises(QuotaExceeded):
+            quota.charge_page()
+        assert quota.exceeded == "max_pages"
+    
+    def test_bytes_and_wall_time(self):
+        """اختبار حد البايتات والوقت"""
+        quota = DownloadQuota(max_bytes=100)
+        quota.charge_bytes(100)
+        with pytest.raises(QuotaExceeded):
+            quota.check()
+        assert quota.exceeded == "max_bytes"
+        
+        quota = DownloadQuota(max_wall_time=0)
+        with pytest.raises(QuotaExceeded):
+            quota.check()
+        assert quota.exceeded == "wall_time"
+        assert quota.timeout_ms(60000) == 1000
+    
+    @pytest.mark.asyncio
+    async def test_assets_per_page(self):
+        """اختبار حد الموارد لكل صفحة"""
+        downloader = WebsiteDownloader()
+        downloader.download_resource = AsyncMock()
+        html = "".join(f'<img src="/img{i}.png">' for i in range(10))
+        
+        await downloader.download_resources(html, "/tmp", "https://example.com",
+                                            DownloadQuota(max_assets_per_page=3))
+        
+        assert downloader.download_resource.call_count == 3
+
+class TestMemoryGovernor:
+    """اختبارات منظم الذاكرة"""
+    
+    @pytest.mark.asyncio
+    async def test_pressure_levels(self):
+        """اختبار حساب مستويات الضغط"""
+        governor = MemoryGovernor(budget_mb=1000)
+        
+        with patch.object(governor, '_read_rss', return_value=(400.0, 560.0)):
+            await governor.sample()
+        assert governor.pressure == MemoryPressure.CRITICAL
+        
+        # الهامش يمنع النزول الفوري تحت العتبة مباشرة
+        with patch.object(governor, '_read_rss', return_value=(400.0, 520.0)):
+            await governor.sample()
+        assert governor.pressure == MemoryPressure.CRITICAL
+        
+        with patch.object(governor, '_read_rss', return_value=(100.0, 100.0)):
+            await governor.sample()
+        assert governor.pressure == MemoryPressure.NORMAL
+    
+    @pytest.mark.asyncio
+    async def test_admission_throttling(self):
+        """اختبار تقييد الصفحات الجديدة تحت الضغط"""
+        governor = MemoryGovernor(budget_mb=1000)
+        governor.pressure = MemoryPressure.HIGH
+        
+        await governor.acquire_page()
+        with pytest.raises(asyncio.TimeoutError):
+            await governor.acquire_page(timeout=0.05)
+        
+        await governor.release_page()
+        await governor.acquire_page(timeout=0.05)
+        assert governor.get_stats()['active_pages'] == 1
+
+class TestAutoscaler:
+    """اختبارات التحجيم التلقائي لحد التزامن"""
+    
+    def _saturate(self, queue, pending: int = 1):
+        """محاكاة قائمة مشبعة: كل الخانات مشغولة ومهام منتظرة"""
+        queue.running_tasks = {f"r{i}": {} for i in range(queue.max_concurrent)}
+        queue._pending_index = {f"p{i}": None for i in range(pending)}
+    
+    @pytest.mark.asyncio
+    async def test_additive_increase_and_multiplicative_decrease(self):
+        """اختبار الزيادة بواحد عند السلامة والتنصيف عند الحمل الزائد"""
+        from services.queue_manager import DownloadQueue
+        queue = DownloadQueue(max_concurrent=4)
+        scaler = ConcurrencyAutoscaler(queue=queue, governor=MemoryGovernor(budget_mb=1000),
+                                       min_concurrent=1, max_concurrent=6)
+        
+        self._saturate(queue)
+        assert scaler.evaluate() == 5
+        self._saturate(queue)
+        assert scaler.evaluate() == 6
+        self._saturate(queue)
+        assert scaler.evaluate() == 6  # الحد الأعلى
+        
+        # تأخر حلقة الأحداث يخفض الحد للنصف ثم يمنع الزيادة لفترة التهدئة
+        scaler._max_lag = 1.0
+        assert scaler.evaluate() == 3
+        assert scaler.last_decision['reason'] == 'loop_lag'
+        self._saturate(queue)
+        assert scaler.evaluate() == 3
+        assert scaler.last_decision['reason'] == 'cooldown'
+        
+        # القائمة غير المشبعة لا تحتاج زيادة
+        queue.running_tasks, queue._pending_index = {}, {}
+        scaler._cooldown_left = 0
+        assert scaler.evaluate() == 3
+        assert scaler.last_decision['reason'] == 'idle'
+    
+    @pytest.mark.asyncio
+    async def test_overload_signals(self):
+        """اختبار إشارات الذاكرة وزمن العرض والأخطاء"""
+        from services.queue_manager import DownloadQueue
+        queue = DownloadQueue(max_concurrent=8)
+        governor = MemoryGovernor(budget_mb=1000)
+        scaler = ConcurrencyAutoscaler(queue=queue, governor=governor, min_concurrent=1, max_concurrent=8)
+        
+        governor.pressure = MemoryPressure.HIGH
+        assert scaler.evaluate() == 4
+        assert scaler.last_decision['reason'] == 'memory'
+        governor.pressure = MemoryPressure.NORMAL
+        
+        for latency in [1.0] * 10 + [scaler.latency_target * 2]:
+            scaler.record_page_latency(latency)
+        assert scaler.evaluate() == 2
+        assert scaler.last_decision['reason'] == 'latency'
+        
+        queue.stats['completed_tasks'] += 1
+        queue.stats['failed_tasks'] += 3
+        assert scaler.evaluate() == 1
+        assert scaler.last_decision['reason'] == 'errors'
+        
+        # الحد الأدنى
+        governor.pressure = MemoryPressure.CRITICAL
+        assert scaler.evaluate() == 1
+        assert scaler.last_decision['action'] == ScaleAction.DECREASE
+
+class TestProgressPublisher:
+    """اختبارات ناشر رسائل التقدم"""
+    
+    @pytest.mark.asyncio
+    async def test_coalesce_and_skip_identical(self):
+        """اختبار دمج التحديثات المتقاربة وتخطي النص المتطابق"""
+        bot = Mock()
+        bot.edit_message_text = AsyncMock()
+        publisher = ProgressPublisher(bot=bot, min_interval=0.2, global_rate=100)
+        await publisher.start()
+        
+        publisher.publish(1, 10, "10%")
+        await asyncio.sleep(0.05)
+        for text in ("20%", "30%", "40%"):
+            publisher.publish(1, 10, text)
+        await asyncio.sleep(0.3)
+        
+        sent = [call.kwargs['text'] for call in bot.edit_message_text.call_args_list]
+        assert sent == ["10%", "40%"]
+        
+        # النص المطابق لآخر إرسال لا يُرسل
+        assert publisher.publish(1, 10, "40%") is False
+        await publisher.stop()
+        assert publisher.stats['coalesced'] == 2
+    
+    @pytest.mark.asyncio
+    async def test_first_update_does_not_block_loop(self):
+        """اختبار أن أول تحديث لرسالة جديدة يُرسل ولا يعلق حلقة الأحداث"""
+        bot = Mock()
+        bot.edit_message_text = AsyncMock()
+        publisher = ProgressPublisher(bot=bot, min_interval=0.2, global_rate=1000)
+        
+        for message_id in range(5):
+            publisher.publish(1, message_id, "بدء")
+        await asyncio.wait_for(publisher._flush_due(), timeout=1)
+        assert bot.edit_message_text.call_count == 5
+    
+    @pytest.mark.asyncio
+    async def test_retry_after_blocks_globally(self):
+        """اختبار التوقف العام عند RetryAfter وإسقاط الحالات الوسيطة تحت الضغط"""
+        from telegram.error import RetryAfter
+        bot = Mock()
+        bot.edit_message_text = AsyncMock(side_effect=[RetryAfter(1), None, None])
+        publisher = ProgressPublisher(bot=bot, min_interval=0.1, global_rate=100, max_pending=1)
+        
+        publisher.publish(1, 10, "50%")
+        assert publisher.publish(2, 20, "5%") is False  # امتلاء المعلقات
+        assert publisher.publish(2, 20, "✅ تم", final=True) is True
+        
+        await publisher.start()
+        await asyncio.sleep(0.1)
+        assert publisher.blocked_for() > 0
+        assert bot.edit_message_text.call_count == 1
+        
+        await asyncio.sleep(1.1)
+        await publisher.stop()
+        sent = {call.kwargs['chat_id']: call.kwargs['text'] for call in bot.edit_message_text.call_args_list[1:]}
+        assert sent == {1: "50%", 2: "✅ تم"}
+        assert publisher.stats['dropped'] == 1
+
+class TestRateLimiter:
+    """اختبارات محدد معدل الطلبات الصادرة"""
+    
+    @staticmethod
+    def _request(limiter, calls, name, chat_id, endpoint="sendMessage", rate_limit_args=None):
+        async def callback():
+            calls.append(name)
+            return name
+        return limiter.process_request(callback, (), {}, endpoint, {'chat_id': chat_id}, rate_limit_args)
+    
+    @pytest.mark.asyncio
+    async def test_priority_order(self):
+        """الرد التفاعلي يسبق الرسائل الجماعية المنتظرة قبله"""
+        limiter = OutboundRateLimiter(global_rate=20, chat_rate=20)
+        await limiter.initialize()
+        try:
+            limiter._global.tokens = 0  # البوت مشبع حالياً
+            calls = []
+            bulk = {'priority': Priority.BULK}
+            await asyncio.wait_for(asyncio.gather(
+                self._request(limiter, calls, "bulk-1", 1, rate_limit_args=bulk),
+                self._request(limiter, calls, "bulk-2", 2, rate_limit_args=bulk),
+                self._request(limiter, calls, "reply", 3),
+            ), 2)
+            assert calls == ["reply", "bulk-1", "bulk-2"]
+        finally:
+            await limiter.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_saturated_chat_does_not_block_others(self):
+        """محادثة تجاوزت حدها تنتظر وحدها دون حجز الطلبات الأخرى"""
+        limiter = OutboundRateLimiter(global_rate=100, chat_rate=5, chat_burst=1)
+        await limiter.initialize()
+        try:
+            calls = []
+            await asyncio.wait_for(asyncio.gather(
+                self._request(limiter, calls, "a-1", 1),
+                self._request(limiter, calls, "a-2", 1),
+                self._request(limiter, calls, "b-1", 2),
+            ), 2)
+            assert calls == ["a-1", "b-1", "a-2"]
+        finally:
+            await limiter.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_retry_after(self):
+        """إعادة الطلب بعد RetryAfter، عدا تعديلات التقدم التي يدمجها الناشر"""
+        from telegram.error import RetryAfter
+        limiter = OutboundRateLimiter(max_retries=2)
+        await limiter.initialize()
+        try:
+            attempts = []
+            async def flaky():
+                attempts.append(1)
+                if len(attempts) == 1:
+                    raise RetryAfter(0)
+                return True
+            
+            assert await limiter.process_request(flaky, (), {}, "sendMessage", {'chat_id': 1}, None) is True
+            assert limiter.stats['retried'] == 1
+            
+            attempts.clear()
+            with pytest.raises(RetryAfter):
+                await limiter.process_request(flaky, (), {}, "editMessageText", {'chat_id': 1}, None)
+            assert len(attempts) == 1
+        finally:
+            await limiter.shutdown()
+
+class TestBroadcast:
+    """اختبارات محرك الرسائل الجماعية"""
+    
+    @staticmethod
+    def _fake_bot(sent, hang_on=None, blocked=()):
+        from telegram.error import Forbidden
+        bot = Mock()
+        async def send_message(chat_id, text, **kwargs):
+            if chat_id == hang_on:
+                await asyncio.Event().wait()  # انقطاع العملية أثناء الدفعة
+            if chat_id in blocked:
+                raise Forbidden("bot was blocked by the user")
+            sent.append(chat_id)
+        bot.send_message = send_message
+        return bot
+    
+    @pytest.mark.asyncio
+    async def test_resume_after_restart(self, tmp_path):
+        """الاستئناف من آخر دفعة محفوظة دون إعادة الإرسال لمن استلم"""
+        from services.broadcast import BroadcastEngine, BroadcastStatus
+        users = list(range(1, 8))
+        def make_engine(bot):
+            return BroadcastEngine(
+                bot, path=str(tmp_path / "broadcast.db"), batch_size=3, concurrency=2,
+                recipient_page=lambda cursor, limit: [u for u in users if u > cursor][:limit],
+                recipient_count=lambda: len(users)
+            )
+        
+        first_sent = []
+        engine = make_engine(self._fake_bot(first_sent, hang_on=5))
+        await engine.start()
+        broadcast_id = await engine.create("مرحبا")
+        for _ in range(100):
+            if 4 in first_sent:
+                break
+            await asyncio.sleep(0.01)
+        await engine.stop()  # إيقاف البوت أثناء الدفعة الثانية
+        assert first_sent[:3] == [1, 2, 3]
+        
+        second_sent = []
+        engine = make_engine(self._fake_bot(second_sent, blocked={7}))
+        await engine.start()
+        try:
+            await asyncio.wait_for(asyncio.gather(*engine._jobs.values()), 2)
+            state = await engine.get(broadcast_id)
+        finally:
+            await engine.stop()
+        
+        # الدفعة الأولى المحفوظة لا تتكرر، والدفعة المنقطعة تُعاد
+        assert not set(second_sent) & {1, 2, 3}
+        assert set(first_sent) | set(second_sent) == {1, 2, 3, 4, 5, 6}
+        assert state['status'] == BroadcastStatus.DONE
+        assert (state['sent'], state['failed'], state['total']) == (6, 1, 7)
+    
+    @pytest.mark.asyncio
+    async def test_unexpected_error_retries_then_fails(self, tmp_path):
+        """الخطأ العابر يُعاد بعده الإرسال من المؤشر، والمستمر يُعلّم الرسالة فاشلة ويُبلغ المشرف"""
+        from services.broadcast import BroadcastEngine, BroadcastStatus
+        users = list(range(1, 8))
+        calls = []
+        def recipient_page(cursor, limit):
+            calls.append(cursor)
+            if (cursor == 0 and calls.count(cursor) == 1) or cursor >= 3:
+                raise Exception("database is locked")
+            return [u for u in users if u > cursor][:limit]
+        
+        sent = []
+        engine = BroadcastEngine(
+            self._fake_bot(sent), path=str(tmp_path / "broadcast.db"), batch_size=3, concurrency=2,
+            recipient_page=recipient_page, recipient_count=lambda: len(users), max_retries=2
+        )
+        publisher = Mock()
+        with patch("services.broadcast.asyncio.sleep", AsyncMock()) as sleep, \
+                patch("services.broadcast.progress_publisher", publisher):
+            await engine.start()
+            try:
+                broadcast_id = await engine.create("مرحبا", admin_chat_id=1, status_message_id=10)
+                await asyncio.wait_for(asyncio.gather(*engine._jobs.values()), 2)
+                state = await engine.get(broadcast_id)
+                unfinished = engine._jobs
+            finally:
+                await engine.stop()
+        
+        # خطأ عابر ثم دفعة ناجحة، ثم خطأ مستمر: محاولتان ثم الفشل
+        assert calls == [0, 0, 3, 3, 3]
+        assert [call.args[0] for call in sleep.await_args_list] == [2, 2, 4]
+        assert sent == [1, 2, 3]
+        assert state['status'] == BroadcastStatus.FAILED
+        assert (state['sent'], state['cursor']) == (3, 3)
+        assert not unfinished
+        
+        args, kwargs = publisher.publish.call_args
+        assert args[:2] == (1, 10) and kwargs['final'] is True
+        assert "توقفت" in args[2] and "database is locked" in args[2]
+
+class TestArchiveDelivery:
+    """اختبارات تسليم الأرشيفات"""
+    
+    @pytest.mark.asyncio
+    async def test_split_and_retry_parts(self, tmp_path):
+        """أرشيف أكبر من الحد يُرسل كأجزاء مرقمة تُعاد محاولتها منفردة"""
+        from telegram.error import TimedOut
+        from services.delivery import ArchiveDelivery
+        
+        archive = tmp_path / "example.com.zip"
+        archive.write_bytes(b"0123456789A")
+        delivery = ArchiveDelivery(upload_limit=10, part_size=4, concurrency=2, max_retries=1)
+        assert delivery.part_count(str(archive)) == 3
+        
+        uploads = {}
+        failures = {"example.com.zip.002"}
+        async def send_document(chat_id, document, filename, caption, reply_markup=None, **kwargs):
+            if filename in failures:
+                failures.discard(filename)
+                raise TimedOut()
+            uploads[filename] = (document.read(), caption, reply_markup)
+            return filename
+        bot = Mock()
+        bot.send_document = send_document
+        
+        with patch("services.delivery.asyncio.sleep", AsyncMock()):
+            messages = await delivery.deliver(bot, 1, str(archive), "example.com.zip",
+                                              caption="جاهز", reply_markup="keyboard")
+        
+        assert messages == ["example.com.zip.001", "example.com.zip.002", "example.com.zip.003"]
+        assert b"".join(uploads[name][0] for name in messages) == b"0123456789A"
+        assert uploads["example.com.zip.003"][1].startswith("جاهز")
+        assert [uploads[name][2] for name in messages] == [None, None, "keyboard"]
+        assert delivery.stats['retries'] == 1
+        
+        # أرشيف ضمن الحد يُرسل كما هو
+        small = tmp_path / "small.zip"
+        small.write_bytes(b"x" * 10)
+        assert await delivery.deliver(bot, 1, str(small), "small.zip") == ["small.zip"]
+
+    @pytest.mark.asyncio
+    async def test_failed_part_cancels_remaining_uploads(self, tmp_path):
+        """رفض جزء يوقف رفع الأجزاء الجارية ولا يبدأ المتبقية"""
+        from telegram.error import BadRequest
+        from services.delivery import ArchiveDelivery, DeliveryError
+
+        archive = tmp_path / "example.com.zip"
+        archive.write_bytes(b"0123456789A")
+        delivery = ArchiveDelivery(upload_limit=10, part_size=4, concurrency=2, max_retries=1)
+
+        started, cancelled = [], []
+        async def send_document(chat_id, document, filename, caption, reply_markup=None, **kwargs):
+            started.append(filename)
+            if filename.endswith(".001"):
+                await asyncio.sleep(0.01)
+                raise BadRequest("Request Entity Too Large")
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.append(filename)
+                raise
+        bot = Mock()
+        bot.send_document = send_document
+
+        with pytest.raises(DeliveryError):
+            await delivery.deliver(bot, 1, str(archive), "example.com.zip")
+
+        # كل جزء بدأ رفعه بعد الجزء المرفوض أُلغي، ولا يبدأ شيء بعد الفشل
+        assert started[0] == "example.com.zip.001"
+        assert sorted(cancelled) == sorted(started[1:]) and "example.com.zip.002" in cancelled
+        count = len(started)
+        await asyncio.sleep(0.05)
+        assert len(started) == count
+
+    @pytest.mark.asyncio
+    async def test_file_id_reuse(self, tmp_path):
+        """الأرشيف المرسل سابقاً يُعاد إرساله بمعرفه: بدون رفع، وبدون زحف لنفس الرابط"""
+        from telegram.error import BadRequest
+        from services.delivery import ArchiveDelivery, FileIdStore, url_cache_key
+        
+        delivery = ArchiveDelivery(store=FileIdStore(path=str(tmp_path / "file_ids.db")))
+        await delivery.start()
+        try:
+            uploads, resends = [], []
+            async def send_document(chat_id, document, **kwargs):
+                if isinstance(document, str):
+                    if document == "expired":
+                        raise BadRequest("Wrong file identifier")
+                    resends.append(document)
+                    file_id = document
+                else:
+                    uploads.append(document.read())
+                    file_id = f"fid-{len(uploads)}"
+                return Mock(document=Mock(file_id=file_id))
+            bot = Mock()
+            bot.send_document = send_document
+            
+            archive = tmp_path / "a" / "example.com.zip"
+            archive.parent.mkdir()
+            archive.write_bytes(b"archive")
+            url_key = url_cache_key("https://example.com")
+            
+            assert await delivery.deliver_cached(bot, 1, url_key) is None
+            await delivery.deliver(bot, 1, str(archive), "example.com.zip", url_key=url_key)
+            assert len(uploads) == 1
+            
+            # نفس الرابط: بدون زحف ولا رفع
+            assert await delivery.deliver_cached(bot, 2, url_key) is not None
+            # زحف جديد بنفس المحتوى (موقع لم يتغير): بدون رفع
+            same = tmp_path / "b" / "example.com.zip"
+            same.parent.mkdir()
+            same.write_bytes(b"archive")
+            await delivery.deliver(bot, 3, str(same), "example.com.zip")
+            assert len(uploads) == 1 and resends == ["fid-1", "fid-1"]
+            
+            # معرف لم يعد صالحاً يُنسى فيعود الطلب للمسار العادي
+            await delivery.store.put([url_cache_key("https://old.com")], ["expired"])
+            assert await delivery.deliver_cached(bot, 1, url_cache_key("https://old.com")) is None
+            assert await delivery.store.get(url_cache_key("https://old.com")) is None
+        finally:
+            await delivery.stop()
+
+    @pytest.mark.asyncio
+    async def test_local_bot_api_sends_file_path(self, tmp_path):
+        """مع خادم Bot API محلي يُرسل مسار الملف بدلاً من رفع محتواه"""
+        from aiohttp import web
+        from telegram.ext import ExtBot
+        from services.delivery import ArchiveDelivery
+        
+        received = []
+        async def api(request):
+            method = request.match_info['method']
+            fields = await request.post()
+            received.append((method, request.content_type, dict(fields)))
+            if method == "getMe":
+                result = {'id': 1, 'is_bot': True, 'first_name': "bot", 'username': "bot"}
+            else:
+                result = {'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': "private"},
+                          'document': {'file_id': "fid", 'file_unique_id': "u"}}
+            return web.json_response({'ok': True, 'result': result})
+        
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", api)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        
+        bot = ExtBot("1:test", base_url=f"http://127.0.0.1:{port}/bot", local_mode=True)
+        try:
+            await bot.initialize()
+            archive = tmp_path / "example.com.zip"
+            archive.write_bytes(b"x" * 1024)
+            
+            delivery = ArchiveDelivery(local_mode=True)
+            messages = await delivery.deliver(bot, 5, str(archive), "example.com.zip", caption="جاهز")
+            
+            method, content_type, fields = received[-1]
+            assert method == "sendDocument" and messages[0].document.file_id == "fid"
+            assert content_type != "multipart/form-data"
+            assert fields['document'] == archive.absolute().as_uri()
+        finally:
+            await bot.shutdown()
+            await runner.cleanup()
+
+class TestWebhook:
+    """اختبارات استقبال Webhook"""
+    
+    @pytest.mark.asyncio
+    async def test_secret_token_and_enqueue(self):
+        """رفض الطلبات بدون السر ووضع التحديثات الصحيحة في قائمة التطبيق"""
+        import httpx
+        from telegram.ext import Application
+        from services.webhook import SECRET_HEADER, WebhookServer
+        
+        application = Application.builder().token("1:test").build()
+        server = WebhookServer(application, url="", secret="s3cret", host="127.0.0.1", port=0)
+        await server.start()
+        try:
+            endpoint = f"http://127.0.0.1:{server.bound_port}{server.path}"
+            update = {'update_id': 7, 'message': {'message_id': 1, 'date': 0, 'text': "/start",
+                                                   'chat': {'id': 5, 'type': "private"}}}
+            async with httpx.AsyncClient() as client:
+                missing = await client.post(endpoint, json=update)
+                rejected = await client.post(endpoint, json=update, headers={SECRET_HEADER: "wrong"})
+                accepted = await client.post(endpoint, json=update, headers={SECRET_HEADER: "s3cret"})
+            
+            assert missing.status_code == 403
+            assert rejected.status_code == 403
+            assert accepted.status_code == 200
+            queued = application.update_queue.get_nowait()
+            assert queued.update_id == 7 and queued.effective_chat.id == 5
+            assert application.update_queue.empty()
+            assert server.get_stats()['rejected'] == 2
+        finally:
+            await server.stop()
+    
+    @pytest.mark.asyncio
+    async def test_requires_secret_and_keeps_pending_updates(self):
+        """لا تشغيل بدون سر، والتسجيل لا يحذف التحديثات المنتظرة افتراضياً"""
+        from telegram.ext import Application
+        from services.webhook import WebhookServer
+        
+        application = Application.builder().token("1:test").build()
+        insecure = WebhookServer(application, url="", secret="", host="127.0.0.1", port=0)
+        with pytest.raises(Exception):
+            await insecure.start()
+        assert insecure._server_task is None
+        assert not insecure._authorized(None) and not insecure._authorized("")
+        
+        bot = AsyncMock()
+        server = WebhookServer(application, url="https://bot.example", secret="s3cret")
+        await server.register(bot, allowed_updates=["message"])
+        kwargs = bot.set_webhook.call_args.kwargs
+        assert kwargs['secret_token'] == "s3cret" and kwargs['drop_pending_updates'] is False
+        assert kwargs['url'] == "https://bot.example" + server.path
+
+class TestUpdateProcessor:
+    """اختبارات معالج التحديثات المتوازي"""
+    
+    @pytest.mark.asyncio
+    async def test_parallel_chats_ordered_within_chat(self):
+        """محادثة بطيئة لا تؤخر غيرها، وتحديثات المحادثة الواحدة تبقى بالترتيب"""
+        from telegram import Update
+        from services.update_processor import ChatOrderedUpdateProcessor
+        
+        processor = ChatOrderedUpdateProcessor(4)
+        events = []
+        
+        def make_update(update_id, chat_id):
+            return Update.de_json({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': 0, 'text': "x", 'chat': {'id': chat_id, 'type': "private"}
+            }}, None)
+        
+        async def handle(name, delay):
+            events.append(f"start {name}")
+            await asyncio.sleep(delay)
+            events.append(f"end {name}")
+        
+        # نفس طريقة التطبيق: مهمة لكل تحديث بترتيب الوصول
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(1, 100), handle("a1", 0.2))),
+            asyncio.create_task(processor.process_update(make_update(2, 100), handle("a2", 0))),
+            asyncio.create_task(processor.process_update(make_update(3, 200), handle("b1", 0))),
+        ]
+        await asyncio.wait_for(asyncio.gather(*tasks), 2)
+        
+        assert events.index("end b1") < events.index("end a1")
+        assert events.index("end a1") < events.index("start a2")
+        assert processor.get_stats()['active_chats'] == 0
+
+class TestDatabaseManager:
+    """اختبارات طبقة قاعدة البيانات غير المتزامنة"""
+    
+    @pytest.mark.asyncio
+    async def test_handler_queries(self, tmp_path):
+        """مسار المعالجات كاملاً: المستخدم، سجل التنزيل، الإحصائيات والسجلات"""
+        from services.database_manager import DatabaseManager
+        
+        manager = DatabaseManager(f"sqlite:///{tmp_path / 'bot.db'}")
+        try:
+            user, created = await manager.save_user(5, username="u", first_name="U")
+            assert created and user.telegram_id == 5
+            _, created = await manager.save_user(5)
+            assert not created and not await manager.is_premium(5)
+            
+            # كتابات متزامنة من عدة مهام كما تفعل المعالجات
+            ids = await asyncio.gather(*(
+                manager.create_download(5, f"https://site{i}.example", domain="site.example")
+                for i in range(10)
+            ))
+            await asyncio.gather(*(
+                manager.update_download(download_id, status='completed', file_size=100.0)
+                for download_id in ids[:7]
+            ))
+            
+            summary = await manager.get_user_summary(5)
+            assert summary['total'] == 10 and summary['successful'] == 7
+            assert summary['total_size'] == 700.0 and summary['last_download_at']
+            assert len(await manager.get_user_downloads(5, limit=3)) == 3
+            assert (await manager.get_download(ids[0])).status == 'completed'
+            
+            # العدادات المجمعة تتبع الكتابات، والانتهاء المكرر لا يُحتسب مرتين
+            await manager.update_download(ids[0], status='completed', file_size=100.0)
+            await manager.update_download(ids[7], status='failed')
+            totals = await manager.get_global_stats()
+            assert totals == {'users': 1, 'downloads': 10, 'completed': 7, 'failed': 1,
+                              'cancelled': 0, 'total_size': 700.0}
+            today = await manager.get_recent_stats(days=1)
+            assert today['new_users'] == 1 and today['downloads'] == 10 and today['completed'] == 7
+            assert await manager.get_top_domains() == [("site.example", 10)]
+            user_info = (await manager.get_user_stats(5))['user_info']
+            assert (user_info['total_downloads'], user_info['successful_downloads'],
+                    user_info['failed_downloads'], user_info['total_size']) == (10, 7, 1, 700.0)
+            
+            await manager.log_event('INFO', "test", 'tests', source="unit")
+            assert (await manager.get_recent_logs())[0]['metadata'] == {'source': "unit"}
+            await manager.set_cache("k", "v", ttl=60)
+            assert await manager.get_cache("k") == "v"
+            
+            # كل كتابة تمر بقفل الكاتب الواحد، بما فيها السجلات والكاش والتنظيف
+            acquire = manager._write_lock.acquire
+            writes = []
+            async def counting_acquire():
+                writes.append(1)
+                return await acquire()
+            manager._write_lock.acquire = counting_acquire
+            await manager.update_user(5, username="v")
+            assert await manager.add_user_warning(5) == 1
+            await manager.log_event('INFO', "test", 'tests')
+            await manager.log_security_event(5, "test", "low", "unit")
+            await manager.set_cache("k", "w", ttl=60)
+            assert await manager.get_cache("k") == "w"
+            await manager.delete_cache("k")
+            await manager.cleanup_expired_cache()
+            await manager.cleanup_old_data()
+            assert len(writes) == 9
+        finally:
+            await manager.close()
+    
+    @pytest.mark.asyncio
+    async def test_migrates_legacy_schema(self, tmp_path):
+        """قاعدة أنشأها مخطط database_manager القديم تُرحَّل للمخطط الموحد دون فقد بيانات"""
+        import sqlite3
+        import database
+        from services.database_manager import DatabaseManager
+        
+        path = tmp_path / "legacy.db"
+        connection = sqlite3.connect(path)
+        connection.executescript("""
+            CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE NOT NULL,
+                                is_banned BOOLEAN, warnings_count INTEGER, settings JSON);
+            CREATE TABLE downloads (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, url TEXT NOT NULL,
+                                    status VARCHAR(50), file_size INTEGER, completed_at DATETIME);
+            INSERT INTO users (telegram_id) VALUES (5);
+            INSERT INTO downloads (user_id, url, status, file_size, completed_at)
+            VALUES (5, 'https://a.example', 'completed', 10, '2024-01-01 00:00:00');
+        """)
+        connection.commit()
+        connection.close()
+        
+        manager = DatabaseManager(f"sqlite:///{path}")
+        try:
+            await manager.initialize()
+            assert not await manager.is_premium(5)
+            assert (await manager.get_download(1)).end_time.year == 2024
+            assert (await manager.get_user_summary(5))['successful'] == 1
+            assert await manager.add_user_warning(5) == 1
+            # العدادات تُعبأ من البيانات الموجودة عند الترحيل
+            totals = await manager.get_global_stats()
+            assert (totals['users'], totals['downloads'], totals['completed'], totals['total_size']) == (1, 1, 1, 10)
+            assert (await manager.get_user_stats(5))['user_info']['successful_downloads'] == 1
+        finally:
+            await manager.close()
+        
+        connection = sqlite3.connect(path)
+        try:
+            versions = [row[0] for row in connection.execute("SELECT version FROM schema_version ORDER BY version")]
+            indexes = {row[1] for row in connection.execute("PRAGMA index_list(downloads)")}
+            # /stats يُقرأ من الفهرس المغطي دون صفوف الجدول
+            plan = connection.execute(
+                "EXPLAIN QUERY PLAN SELECT count(*), sum(file_size), max(created_at) "
+                "FROM downloads WHERE user_id = 5 AND status = 'completed'"
+            ).fetchall()
+        finally:
+            connection.close()
+        assert versions == [version for version, _, _ in database.MIGRATIONS]
+        assert {'ix_downloads_created_at', 'ix_downloads_status',
+                'ix_downloads_user_created', 'ix_downloads_user_status'} <= indexes
+        assert "COVERING INDEX ix_downloads_user_status" in plan[0][-1]
+    
+    def test_upgrades_baseline_schema(self, tmp_path):
+        """قاعدة بمخطط database.py السابق للترحيلات تصل لآخر إصدار بصفوفها كما هي"""
+        import sqlite3
+        from sqlalchemy import create_engine, inspect
+        import database
+        
+        path = tmp_path / "baseline.db"
+        connection = sqlite3.connect(path)
+        connection.executescript("""
+            CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE NOT NULL, username VARCHAR,
+                                first_name VARCHAR, last_name VARCHAR, language_code VARCHAR, is_premium BOOLEAN,
+                                created_at DATETIME, last_activity DATETIME, total_downloads INTEGER,
+                                total_size FLOAT, is_banned BOOLEAN);
+            CREATE TABLE downloads (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, url VARCHAR NOT NULL,
+                                    domain VARCHAR, status VARCHAR, file_path VARCHAR, file_size FLOAT,
+                                    total_files INTEGER, start_time DATETIME, end_time DATETIME,
+                                    error_message VARCHAR, created_at DATETIME);
+            INSERT INTO users VALUES (1, 7, 'sara', 'Sara', NULL, 'ar', 1, '2024-01-01 10:00:00',
+                                      '2024-01-03 10:00:00', 0, 0.0, 0);
+            INSERT INTO downloads VALUES (1, 7, 'https://a.example', 'a.example', 'completed', '/tmp/a.zip', 2048.0,
+                                          12, '2024-01-02 10:00:00', '2024-01-02 10:05:00', NULL,
+                                          '2024-01-02 10:00:00');
+            INSERT INTO downloads VALUES (2, 7, 'https://b.example', 'b.example', 'failed', NULL, NULL, NULL,
+                                          '2024-01-03 10:00:00', '2024-01-03 10:01:00', 'timeout',
+                                          '2024-01-03 10:00:00');
+        """)
+        connection.commit()
+        downloads = connection.execute("SELECT * FROM downloads ORDER BY id").fetchall()
+        connection.close()
+        
+        engine = create_engine(f"sqlite:///{path}")
+        try:
+            with engine.begin() as conn:
+                assert database.migrate(conn) == database.SCHEMA_VERSION
+            # الترحيلات المجمدة تنتج كل أعمدة النماذج الحالية وفهارسها
+            inspector = inspect(engine)
+            for table in database.Base.metadata.sorted_tables:
+                columns = {column['name'] for column in inspector.get_columns(table.name)}
+                assert {column.name for column in table.columns} <= columns, table.name
+                indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+                assert {index.name for index in table.indexes} <= indexes, table.name
+        finally:
+            engine.dispose()
+        
+        connection = sqlite3.connect(path)
+        try:
+            # الأعمدة الأصلية بقيمها وترتيبها، والجديدة تُضاف بعدها
+            after = connection.execute("SELECT * FROM downloads ORDER BY id").fetchall()
+            assert [row[:len(downloads[0])] for row in after] == downloads
+            user = connection.execute(
+                "SELECT username, is_premium, created_at, total_downloads, successful_downloads, "
+                "failed_downloads, total_size, warnings_count FROM users WHERE telegram_id = 7"
+            ).fetchone()
+            totals = connection.execute(
+                "SELECT users, downloads, completed, failed, total_size FROM global_stats"
+            ).fetchone()
+            domains = connection.execute("SELECT domain, downloads FROM domain_stats ORDER BY domain").fetchall()
+        finally:
+            connection.close()
+        assert user == ('sara', 1, '2024-01-01 10:00:00', 2, 1, 1, 2048.0, 0)
+        assert totals == (1, 2, 1, 1, 2048.0)
+        assert domains == [('a.example', 1), ('b.example', 1)]
+
 class TestCacheManager:
     """اختبارات مدير الكاش"""
     
@@ -194,6 +991,26 @@ class TestCacheManager:
         assert 'memory_usage' in stats
         assert 'hit_rate' in stats
 
+class TestFileManager:
+    """اختبارات مدير الملفات"""
+    
+    @pytest.mark.asyncio
+    async def test_cleanup_removes_nested_archives(self, tmp_path):
+        """أرشيفات مجلدات المهام تُحذف مع مجلداتها، والحديثة تبقى"""
+        from services.file_manager import FileManager
+        
+        task_dir = tmp_path / "task-1"
+        task_dir.mkdir()
+        (task_dir / "example.com.zip").write_bytes(b"x" * 10)
+        
+        await FileManager.cleanup_old_files(str(tmp_path), max_age_hours=1)
+        assert (task_dir / "example.com.zip").exists()
+        
+        cleaned_count, cleaned_size = await FileManager.cleanup_old_files(str(tmp_path), max_age_hours=0)
+        assert not task_dir.exists()
+        assert cleaned_size == 10
+        assert tmp_path.exists()
+
 class TestSecurityManager:
     """اختبارات مدير الأمان"""
     
@@ -329,6 +1146,391 @@ class TestQueueManager:
         
         assert "تجاوز الحد الأقصى" in str(exc_info.value)
     
+    @pytest.mark.asyncio
+    async def test_burst_dispatch(self):
+        """اختبار ملء جميع الخانات الفارغة فوراً دون انتظار الاستطلاع"""
+        from services.queue_manager import DownloadQueue
+        queue = DownloadQueue(max_concurrent=2)
+        release = asyncio.Event()
+        
+        async def job(task):
+            await release.wait()
+            return {'success': True}
+        
+        await queue.start()
+        try:
+            for i in range(3):
+                await queue.add_task(100 + i, f"https://burst{i}.com", callback=job)
+            
+            await asyncio.sleep(0.05)
+            stats = queue.get_queue_stats()
+            assert stats['running_tasks'] == 2
+            assert stats['pending_tasks'] == 1
+            
+            # إكمال المهام يحرر الخانة للمهمة المنتظرة مباشرة
+            release.set()
+            await asyncio.sleep(0.05)
+            assert queue.get_queue_stats()['pending_tasks'] == 0
+        finally:
+            await queue.stop()
+    
+    @pytest.mark.asyncio
+    async def test_indexes_and_tombstones(self):
+        """اختبار الفهارس والحذف الكسول للمهام الملغاة"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        queue = DownloadQueue(max_concurrent=1)  # بدون تشغيل الموزع
+        
+        first = await queue.add_task(1, "https://a.com")
+        second = await queue.add_task(1, "https://b.com")
+        assert queue._get_user_pending_count(1) == 2
+        
+        assert await queue.cancel_task(first, 1) is True
+        assert queue._get_user_pending_count(1) == 1
+        assert queue.get_queue_stats()['pending_tasks'] == 1
+        
+        # الموزع يتخطى الشاهد الملغى
+        task = queue._pop_pending()
+        assert task.id == second
+        assert queue._pop_pending() is None
+        
+        user_tasks = {t.id: t for t in await queue.get_user_tasks(1)}
+        assert set(user_tasks) == {first, second}
+        assert user_tasks[first].status == TaskStatus.CANCELLED
+    
+    @pytest.mark.asyncio
+    async def test_fair_share_scheduling(self):
+        """اختبار توزيع الخانات بعدالة بين المستخدمين مع احترام الأولوية"""
+        from services.queue_manager import DownloadQueue, Priority
+        queue = DownloadQueue(max_concurrent=1)
+        
+        for i in range(4):
+            await queue.add_task(1, f"https://heavy{i}.com")
+        await queue.add_task(2, "https://casual.com")
+        await queue.add_task(3, "https://premium1.com", is_premium=True)
+        await queue.add_task(3, "https://premium2.com", is_premium=True)
+        await queue.add_task(4, "https://urgent.com", priority=Priority.URGENT)
+        
+        order = []
+        while (task := queue._pop_pending()) is not None:
+            order.append(task.user_id)
+        
+        # الأولوية العاجلة أولاً، ثم لا ينتظر المستخدم العادي خلف كل مهام المستخدم الثقيل
+        assert order == [4, 3, 3, 1, 2, 1, 1, 1]
+    
+    @pytest.mark.asyncio
+    async def test_persistent_queue_recovery(self, tmp_path):
+        """اختبار استعادة المهام المنتظرة والمهام منتهية العقد بعد إعادة التشغيل"""
+        import time
+        from services.queue_manager import DownloadQueue, TaskStatus
+        from services.queue_store import QueueStore
+        db_path = str(tmp_path / "queue.db")
+        
+        # عملية أولى تضيف مهام ثم "تنهار" أثناء تنفيذ إحداها
+        store = QueueStore(path=db_path, lease_timeout=30)
+        await store.start()
+        first = DownloadQueue(max_concurrent=1, store=store)
+        pending_id = await first.add_task(1, "https://pending.com", handler="download")
+        crashed_id = await first.add_task(2, "https://crashed.com", handler="download")
+        crashed = first._pending_index[crashed_id]
+        crashed.status = TaskStatus.RUNNING
+        store.save(crashed, "dead-worker", time.time() - 1)
+        await store.stop()
+        
+        # عملية ثانية تستعيد المهام وتعيد ربط المعالج
+        done = []
+        
+        async def handler(task):
+            done.append(task.id)
+            return {'success': True}
+        
+        second = DownloadQueue(max_concurrent=2, store=QueueStore(path=db_path, lease_timeout=30))
+        second.register_handler("download", handler)
+        await second.start()
+        try:
+            for _ in range(50):
+                if len(done) == 2:
+                    break
+                await asyncio.sleep(0.05)
+            
+            assert sorted(done) == sorted([pending_id, crashed_id])
+            recovered = await second.get_task_status(crashed_id)
+            assert recovered.retry_count == 1
+        finally:
+            await second.stop()
+    
+    @pytest.mark.asyncio
+    async def test_request_coalescing(self):
+        """اختبار خدمة الطلبات المتطابقة بزحف واحد مع مشاركة التقدم والنتيجة"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        queue_manager = DownloadQueue(max_concurrent=2)
+        release = asyncio.Event()
+        crawls = []
+        updates = {}
+        
+        async def crawl(task):
+            crawls.append(task.url)
+            await queue_manager.report_progress(task, 50.0)
+            await release.wait()
+            return {'success': True, 'zip_path': f"/tmp/{task.id}.zip"}
+        
+        async def listener(task):
+            updates.setdefault(task.id, []).append((task.status, task.progress))
+        
+        queue_manager.register_handler("crawl", crawl)
+        await queue_manager.start()
+        try:
+            first = await queue_manager.add_task(1, "https://Viral.com", handler="crawl", listener=listener)
+            second = await queue_manager.add_task(2, "https://viral.com/#top", handler="crawl", listener=listener)
+            leaver = await queue_manager.add_task(3, "https://viral.com:443/", handler="crawl", listener=listener)
+            other = await queue_manager.add_task(4, "https://viral.com", handler="crawl",
+                                                 options={'max_pages': 1}, listener=listener)
+            
+            await asyncio.sleep(0.1)
+            assert len(crawls) == 2  # خيارات مختلفة = زحف مستقل
+            assert await queue_manager.cancel_task(leaver, 3) is True
+            
+            release.set()
+            await asyncio.sleep(0.1)
+            
+            primary = await queue_manager.get_task_status(first)
+            subscriber = await queue_manager.get_task_status(second)
+            assert subscriber.status == TaskStatus.COMPLETED
+            assert subscriber.result == primary.result
+            assert (TaskStatus.RUNNING, 50.0) in updates[second]
+            assert (await queue_manager.get_task_status(leaver)).status == TaskStatus.CANCELLED
+            assert (await queue_manager.get_task_status(other)).result != primary.result
+            assert queue_manager.get_queue_stats()['coalesced_tasks'] == 2
+        finally:
+            await queue_manager.stop()
+    
+    @pytest.mark.asyncio
+    async def test_cancel_owner_keeps_shared_crawl(self):
+        """اختبار أن إلغاء صاحب زحف مشترك يظهر له ملغى بينما يكتمل الزحف للمشترك"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        queue = DownloadQueue(max_concurrent=1)
+        release = asyncio.Event()
+        
+        async def crawl(task):
+            await release.wait()
+            return {'success': True, 'zip_path': "/tmp/shared.zip"}
+        
+        queue.register_handler("crawl", crawl)
+        await queue.start()
+        try:
+            owner = await queue.add_task(1, "https://shared.com", handler="crawl")
+            follower = await queue.add_task(2, "https://shared.com", handler="crawl")
+            await asyncio.sleep(0.05)
+            
+            assert await queue.cancel_task(owner, 1) is True
+            assert (await queue.get_task_status(owner)).status == TaskStatus.CANCELLED
+            assert queue.get_queue_stats()['running_tasks'] == 1
+            
+            release.set()
+            await asyncio.sleep(0.05)
+            assert (await queue.get_task_status(owner)).status == TaskStatus.CANCELLED
+            assert (await queue.get_task_status(follower)).status == TaskStatus.COMPLETED
+        finally:
+            await queue.stop()
+    
+    @pytest.mark.asyncio
+    async def test_last_subscriber_drops_detached_retry(self):
+        """اختبار إسقاط زحف مفصول ينتظر إعادة المحاولة عند إلغاء آخر مشترك فيه"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        queue = DownloadQueue(max_concurrent=1)
+        queue.retry_base_delay = 60
+        release = asyncio.Event()
+        crawls = []
+        
+        async def crawl(task):
+            crawls.append(task.id)
+            await release.wait()
+            raise Exception("فشل مؤقت")
+        
+        queue.register_handler("crawl", crawl)
+        await queue.start()
+        try:
+            owner = await queue.add_task(1, "https://shared.com", handler="crawl")
+            follower = await queue.add_task(2, "https://shared.com", handler="crawl")
+            await asyncio.sleep(0.05)
+            assert await queue.cancel_task(owner, 1) is True
+        
+            # الفشل يعيد الزحف المفصول إلى heap التأجيل لأجل المشترك
+            release.set()
+            await asyncio.sleep(0.05)
+            assert owner in queue._retry_index
+        
+            assert await queue.cancel_task(follower, 2) is True
+            assert queue.get_queue_stats()['retrying_tasks'] == 0
+            assert not queue._inflight
+            assert (await queue.get_task_status(owner)).status == TaskStatus.CANCELLED
+            assert (await queue.get_task_status(follower)).status == TaskStatus.CANCELLED
+        
+            # طلب جديد لنفس الرابط يبدأ زحفاً مستقلاً بدل الإلحاق بزحف ميت
+            fresh = await queue.add_task(3, "https://shared.com", handler="crawl")
+            await asyncio.sleep(0.05)
+            assert crawls == [owner, fresh]
+        finally:
+            await queue.stop()
+    
+    @pytest.mark.asyncio
+    async def test_retry_frees_slot(self):
+        """اختبار أن إعادة المحاولة المؤجلة تحرر الخانة فوراً"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        queue = DownloadQueue(max_concurrent=1)
+        queue.retry_base_delay = 0.3
+        attempts = []
+        
+        async def flaky(task):
+            attempts.append(task.url)
+            if len(attempts) == 1:
+                raise Exception("فشل مؤقت")
+            return {'success': True}
+        
+        await queue.start()
+        try:
+            flaky_id = await queue.add_task(1, "https://flaky.com", callback=flaky)
+            await asyncio.sleep(0.05)
+            
+            # الخانة متاحة لمهمة أخرى أثناء انتظار موعد إعادة المحاولة
+            other_id = await queue.add_task(2, "https://other.com", callback=flaky)
+            await asyncio.sleep(0.05)
+            stats = queue.get_queue_stats()
+            assert stats['retrying_tasks'] == 1
+            assert flaky_id not in queue.completed_tasks
+            assert (await queue.get_task_status(other_id)).status == TaskStatus.COMPLETED
+            
+            await asyncio.sleep(0.5)
+            task = await queue.get_task_status(flaky_id)
+            assert task.status == TaskStatus.COMPLETED
+            assert task.retry_count == 1
+        finally:
+            await queue.stop()
+    
+    @pytest.mark.asyncio
+    async def test_bounded_history_spills_to_store(self, tmp_path):
+        """اختبار حد سجل المهام المنتهية وقراءة الأقدم من المخزن"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        from services.queue_store import QueueStore
+        store = QueueStore(path=str(tmp_path / "queue.db"))
+        await store.start()
+        queue = DownloadQueue(max_concurrent=1, store=store)
+        queue.history_size = 3
+        
+        try:
+            task_ids = []
+            for i in range(5):
+                task_id = await queue.add_task(7, f"https://site{i}.com")
+                await queue.cancel_task(task_id, 7)
+                task_ids.append(task_id)
+            
+            assert list(queue.completed_tasks) == task_ids[2:]
+            assert len(queue._user_completed[7]) == 3
+            
+            history = await queue.get_user_tasks(7)
+            assert [task.id for task in history] == task_ids[::-1]
+            assert all(task.status == TaskStatus.CANCELLED for task in history)
+        finally:
+            await store.stop()
+    
+    @pytest.mark.asyncio
+    async def test_deadline_frees_hung_slot(self):
+        """اختبار إيقاف المهمة العالقة بعد مهلتها وتحرير الخانة"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        queue = DownloadQueue(max_concurrent=1)
+        queue.deadline_grace = 0.05
+        
+        async def hang(task):
+            await asyncio.Event().wait()
+        
+        async def quick(task):
+            return {'success': True}
+        
+        await queue.start()
+        try:
+            hung_id = await queue.add_task(1, "https://hung.com", callback=hang, timeout=0.1)
+            quick_id = await queue.add_task(2, "https://quick.com", callback=quick)
+            await asyncio.sleep(0.4)
+            
+            hung = await queue.get_task_status(hung_id)
+            assert hung.status == TaskStatus.FAILED
+            assert hung.retry_count == 0
+            assert (await queue.get_task_status(quick_id)).status == TaskStatus.COMPLETED
+            assert queue.get_queue_stats()['timed_out_tasks'] == 1
+        finally:
+            await queue.stop()
+    
+    def test_best_fit_prefers_short_tasks(self):
+        """اختبار تفضيل المهام الأقصر تقديراً مع منع تجويع الطويلة"""
+        from services.queue_manager import DownloadQueue, QueueTask, MAX_SKIPS
+        queue = DownloadQueue(max_concurrent=1)
+        queue._record_duration(QueueTask(url="https://slow.com"), 120.0)
+        queue._record_duration(QueueTask(url="https://fast.com"), 5.0)
+        
+        slow = QueueTask(user_id=1, url="https://slow.com/a")
+        queue._push_pending(slow)
+        for i in range(MAX_SKIPS + 1):
+            queue._push_pending(QueueTask(user_id=2 + i, url=f"https://fast.com/{i}"))
+        
+        order = [queue._pop_best_fit().url for _ in range(MAX_SKIPS + 2)]
+        assert order[0].startswith("https://fast.com")
+        assert order.index("https://slow.com/a") == MAX_SKIPS
+    
+    @pytest.mark.asyncio
+    async def test_backpressure_and_position(self):
+        """اختبار رفض المهام عند التشبع وترتيب الانتظار والوقت المتوقع"""
+        from services.queue_manager import DownloadQueue, QueueFullError
+        queue = DownloadQueue(max_concurrent=1)
+        queue.max_pending = 3
+        queue._duration_estimates["a.com"] = 60.0
+        
+        updates = []
+        async def listener(task):
+            updates.append(task.id)
+        queue.register_listener("crawl", listener)
+        
+        first = await queue.add_task(1, "https://a.com/1", handler="crawl")
+        second = await queue.add_task(2, "https://a.com/2", handler="crawl")
+        third = await queue.add_task(3, "https://a.com/3", handler="crawl")
+        
+        with pytest.raises(QueueFullError) as error:
+            await queue.add_task(4, "https://a.com/4", handler="crawl")
+        assert error.value.retry_after == pytest.approx(180.0)
+        
+        # الطلب المطابق لزحف قائم لا يضيف حملاً فيُقبل رغم التشبع
+        follower = await queue.add_task(5, "https://a.com/3", handler="crawl")
+        
+        positions = [queue.get_queue_position(task_id) for task_id in (first, second, third, follower)]
+        assert [p['position'] for p in positions] == [1, 2, 3, 3]
+        assert [p['eta'] for p in positions] == [0.0, 60.0, 120.0, 120.0]
+        assert queue.get_queue_position("missing") is None
+        
+        # المستمع المسجل للمعالج يُربط بالمهام الجديدة
+        task = await queue.get_task_status(first)
+        assert task.listener is listener
+    
+    @pytest.mark.asyncio
+    async def test_position_matches_heap_order(self):
+        """اختبار تطابق الترتيب من شجرة الترتيب مع ترتيب الموزع بعد الإلغاء والسحب"""
+        from services.queue_manager import DownloadQueue, Priority
+        queue = DownloadQueue(max_concurrent=1)
+        queue.max_pending = 1000
+        
+        task_ids = [
+            await queue.add_task(i % 12, f"https://site{i}.com",
+                                 priority=Priority.HIGH if i % 5 == 0 else Priority.NORMAL)
+            for i in range(60)
+        ]
+        for task_id in task_ids[::4]:
+            await queue.cancel_task(task_id)
+        for _ in range(10):
+            queue._pop_best_fit()
+        
+        expected = sorted(queue._pending_index.values())
+        positions = {task_id: queue.get_queue_position(task_id)['position'] for task_id in queue._pending_index}
+        assert [positions[task.id] for task in expected] == list(range(1, len(expected) + 1))
+        assert len(queue._rank) == len(expected)
+        assert queue._rank.total == pytest.approx(sum(queue.estimate_duration(task) for task in expected))
+    
     @pytest.mark.asyncio
     async def test_queue_stats(self, queue_manager):
         """اختبار إحصائيات القائمة"""
@@ -339,6 +1541,155 @@ class TestQueueManager:
         assert 'completed_tasks' in stats
         assert 'max_concurrent' in stats
 
+class TestBroker:
+    """اختبارات وسيط المهام وعمال الزحف"""
+    
+    @staticmethod
+    def _make_broker(tmp_path):
+        """وسيط SQLite مؤقت للاختبار"""
+        from services.broker import SQLiteBroker
+        return SQLiteBroker(path=str(tmp_path / "broker.db"), lease_timeout=30, max_attempts=2)
+    
+    @staticmethod
+    def _fake_downloader_factory():
+        """محرك وهمي بنفس واجهة fork/download_website"""
+        class FakeDownloader:
+            def __init__(self, callback=None):
+                self.callback = callback
+            async def initialize(self): pass
+            async def close(self): pass
+            def fork(self, progress_callback=None):
+                return FakeDownloader(progress_callback)
+            async def download_website(self, url, output_dir, user_id=None, quota=None):
+                await self.callback(50.0, "نصف الطريق")
+                return os.path.join(output_dir, "site.zip"), 3, 1024
+        return FakeDownloader
+    
+    @pytest.mark.asyncio
+    async def test_claim_lease_and_reclaim(self, tmp_path):
+        """اختبار الحجز الحصري واستعادة مهمة عامل منهار بعد انتهاء عقده"""
+        from services.broker import JobStatus
+        broker = self._make_broker(tmp_path)
+        await broker.start()
+        try:
+            job_id = await broker.submit("download", {'url': "https://example.com"})
+            
+            job = await broker.claim("worker-a")
+            assert job['id'] == job_id and job['attempts'] == 1
+            assert await broker.claim("worker-b") is None
+            
+            # انتهاء العقد دون تجديد يعيد المهمة لعامل آخر
+            broker.lease_timeout = -1
+            assert await broker.heartbeat(job_id, "worker-a") is True
+            broker.lease_timeout = 30
+            reclaimed = await broker.claim("worker-b")
+            assert reclaimed['id'] == job_id and reclaimed['attempts'] == 2
+            
+            # العامل القديم لا يكتب فوق العامل الجديد
+            assert await broker.complete(job_id, "worker-a", {'zip_path': "stale.zip"}) is False
+            assert await broker.complete(job_id, "worker-b", {'zip_path': "a.zip"}) is True
+            
+            done = await broker.get(job_id)
+            assert done['status'] == JobStatus.DONE
+            assert done['result'] == {'zip_path': "a.zip"}
+            assert await broker.purge_finished(max_age=-1) == 1
+        finally:
+            await broker.stop()
+    
+    @pytest.mark.asyncio
+    async def test_stuck_crawl_delivers_partial_archive(self, tmp_path):
+        """زحف عالق بعد حد الوقت يُوقف قبل إلغاء القائمة ويُسلَّم ما نُزّل كأرشيف جزئي"""
+        from services.worker import run_download
+        
+        class StuckDownloader(WebsiteDownloader):
+            def fork(self, progress_callback=None):
+                return self
+            async def download_website(self, url, output_dir, user_id=None, quota=None):
+                domain_dir = os.path.join(output_dir, "example.com")
+                os.makedirs(domain_dir)
+                with open(os.path.join(domain_dir, "index.html"), "w") as f:
+                    f.write("<html></html>")
+                self.total_files, self.total_size = 1, 13
+                await asyncio.sleep(3600)  # صفحة لا تستجيب ولا تحترم الحصة
+        
+        with patch.object(config.Config, 'DOWNLOADS_DIR', str(tmp_path)), \
+                patch.object(config.Config, 'TASK_DEADLINE_GRACE', 0.1):
+            result = await asyncio.wait_for(run_download(StuckDownloader(), {
+                'task_id': "t1", 'url': "https://example.com", 'options': {'max_wall_time': 0.1}
+            }), 2)
+        
+        assert result['success'] and result['partial']
+        assert result['zip_path'] == os.path.join(str(tmp_path), "t1", "example.com.zip")
+        assert os.path.exists(result['zip_path'])
+        assert result['files_count'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_remote_execution_through_worker(self, tmp_path):
+        """اختبار تنفيذ مهمة القائمة على عامل منفصل؛ انتظار الوسيط لا يُحتسب من المهلة"""
+        from services.queue_manager import DownloadQueue, TaskStatus
+        from services.worker import CrawlWorker, DOWNLOAD_HANDLER, make_remote_handler
+        broker = self._make_broker(tmp_path)
+        worker = CrawlWorker(broker, concurrency=1, poll_interval=0.05,
+                             downloader_factory=self._fake_downloader_factory())
+        queue = DownloadQueue(max_concurrent=2)
+        queue.deadline_grace = 0.05
+        queue.register_handler(DOWNLOAD_HANDLER, make_remote_handler(broker, poll_interval=0.05, queue=queue))
+        
+        await broker.start()
+        await queue.start()
+        try:
+            task_id = await queue.add_task(1, "https://example.com", handler=DOWNLOAD_HANDLER, timeout=0.2)
+            
+            # لا يوجد عامل بعد: المهمة تنتظر في الوسيط أطول من مهلتها دون أن تفشل
+            await asyncio.sleep(0.5)
+            task = await queue.get_task_status(task_id)
+            assert task.status == TaskStatus.RUNNING
+            assert task.deadline is None
+            
+            await worker.start()
+            for _ in range(100):
+                task = await queue.get_task_status(task_id)
+                if task.status == TaskStatus.COMPLETED:
+                    break
+                await asyncio.sleep(0.05)
+            
+            assert task.status == TaskStatus.COMPLETED
+            assert task.result['zip_path'].endswith(os.path.join(task_id, "site.zip"))
+            assert worker.get_stats()['completed'] == 1
+        finally:
+            await queue.stop()
+            await worker.stop()
+    
+    @pytest.mark.asyncio
+    async def test_frontend_restart_keeps_and_reattaches_job(self, tmp_path):
+        """اختبار أن إيقاف الواجهة لا يلغي مهمة الوسيط وأن المتابعة تُستأنف بنفس المهمة"""
+        from services.broker import JobStatus
+        from services.queue_manager import DownloadQueue, QueueTask
+        from services.worker import make_remote_handler
+        broker = self._make_broker(tmp_path)
+        await broker.start()
+        try:
+            queue = DownloadQueue(max_concurrent=1)  # متوقفة كما أثناء الإيقاف
+            handler = make_remote_handler(broker, poll_interval=0.02, queue=queue)
+            task = QueueTask(user_id=1, url="https://example.com")
+            
+            run = asyncio.create_task(handler(task))
+            await asyncio.sleep(0.05)
+            run.cancel()
+            await asyncio.gather(run, return_exceptions=True)
+            
+            job_id = task.context['broker_job_id']
+            assert (await broker.get(job_id))['status'] == JobStatus.QUEUED
+            
+            # بعد الاستعادة: نفس المهمة تُتابع دون إرسال زحف مكرر
+            job = await broker.claim("worker-a")
+            await broker.complete(job['id'], "worker-a", {'success': True, 'zip_path': "a.zip"})
+            result = await handler(task)
+            assert result['zip_path'] == "a.zip"
+            assert sum((await broker.get_stats()).values()) == 1
+        finally:
+            await broker.stop()
+
 # تشغيل الاختبارات
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
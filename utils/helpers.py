@@ -1,7 +1,7 @@
 import re
 import os
 import hashlib
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse, urljoin, urlunparse
 from datetime import datetime
 import magic
 import aiofiles
@@ -34,6 +34,18 @@ def get_domain_from_url(url):
     except:
         return "unknown"
 
+def normalize_url(url):
+    """توحيد شكل الرابط لمقارنة الطلبات المتطابقة"""
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or '').lower()
+    
+    # حذف المنفذ الافتراضي
+    if parsed.port and (scheme, parsed.port) not in (('http', 80), ('https', 443)):
+        netloc = f"{netloc}:{parsed.port}"
+    
+    return urlunparse((scheme, netloc, parsed.path or '/', '', parsed.query, ''))
+
 def generate_unique_id():
     """إنشاء معرف فريد"""
     return hashlib.md5(datetime.now().isoformat().encode()).hexdigest()[:8]